@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Messages like the ones the server sends
+'''
+MESSAGES = {
+
+    # Small command reply
+    'reply': {'r': {'result': 7, 'status': 'ok'}, 'tid': '1672531200.123-0.456', 't': 1672531200.789},
+
+    # Batch of replies
+    'batch': [{'r': {'i': i, 'name': f'item-{i}', 'v': i * 0.5}, 'tid': f'tid-{i}', 't': 1672531200.0}
+              for i in range(100)],
+
+    # Matrix event, like ./test/site.py
+    'matrix': {'evt': 'matrixUpdate', 'ver': 42, 't': 1672531200.0, 'r': {'m': 100 * 100 * '0', 'w': 100, 'h': 100}},
+
+    # Table of numbers
+    'table': {'rows': [[r * 10 + c + 0.25 for c in range(10)] for r in range(500)]},
+}
+
+
+''' Returns encodes and decodes per second for a codec and message
+    @param [in] c       - Codec
+    @param [in] msg     - Message
+    @param [in] secs    - Approximate seconds to spend on each
+'''
+def benchCodec(c, msg, secs=0.2):
+
+    data = c.dumps(msg)
+    return loadgen.callRate(lambda: c.dumps(msg), secs), \
+           loadgen.callRate(lambda: c.loads(data), secs), len(data)
+
+
+def main():
+
+    codecs = {k: v() for k, v in ws.codec.JSON_CODECS.items()}
+    codecs.update({k: v() for k, v in ws.codec.BINARY_CODECS.items()})
+
+    for name, msg in MESSAGES.items():
+        Log(f'--- {name}')
+        Log(f'{"codec":>10} {"encode/s":>12} {"decode/s":>12} {"bytes":>10}')
+        for k, c in codecs.items():
+            enc, dec, size = benchCodec(c, msg)
+            Log(f'{k:>10} {enc:>12.0f} {dec:>12.0f} {size:>10}')
+
+if __name__ == '__main__':
+    main()
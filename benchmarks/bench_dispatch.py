@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import time
+import propertybag as pb
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Server using the original websocket dispatch, which copies the message
+    into a property bag, reads the options from the bag on every message,
+    and scans the handler groups for a match
+'''
+class LegacyApp(ws.WebShoesApp):
+
+    async def handleWsCmd(self, req, ws, conn, j, order):
+
+        tid = ''
+        res = None
+        try:
+            j = pb.Bag(j, '')
+
+            if self.opts.verbose:
+                Log(f'Message: {j}')
+
+            if j.tid:
+                tid = j.tid
+
+            for c,h in self.handlers.items():
+
+                r = None
+                if h['evt'] and h['evt'] in j:
+                    continue
+
+                elif h['cmd'] and j.exists(h['cmd']):
+                    cmd = j[h['cmd']]
+                    q = j[h['q']] if h['q'] in j else j
+
+                    p = cmd.split('/')
+                    while len(p) and not p[0]:
+                        p = p[1:]
+                    if 0 >= len(p) or p[0] != h['sub']:
+                        continue
+                    if 1 < len(p) and h['sub'] and p[0] == h['sub']:
+                        p = p[1:]
+                    if p[0] not in h['fm']:
+                        if '*' not in h['fm']:
+                            raise Exception(f'No handler for {cmd}')
+                        p[0] = '*'
+
+                    f = h['fm'][p[0]]
+                    ctx = pb.Bag({'p': cmd, 'req': req, 'opts': self.opts, 'wsa': self, 'ws': ws})
+                    r = f(ctx, pb.Bag(q))
+                else:
+                    continue
+
+                if r:
+                    if isinstance(r, pb.Bag):
+                        r = r.as_dict()
+                    res = {h['rep']:r} if 'rep' in h and h['rep'] else r
+                    if j.tid:
+                        res['tid'] = tid
+                    if 't' not in res:
+                        res['t'] = time.time()
+                break
+
+        except Exception as e:
+            Log(e)
+            res = {'error': str(e)}
+            if tid:
+                res['tid'] = tid
+
+        return res, None
+
+
+def cmdAdd(ctx, q):
+    return {'result': int(q.a) + int(q.b)}
+
+def cmdAddRaw(ctx, q):
+    return {'result': int(q['a']) + int(q['b'])}
+
+
+''' Time the dispatch of a small command, from decoded message to reply
+    @param [in] cls     - WebShoesApp class to benchmark
+    @param [in] wrap    - Handler argument mode
+    @param [in] count   - Number of commands
+    @param [in] metrics - False to turn off the counters, see metrics.py
+'''
+async def benchDispatch(cls, wrap, count=20000, metrics=True):
+
+    wsa = cls('127.0.0.1', 0, {'metrics': metrics})
+    wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {'add': cmdAddRaw if 'raw' == wrap else cmdAdd}, 'inline', wrap=wrap)
+    conn = loadgen.NullConn()
+    order = {}
+
+    async def call(i):
+        await wsa.handleWsCmd(None, None, conn, {'cmd': 'cmd/add', 'q': {'a': 2, 'b': 3}, 'tid': i}, order)
+
+    return await loadgen.perCall(call, count)
+
+
+async def run():
+    Log(f'{"":>18} {"us/cmd":>10}')
+    for name, cls, wrap, metrics in [('before', LegacyApp, 'bag', True),
+                                     ('after (bag)', ws.WebShoesApp, 'bag', True),
+                                     ('bag, no metrics', ws.WebShoesApp, 'bag', False),
+                                     ('after (light)', ws.WebShoesApp, 'light', True),
+                                     ('after (raw)', ws.WebShoesApp, 'raw', True),
+                                     ('raw, no metrics', ws.WebShoesApp, 'raw', False)]:
+        t = await benchDispatch(cls, wrap, metrics=metrics)
+        Log(f'{name:>18} {t*1e6:>10.2f}')
+
+
+def main():
+    loadgen.run(run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import time
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Server using the original fan-out, which builds and serializes
+    a message for every subscriber.  It queues on the connection like
+    the current one, so only the fan-out itself is compared.
+'''
+class LegacyApp(ws.WebShoesApp):
+
+    async def sendEvent(self, ev):
+        t = time.time()
+        ver = self.evh[ev].ver
+        r = self.evh[ev].last
+        ruids = []
+        for k,v in self.evh[ev].subs.items():
+            if v.ver != ver:
+                v.ver = ver
+                msg = self.json.dumps({'evt':ev, 'uid': k, 'ver':ver, 't':t, 'r':r})
+                if not v.conn.push((ev, k), msg):
+                    ruids.append(v)
+        for v in ruids:
+            self.removeUid(v.uid, v.conn)
+
+
+''' Time a single event broadcast to the specified number of subscribers
+    @param [in] cls     - WebShoesApp class to benchmark
+    @param [in] subs    - Number of subscribers
+    @param [in] opts    - Server options
+    @param [in] reps    - Number of broadcasts to average over
+'''
+async def benchFanout(cls, subs, opts={}, reps=5):
+
+    wsa = cls('127.0.0.1', 0, opts)
+    sock = loadgen.NullConn()
+    for i in range(subs):
+        await wsa.addEventHanlder('matrixUpdate', f'uid-{i}', sock)
+
+    # Something like the matrix in ./test/site.py, but larger
+    m = 100 * 100 * '0'
+
+    async def call(i):
+        await wsa.triggerEventSync('matrixUpdate', {'m': m, 'w': 100, 'h': 100})
+
+    return await loadgen.perCall(call, reps)
+
+
+async def run():
+    Log(f'{"subscribers":>12} {"before ms":>12} {"after ms":>12} {"no uid ms":>12}')
+    for subs in [10, 100, 1000, 5000]:
+        legacy = await benchFanout(LegacyApp, subs)
+        current = await benchFanout(ws.WebShoesApp, subs)
+        nouid = await benchFanout(ws.WebShoesApp, subs, {'evtnouid': True})
+        Log(f'{subs:>12} {legacy*1000:>12.2f} {current*1000:>12.2f} {nouid*1000:>12.2f}')
+
+
+def main():
+    loadgen.run(run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import json
+from aiohttp import web
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Server using the original dispatch, which attempts a websocket
+    handshake on every request and falls back to http when it throws
+'''
+class LegacyApp(ws.WebShoesApp):
+
+    async def reqHandler(self, req):
+        try:
+            wsr = web.WebSocketResponse()
+            await wsr.prepare(req)
+            try:
+                await self.handleWs(req, wsr)
+                return wsr
+            except Exception as e:
+                Log(e)
+        except Exception as e:
+            try:
+                return await self.handleHttp(req)
+            except Exception as e:
+                return web.Response(text=json.dumps({'error': str(e)}))
+
+
+def cmdHeartbeat(ctx, q):
+    return {'status': 'ok'}
+
+
+''' Measure http requests per second against the specified app class
+    @param [in] cls     - WebShoesApp class to benchmark
+    @param [in] secs    - Seconds to measure for
+'''
+async def benchApp(cls, secs=3):
+    wsa = cls(loadgen.host, loadgen.port, {'verbose': False})
+    wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {
+            'heartbeat': cmdHeartbeat
+        })
+    async with loadgen.serving(wsa, '/cmd/heartbeat') as session:
+        r = await loadgen.httpLoad(session, loadgen.url('/cmd/heartbeat'), secs=secs)
+    return r['rate']
+
+
+async def run():
+    legacy = await benchApp(LegacyApp)
+    Log(f'before (handshake first) : {legacy:10.1f} req/s')
+    current = await benchApp(ws.WebShoesApp)
+    Log(f'after  (header dispatch) : {current:10.1f} req/s')
+    Log(f'speedup                  : {current / legacy:10.2f}x')
+
+
+def main():
+    loadgen.run(run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import threading
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Server using the original trigger, which goes through the
+    threadmsg queue and waits for msgThread to drain it
+'''
+class LegacyApp(ws.WebShoesApp):
+
+    def triggerEvent(self, event, data):
+        return self.thread.call('triggerEventSync', event=event, data=data)
+
+
+''' Measure trigger to receive latency for events published from a worker thread
+    @param [in] cls     - WebShoesApp class to benchmark
+    @param [in] count   - Number of events to publish
+    @param [in] gap     - Seconds between events
+'''
+async def benchApp(cls, count=1000, gap=0.002):
+
+    wsa = cls(loadgen.host, loadgen.port, {'verbose': False})
+    wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {})
+
+    lat = []
+    async with loadgen.serving(wsa) as session:
+
+        done = asyncio.get_running_loop().create_future()
+        def onEvent(j):
+            lat.append(time.perf_counter() - j['r']['t'])
+            if j['r']['i'] == count - 1 and not done.done():
+                done.set_result(True)
+
+        c = await loadgen.WsClient.connect(session, onEvent)
+        try:
+            await c.call({'evt': 'tick', 'uid': 'bench'})
+
+            # Publish from another thread, like a worker would
+            def producer():
+                for i in range(count):
+                    wsa.triggerEvent('tick', {'i': i, 't': time.perf_counter()})
+                    time.sleep(gap)
+            th = threading.Thread(target=producer)
+            th.start()
+
+            await asyncio.wait_for(done, 60)
+            th.join()
+        finally:
+            await c.close()
+
+    s = loadgen.summary(lat)
+    return s['p50'], s['p99']
+
+
+async def run():
+    Log(f'{"":>8} {"p50 ms":>10} {"p99 ms":>10}')
+    for name, cls in [('before', LegacyApp), ('after', ws.WebShoesApp)]:
+        p50, p99 = await benchApp(cls)
+        Log(f'{name:>8} {p50:>10.3f} {p99:>10.3f}')
+
+
+def main():
+    loadgen.run(run())
+
+if __name__ == '__main__':
+    main()
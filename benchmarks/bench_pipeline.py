@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Handler that waits on something, like a database or another service
+'''
+async def cmdWait(ctx, q):
+    await asyncio.sleep(0.01)
+    return {'status': 'ok'}
+
+def cmdHeartbeat(ctx, q):
+    return {'status': 'ok'}
+
+
+''' Send a burst of commands without waiting for replies
+    @param [in] opts    - Server options
+    @param [in] count   - Number of commands
+    @param [in] fn      - Command to send
+
+    Returns the seconds until the last reply arrived.
+'''
+async def benchPipeline(opts, count=200, fn='wait'):
+
+    wsa = ws.WebShoesApp(loadgen.host, loadgen.port, dict(opts, verbose=False))
+    wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {
+            'wait': cmdWait,
+            'heartbeat': cmdHeartbeat
+        }, 'inline')
+
+    async with loadgen.serving(wsa, '/cmd/heartbeat') as session:
+        c = await loadgen.WsClient.connect(session)
+        try:
+            t = time.perf_counter()
+            await asyncio.gather(*[c.call({'cmd': fn}) for i in range(count)])
+            t = time.perf_counter() - t
+        finally:
+            await c.close()
+
+    return t
+
+
+async def run():
+    Log(f'200 pipelined commands on one connection')
+    Log(f'{"":>12} {"10ms cmd s":>12} {"no-op cmd s":>12}')
+    for name, opts in [('before', {'wsinflight': 1}), ('after', {})]:
+        tw = await benchPipeline(opts)
+        tn = await benchPipeline(opts, fn='heartbeat')
+        Log(f'{name:>12} {tw:>12.3f} {tn:>12.3f}')
+
+
+def main():
+    loadgen.run(run())
+
+if __name__ == '__main__':
+    main()
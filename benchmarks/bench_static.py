@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os
+import mimetypes
+from aiohttp import web
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Server using the original folder handler, which checks the disk
+    and streams the file on every request
+'''
+class LegacyApp(ws.WebShoesApp):
+
+    @staticmethod
+    async def serveFolder(ctx, q, **route):
+        p = ctx.req.path.split('/')
+        while len(p) and not p[0]:
+            p = p[1:]
+        h, fn = ctx.wsa.findRoute(p, ctx.wsa.handlers)
+        root = h['fm'][fn].get('root')
+        if not root or not os.path.isdir(root):
+            return web.Response(text='Not Found', status=404)
+        p = os.path.join(root, '/'.join(p[1:]))
+        if not os.path.isfile(p):
+            return web.Response(text='Not Found', status=404)
+        mime = mimetypes.guess_type(p)[0] or 'text/plain'
+        return web.FileResponse(p, headers={"Content-Type":mime})
+
+
+''' Measure static file requests per second
+    @param [in] cls         - WebShoesApp class to benchmark
+    @param [in] revalidate  - Send the validators from the first reply, like
+                              a browser with the file already cached
+    @param [in] secs        - Seconds to measure for
+'''
+async def benchStatic(cls, revalidate=False, secs=3):
+    wsa = cls(loadgen.host, loadgen.port, {'verbose': False})
+    wsa.register('web', '', '', '', '', {
+            '*': {'root': ws.libPath('web')}
+        })
+    url = loadgen.url('/web/webshoes.js')
+    async with loadgen.serving(wsa, '/web/webshoes.js') as session:
+        headers = {}
+        if revalidate:
+            etag = (await loadgen.waitHttp(session, url)).get('ETag')
+            headers = {'If-None-Match': etag} if etag else {}
+        r = await loadgen.httpLoad(session, url, secs=secs, headers=headers)
+    return r['rate'], r['size']
+
+
+async def run():
+    Log(f'{"":>20} {"req/s":>10} {"wire bytes/req":>15}')
+    for name, cls, rv in [('before', LegacyApp, False),
+                          ('after', ws.WebShoesApp, False),
+                          ('after, revalidate', ws.WebShoesApp, True)]:
+        rate, size = await benchStatic(cls, rv)
+        Log(f'{name:>20} {rate:>10.1f} {size:>15.0f}')
+
+
+def main():
+    loadgen.run(run())
+
+if __name__ == '__main__':
+    main()
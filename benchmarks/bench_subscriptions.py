@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import time
+import tracemalloc
+import propertybag as pb
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' Server using the original registry, nested dicts in a property bag
+    and a uid removal that scans every event
+'''
+class LegacyApp(ws.WebShoesApp):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.evh = pb.Bag()
+
+    async def addEventHanlder(self, ev, uid, conn):
+        if ev not in self.evh:
+            self.evh[ev] = {'evt': ev, 'cb':{}, 'ver': 0}
+        if uid not in self.evh[ev]['cb']:
+            self.evh[ev]['cb'][uid] = {'uid': uid, 'ws': conn, 'ver': 0, 'last': {}}
+        else:
+            self.evh[ev]['cb'][uid]['ver'] = 0
+
+    def removeUid(self, uid, conn=None):
+        for k,v in self.evh.items():
+            if uid in v['cb']:
+                del v['cb'][uid]
+
+
+''' Subscribe every connection to a spread of events, then disconnect them all
+    @param [in] cls     - WebShoesApp class to benchmark
+    @param [in] events  - Number of distinct events
+    @param [in] conns   - Number of connections
+    @param [in] per     - Subscriptions per connection
+'''
+async def benchSubscriptions(cls, events=10000, conns=1000, per=100):
+
+    wsa = cls('127.0.0.1', 0, {})
+    conn = loadgen.NullConn()
+
+    # Names are created up front so only the registry is measured
+    evts = [f'evt-{i}' for i in range(events)]
+    uids = [f'uid-{c}' for c in range(conns)]
+
+    tracemalloc.start()
+    m = tracemalloc.get_traced_memory()[0]
+    t = time.perf_counter()
+    for c in range(conns):
+        for i in range(per):
+            await wsa.addEventHanlder(evts[(c * per + i) % events], uids[c], conn)
+    tadd = time.perf_counter() - t
+    m = tracemalloc.get_traced_memory()[0] - m
+    tracemalloc.stop()
+
+    t = time.perf_counter()
+    for c in range(conns):
+        wsa.removeUid(uids[c])
+    tdel = time.perf_counter() - t
+
+    return tadd, tdel, m / (conns * per)
+
+
+async def run():
+    Log(f'100k subscriptions, 10k events, 1k connections')
+    Log(f'{"":>8} {"add s":>10} {"disconnect s":>14} {"bytes/sub":>10}')
+    for name, cls in [('before', LegacyApp), ('after', ws.WebShoesApp)]:
+        tadd, tdel, mem = await benchSubscriptions(cls)
+        Log(f'{name:>8} {tadd:>10.3f} {tdel:>14.3f} {mem:>10.0f}')
+
+
+def main():
+    loadgen.run(run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+''' Benchmark suite
+
+    Drives a local WebShoesApp over loopback and measures
+
+        http        - Command requests per second and latency
+        ws          - Websocket command round trips, pipelined on a few connections
+        static      - serveFolder() requests per second and bytes per second
+        fanout_N    - Time from triggerEvent() until N subscribers have the event
+
+    Results are written as json, and can be checked against an earlier run
+
+        $ python3 benchmarks/bench_suite.py --out base.json
+        $ python3 benchmarks/bench_suite.py --compare base.json --threshold 0.15
+
+    The exit code is 1 if any rate dropped, or p50 / p99 latency rose,
+    by more than the threshold.  Client and server share the machine,
+    so compare runs from the same machine, and keep it otherwise idle.
+'''
+
+import argparse
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+def cmdHeartbeat(ctx, q):
+    return {'status': 'ok'}
+
+
+''' Returns a server for a benchmark
+'''
+def createServer():
+    wsa = ws.WebShoesApp(loadgen.host, loadgen.port, {'verbose': False})
+    wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {
+            'heartbeat': cmdHeartbeat
+        }, 'inline')
+    wsa.register('web', '', '', '', '', {
+            '*': {'root': ws.libPath('web')}
+        })
+    return wsa
+
+
+async def benchHttp(session, secs):
+    return await loadgen.httpLoad(session, loadgen.url('/cmd/heartbeat'), secs=secs)
+
+
+async def benchWs(session, secs):
+    return await loadgen.wsLoad(session, {'cmd': 'heartbeat'}, secs=secs)
+
+
+async def benchStatic(session, secs):
+    return await loadgen.httpLoad(session, loadgen.url('/web/webshoes.js'), secs=secs)
+
+
+async def run(args):
+
+    only = set(args.only.split(',')) if args.only else None
+    want = lambda name: not only or name in only
+
+    res = {'env': loadgen.environment(), 'params': vars(args), 'results': {}}
+    show = lambda name, r: Log(f'{name:>14} {r.get("rate", 0):>12.1f} {r["p50"]:>10.3f} '
+                               f'{r["p99"]:>10.3f} {r.get("mbps", ""):>10}')
+
+    Log(f'{"":>14} {"rate /s":>12} {"p50 ms":>10} {"p99 ms":>10} {"MB/s":>10}')
+    for name, fn in [('http', benchHttp), ('ws', benchWs), ('static', benchStatic)]:
+        if not want(name):
+            continue
+        async with loadgen.serving(createServer(), '/cmd/heartbeat') as session:
+            r = res['results'][name] = await fn(session, args.secs)
+        show(name, r)
+
+    if want('fanout'):
+        wsa = createServer()
+        async with loadgen.serving(wsa, '/cmd/heartbeat') as session:
+            for n in [int(v) for v in args.subs.split(',')]:
+                r = await loadgen.fanoutLoad(wsa, session, n, max(5, min(args.reps, 20000 // n)))
+                res['results'][f'fanout_{n}'] = r
+                show(f'fanout_{n}', r)
+
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(description='webshoes benchmark suite')
+    ap.add_argument('--secs', type=float, default=3, help='Seconds to measure each benchmark for')
+    ap.add_argument('--only', default='', help='Comma separated list of http, ws, static, fanout')
+    ap.add_argument('--subs', default='1,10,100,1000,10000', help='Subscriber counts for fanout')
+    ap.add_argument('--reps', type=int, default=50, help='Events to time for each fanout')
+    ap.add_argument('--out', default='', help='Write the results to this json file')
+    ap.add_argument('--compare', default='', help='Json file from an earlier run to check against')
+    ap.add_argument('--threshold', type=float, default=0.1, help='Fraction a metric may get worse by')
+    args = ap.parse_args()
+
+    res = loadgen.run(run(args))
+
+    if args.out:
+        loadgen.save(res, args.out)
+        Log(f'Wrote {args.out}')
+
+    if args.compare:
+        bad = loadgen.compare(loadgen.load(args.compare), res, args.threshold)
+        for name, k, b, c, change in bad:
+            Log(f'REGRESSION {name}.{k}: {b} -> {c} ({change*100:+.1f}%)')
+        if bad:
+            return 1
+        Log(f'No regressions over {args.threshold*100:.0f}%')
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import os
+import asyncio
+import multiprocessing
+import aiohttp
+import webshoes as ws
+
+import loadgen
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+def cmdAdd(ctx, q):
+    return {'result': int(q.a) + int(q.b)}
+
+
+''' Client process, sends requests until the time is up
+    @param [in] secs    - Seconds to run for
+    @param [in] conc    - Number of concurrent requests
+    @param [in] res     - multiprocessing.Value to add the count to
+'''
+def clientProc(secs, conc, res):
+
+    async def run():
+        # New connections, so they spread over the workers
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(force_close=True)) as session:
+            r = await loadgen.httpLoad(session, loadgen.url('/cmd/add?a=2&b=3'), conc, secs, warmup=0)
+        return r['count']
+
+    n = loadgen.run(run())
+    with res.get_lock():
+        res.value += n
+
+
+''' Measure http requests per second for a number of workers
+    @param [in] workers - Number of worker processes, 1 for none
+    @param [in] clients - Number of client processes
+    @param [in] secs    - Seconds to run for
+'''
+async def benchWorkers(workers, clients, secs=3, conc=16):
+
+    wsa = ws.WebShoesApp(loadgen.host, loadgen.port, {'verbose': False, 'workers': workers})
+    wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {'add': cmdAdd}, 'inline', wrap='light')
+
+    async with loadgen.serving(wsa, '/cmd/add?a=2&b=3'):
+        res = multiprocessing.Value('l', 0)
+        ps = [multiprocessing.Process(target=clientProc, args=(secs, conc, res)) for i in range(clients)]
+        for p in ps:
+            p.start()
+        for p in ps:
+            await asyncio.get_running_loop().run_in_executor(None, p.join)
+
+    return res.value / secs
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    clients = max(2, cpus // 2)
+    Log(f'{cpus} cpus, {clients} client processes')
+    Log(f'{"workers":>8} {"req/s":>10} {"scale":>8}')
+    base = None
+    for n in sorted({1, 2, 4, max(1, cpus // 2)}):
+        rate = loadgen.run(benchWorkers(n, clients))
+        base = base or rate
+        Log(f'{n:>8} {rate:>10.1f} {rate/base:>7.2f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+
+''' Shared benchmark code
+
+    The server, clients and timing loops the benchmarks have in common,
+    so every script, and bench_suite.py, measures a scenario the same
+    way.  Clients run on one asyncio loop and drive a local WebShoesApp
+    over loopback.
+'''
+
+import os
+import json
+import time
+import asyncio
+import platform
+import contextlib
+import aiohttp
+import webshoes as ws
+
+# Where the benchmark servers listen, one at a time
+host = '127.0.0.1'
+port = 15401
+
+
+''' Returns a url on the benchmark server
+    @param [in] path    - Path, i.e. '/cmd/heartbeat'
+'''
+def url(path=''):
+    return f'http://{host}:{port}{path}'
+
+
+''' Stand in for a connection, so only the server side cost is measured
+'''
+class NullConn():
+
+    batch = False
+    delta = False
+    codec = None
+
+    def __init__(self):
+        self.uids = set()
+        self.bytes = 0
+
+    def push(self, key, msg, full=None):
+        self.bytes += len(msg)
+        return True
+
+    async def send_str(self, s):
+        self.bytes += len(s)
+
+
+''' Returns the value below which a fraction of the sorted values fall
+    @param [in] v   - Sorted list of values
+    @param [in] q   - Fraction, i.e. 0.99
+'''
+def quantile(v, q):
+    if not v:
+        return 0
+    return v[min(len(v) - 1, int(q * len(v)))]
+
+
+''' Returns a summary of latencies, in milliseconds
+    @param [in] lat     - Latencies in seconds
+'''
+def summary(lat):
+    lat = sorted(lat)
+    ms = lambda v: round(v * 1000, 4)
+    return {'count': len(lat),
+            'mean': ms(sum(lat) / len(lat)) if lat else 0,
+            'p50': ms(quantile(lat, 0.5)),
+            'p90': ms(quantile(lat, 0.9)),
+            'p99': ms(quantile(lat, 0.99)),
+            'max': ms(lat[-1]) if lat else 0}
+
+
+''' Calls fn() from concurrent clients for a while, returns the rate and latencies
+    @param [in] fn      - Coroutine function to call, it is passed the client index
+    @param [in] conc    - Number of concurrent clients
+    @param [in] secs    - Seconds to measure for
+    @param [in] warmup  - Seconds to run first without measuring
+
+    Calls that raise are counted as errors and not timed.
+'''
+async def runLoad(fn, conc=32, secs=3, warmup=0.5):
+
+    lat = []
+    errors = 0
+    measure = False
+    end = time.perf_counter() + warmup
+
+    async def client(i):
+        nonlocal errors
+        while time.perf_counter() < end:
+            t = time.perf_counter()
+            try:
+                await fn(i)
+            except Exception:
+                if measure:
+                    errors += 1
+                continue
+            if measure:
+                lat.append(time.perf_counter() - t)
+
+    if warmup:
+        await asyncio.gather(*[client(i) for i in range(conc)])
+
+    measure = True
+    t = time.perf_counter()
+    end = t + secs
+    await asyncio.gather(*[client(i) for i in range(conc)])
+    t = time.perf_counter() - t
+
+    return dict(summary(lat), rate=round(len(lat) / t, 1), errors=errors)
+
+
+''' Returns the seconds per call of fn(), called one after the other
+    @param [in] fn      - Coroutine function to call, it is passed the call index
+    @param [in] count   - Number of calls to time
+    @param [in] warmup  - Number of calls to make first without timing
+'''
+async def perCall(fn, count, warmup=0):
+    for i in range(warmup):
+        await fn(i)
+    t = time.perf_counter()
+    for i in range(count):
+        await fn(i)
+    return (time.perf_counter() - t) / count
+
+
+''' Returns calls per second of a plain function, called in batches of 100
+    @param [in] fn      - Function to call, with no arguments
+    @param [in] secs    - Approximate seconds to spend
+'''
+def callRate(fn, secs=0.2):
+    n = 0
+    t = time.perf_counter()
+    while time.perf_counter() - t < secs:
+        for i in range(100):
+            fn()
+        n += 100
+    return n / (time.perf_counter() - t)
+
+
+''' Waits for a server to answer http, returns the first reply's headers
+    @param [in] session - aiohttp.ClientSession
+    @param [in] u       - Url to request
+    @param [in] to      - Seconds to wait
+    @param [in] headers - Request headers
+'''
+async def waitHttp(session, u, to=10, headers=None):
+    end = time.perf_counter() + to
+    while True:
+        try:
+            async with session.get(u, headers=headers) as r:
+                await r.read()
+                return r.headers
+        except Exception:
+            if time.perf_counter() > end:
+                raise Exception(f'Server did not start: {u}')
+            await asyncio.sleep(0.05)
+
+
+''' Starts a server, and stops it when done, yields a client session
+    @param [in] wsa     - WebShoesApp, with its handlers registered
+    @param [in] path    - Path that answers http once the server is up
+    @param [in] session - Session to use, a new one if None
+'''
+@contextlib.asynccontextmanager
+async def serving(wsa, path='/', session=None):
+    wsa.start()
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            if not session:
+                session = await stack.enter_async_context(aiohttp.ClientSession())
+            await waitHttp(session, url(path))
+            yield session
+    finally:
+        wsa.stop()
+
+
+''' class WsClient
+
+    Websocket connection that matches replies to commands by tid and
+    passes events to a callback
+
+'''
+class WsClient():
+
+    ''' Constructor
+        @param [in] wsc     - aiohttp websocket
+        @param [in] onEvent - Called with each event message
+    '''
+    def __init__(self, wsc, onEvent=None):
+        self.wsc = wsc
+        self.onEvent = onEvent
+        self.tid = 0
+        self.waiting = {}
+        self.task = asyncio.ensure_future(self.read())
+
+    ''' Connects to the benchmark server
+        @param [in] session - aiohttp.ClientSession
+        @param [in] onEvent - Called with each event message
+    '''
+    @classmethod
+    async def connect(cls, session, onEvent=None):
+        return cls(await session.ws_connect(url()), onEvent)
+
+    async def read(self):
+        async for m in self.wsc:
+            if aiohttp.WSMsgType.TEXT != m.type:
+                continue
+            j = json.loads(m.data)
+            if 'evt' in j and 'tid' not in j:
+                if self.onEvent:
+                    self.onEvent(j)
+                continue
+            f = self.waiting.pop(j.get('tid'), None)
+            if f and not f.done():
+                f.set_result(j)
+
+        # Closed, fail anything still waiting
+        for f in self.waiting.values():
+            if not f.done():
+                f.set_exception(ConnectionError('Websocket closed'))
+        self.waiting = {}
+
+    ''' Sends a message and returns the reply
+        @param [in] msg     - Message, a tid is added
+    '''
+    async def call(self, msg):
+        self.tid += 1
+        tid = str(self.tid)
+        f = self.waiting[tid] = asyncio.get_running_loop().create_future()
+        await self.wsc.send_str(json.dumps(dict(msg, tid=tid)))
+        return await f
+
+    async def close(self):
+        await self.wsc.close()
+        await self.task
+
+
+''' Http GET requests from concurrent clients, see runLoad()
+    @param [in] session - aiohttp.ClientSession
+    @param [in] u       - Url to request
+    @param [in] conc    - Number of concurrent requests
+    @param [in] secs    - Seconds to measure for
+    @param [in] headers - Request headers
+    @param [in] warmup  - Seconds to run first without measuring
+
+    Also returns the average bytes on the wire per reply, and MB/s.
+'''
+async def httpLoad(session, u, conc=32, secs=3, headers=None, warmup=0.5):
+    size = 0
+    n = 0
+
+    async def call(i):
+        nonlocal size, n
+        async with session.get(u, headers=headers) as r:
+            await r.read()
+            if r.status not in (200, 304):
+                raise Exception(f'Status {r.status}')
+            size += int(r.headers.get('Content-Length', 0))
+            n += 1
+
+    r = await runLoad(call, conc, secs, warmup)
+    per = size / n if n else 0
+    return dict(r, size=round(per), mbps=round(r['rate'] * per / 1e6, 3))
+
+
+''' Websocket command round trips, pipelined on a few connections, see runLoad()
+    @param [in] session - aiohttp.ClientSession
+    @param [in] msg     - Command message
+    @param [in] conns   - Number of connections
+    @param [in] depth   - Commands in flight on each connection
+    @param [in] secs    - Seconds to measure for
+'''
+async def wsLoad(session, msg, conns=4, depth=8, secs=3):
+    cs = [await WsClient.connect(session) for i in range(conns)]
+    try:
+        async def call(i):
+            r = await cs[i % conns].call(msg)
+            if 'error' in r:
+                raise Exception(r['error'])
+
+        return await runLoad(call, conns * depth, secs)
+    finally:
+        for c in cs:
+            await c.close()
+
+
+''' Event fan-out, from triggerEvent() until every subscriber has it
+    @param [in] wsa     - The server
+    @param [in] session - aiohttp.ClientSession
+    @param [in] subs    - Number of subscribers
+    @param [in] reps    - Number of events to time
+    @param [in] conns   - Most connections to spread the subscribers over
+
+    Returns the time until the last subscriber had each event, along
+    with the time until each subscriber had it in sub_p50 / sub_p99.
+'''
+async def fanoutLoad(wsa, session, subs, reps=20, conns=100):
+
+    ev = f'bench{subs}'
+    conns = min(subs, conns)
+    data = {'v': 100 * 'x'}
+
+    state = {'start': 0, 'left': 0, 'arrived': [], 'done': None}
+    def onEvent(j):
+        if ev != j.get('evt'):
+            return
+        state['arrived'].append(time.perf_counter() - state['start'])
+        state['left'] -= 1
+        if 0 >= state['left'] and not state['done'].done():
+            state['done'].set_result(True)
+
+    cs = [await WsClient.connect(session, onEvent) for i in range(conns)]
+    try:
+        # Subscribe, pipelined on each connection
+        await asyncio.gather(*[cs[i % conns].call({'evt': ev, 'uid': f'u{i}'}) for i in range(subs)])
+
+        loop = asyncio.get_running_loop()
+        done = []
+        arrived = []
+        for i in range(reps + 1):
+            state['left'] = subs
+            state['arrived'] = []
+            state['done'] = loop.create_future()
+            state['start'] = time.perf_counter()
+            wsa.triggerEvent(ev, dict(data, n=i))
+            await asyncio.wait_for(state['done'], 60)
+
+            # The first one is a warm up
+            if i:
+                done.append(time.perf_counter() - state['start'])
+                arrived += state['arrived']
+    finally:
+        for c in cs:
+            await c.close()
+
+    total = sum(done)
+    s = summary(arrived)
+    return dict(summary(done), subs=subs, sub_p50=s['p50'], sub_p99=s['p99'],
+                rate=round(subs * reps / total, 1) if total else 0)
+
+
+''' Runs a coroutine on a new event loop, for the scripts' main()
+    @param [in] coro    - Coroutine
+'''
+def run(coro):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop.run_until_complete(coro)
+
+
+''' Describes where the benchmarks ran, so runs can be compared fairly
+'''
+def environment():
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'webshoes': getattr(ws, '__version__', ''),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'jsoncodec': ws.codec.getJsonCodec().name}
+
+
+''' Returns (name, metric, baseline, current, change) for each metric that got worse
+    @param [in] base        - Results from an earlier run
+    @param [in] cur         - Results from this run
+    @param [in] threshold   - Fraction a metric may get worse by, i.e. 0.1
+
+    Rates are better higher, latencies better lower.  Only benchmarks
+    in both runs are compared.
+'''
+def compare(base, cur, threshold=0.1):
+
+    # 1 for higher is better, -1 for lower is better
+    checks = {'rate': 1, 'mbps': 1, 'p50': -1, 'p99': -1}
+
+    r = []
+    for name, b in base.get('results', {}).items():
+        c = cur.get('results', {}).get(name)
+        if not c:
+            continue
+        for k, sign in checks.items():
+            if not b.get(k) or k not in c:
+                continue
+            change = (c[k] - b[k]) / b[k]
+            if threshold < -sign * change:
+                r.append((name, k, b[k], c[k], change))
+    return r
+
+
+''' Reads results written by save()
+    @param [in] path    - File name
+'''
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+''' Writes results as json
+    @param [in] res     - Results
+    @param [in] path    - File name
+'''
+def save(res, path):
+    with open(path, 'w') as f:
+        json.dump(res, f, indent=2, sort_keys=True)
+        f.write('\n')
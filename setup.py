@@ -43,6 +43,11 @@ setup(
             'propertybag',
             'sparen'
         ],
+    extras_require={
+            'fast': ['orjson'],
+            'msgpack': ['msgpack'],
+            'cbor': ['cbor2']
+        },
     dependency_links=[
         ]
 )
@@ -75,7 +75,7 @@ async def run():
             'heartbeat': lambda ctx, q: {'iid': ctx.opts.iid, 'info': webshoes.__info__},
             'getMatrix': getMatrix,
             'incMatrix': incMatrix
-        })
+        }, cache={'getMatrix': {'events': 'matrixUpdate'}})
 
     wsa.start()
 
@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
+import os
 import json
+import time
 import requests
 import urllib
+import pstats
 import asyncio
+import tempfile
+import traceback
+import threading
+import multiprocessing
 import websockets
 import webshoes as ws
+import webshoes.precompress
 
 try:
     import sparen
@@ -33,6 +41,17 @@ def getReq(cmd, opts):
     return json.loads(r.text)
 
 
+def waitServer(to=10):
+    t = time.time()
+    while time.time() - t < to:
+        try:
+            requests.get(f'http://{host}:{port}')
+            return True
+        except Exception:
+            time.sleep(0.05)
+    return False
+
+
 def cmdHeartbeat(ctx, q):
     return {'status': 'ok'}
 
@@ -42,16 +61,157 @@ def cmdAdd(ctx, q):
 def cmdAll(ctx, q):
     return {'p': ctx.p, 'q': q.as_dict()}
 
+def cmdRaw(ctx, q):
+    return {'result': q['a'] + q['b']['c'], 'p': ctx.p}
+
+async def cmdSlow(ctx, q):
+    await asyncio.sleep(0.3)
+    return {'status': 'ok'}
+
+def cmdBig(ctx, q):
+    return {'v': list(range(2000))}
+
+def cmdRows(ctx, q):
+    for i in range(int(q.n)):
+        yield {'i': i}
+
+async def cmdRowsAsync(ctx, q):
+    for i in range(int(q.n)):
+        await asyncio.sleep(0)
+        yield {'i': i}
+
+count = 0
+def cmdCount(ctx, q):
+    global count
+    count += 1
+    return {'count': count}
+
+def cmdWho(ctx, q):
+    return {'pid': os.getpid(), 'tid': threading.get_ident()}
+
 async def test_1():
 
     # Setup server
-    wsa = ws.WebShoesApp(host, port, {'verbose': True})
+    wsa = ws.WebShoesApp(host, port, {'verbose': True, 'wsziplevel': 6, 'wszipbits': 12})
     wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {
             'heartbeat': cmdHeartbeat,
+            'add': cmdAdd,
+            'big': cmdBig,
+            'rows': cmdRows,
+            'arows': cmdRowsAsync,
+            '*': cmdAll
+        })
+    wsa.register('who', 'who', 'q', '', 'r', {
+            'inline': cmdWho,
+            'thread': cmdWho,
+            'process': cmdWho
+        }, {'inline': 'inline', 'process': 'process'})
+    wsa.register('seq', 'seq', 'q', '', 'r', {
+            'slow': cmdSlow,
+            'fast': cmdHeartbeat
+        }, ordered=True)
+    wsa.register('lite', 'lite', 'q', '', 'r', {
             'add': cmdAdd,
             '*': cmdAll
+        }, 'inline', wrap='light')
+    wsa.register('web', '', '', '', '', {
+            '*': {'root': ws.libPath('web'), 'cache': 'max-age=60'}
+        })
+    tmp = tempfile.TemporaryDirectory()
+    with open(os.path.join(tmp.name, 'data.json'), 'w') as f:
+        f.write(json.dumps({'v': list(range(1000))}))
+    ws.precompress.precompress(tmp.name)
+    assert not ws.precompress.isCompressible(os.path.join(tmp.name, 'data.json.gz'))
+    with open(os.path.join(tmp.name, 'big.txt'), 'w') as f:
+        f.write(100000 * 'big ')
+    wsa.register('tmp', '', '', '', '', {
+            '*': {'root': tmp.name}
+        })
+    wsa.register('rawtmp', '', '', '', '', {
+            '*': {'root': tmp.name, 'cache': 'no-cache'}
+        }, wrap='raw')
+    wsa.register('raw', 'raw', 'q', '', 'r', {
+            'add': cmdRaw
+        }, 'inline', wrap='raw')
+    wsa.register('memo', 'memo', 'q', '', 'r', {
+            'count': cmdCount,
+            'rows': cmdRowsAsync
+        }, cache={'events': 'memoReset'})
+    wsa.register('metrics', '', '', '', '', {
+            'json': ws.metricsJson,
+            'prometheus': ws.metricsPrometheus
         })
     wsa.start()
+    assert waitServer()
+
+    # Static files, then again with the validators
+    r = requests.get(f'http://{host}:{port}/web/webshoes.js')
+    assert 200 == r.status_code and 'WebShoes' in r.text and 'max-age=60' == r.headers['Cache-Control']
+    assert 304 == requests.get(f'http://{host}:{port}/web/webshoes.js',
+                               headers={'If-None-Match': r.headers['ETag']}).status_code
+    assert 304 == requests.get(f'http://{host}:{port}/web/webshoes.js',
+                               headers={'If-Modified-Since': r.headers['Last-Modified']}).status_code
+    assert 404 == requests.get(f'http://{host}:{port}/web/nothing.js').status_code
+
+    # Compressed on the fly, or from a precompressed sibling
+    assert 'gzip' == r.headers['Content-Encoding'] and r.headers['ETag'].endswith('-gz"')
+    r = requests.get(f'http://{host}:{port}/tmp/data.json')
+    assert 'gzip' == r.headers['Content-Encoding'] and not r.headers['ETag'].endswith('-gz"')
+    assert 999 == r.json()['v'][-1]
+    r = requests.get(f'http://{host}:{port}/tmp/data.json', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in r.headers and 999 == r.json()['v'][-1]
+    r = requests.get(f'http://{host}:{port}/rawtmp/data.json')
+    assert 999 == r.json()['v'][-1] and 'no-cache' == r.headers['Cache-Control']
+    r = requests.get(f'http://{host}:{port}/tmp/big.txt')
+    assert 'gzip' == r.headers['Content-Encoding'] and 400000 == len(r.text)
+
+    # Large json replies are compressed
+    r = requests.get(f'http://{host}:{port}/cmd/big')
+    assert 'gzip' == r.headers['Content-Encoding'] and 1999 == r.json()['v'][-1]
+    r = requests.get(f'http://{host}:{port}/cmd/big', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in r.headers and 1999 == r.json()['v'][-1]
+    assert 'Content-Encoding' not in requests.get(f'http://{host}:{port}/cmd/heartbeat').headers
+
+    # Streams, one json value per line
+    r = requests.get(f'http://{host}:{port}/cmd/rows?n=1000')
+    assert 'application/x-ndjson' == r.headers['Content-Type']
+    assert list(range(1000)) == [json.loads(v)['i'] for v in r.text.splitlines()]
+    r = requests.get(f'http://{host}:{port}/cmd/arows?n=3')
+    assert [0, 1, 2] == [json.loads(v)['i'] for v in r.text.splitlines()]
+
+    # Cached results, until cleared
+    n = getReq('memo/count', {'a': 1, 'b': 2})['count']
+    assert n == getReq('memo/count', {'b': 2, 'a': 1})['count']
+    assert n != getReq('memo/count', {'a': 2})['count']
+    wsa.triggerEvent('memoReset', {}).result(5)
+    assert n != getReq('memo/count', {'a': 1, 'b': 2})['count']
+    n = getReq('memo/count', {'a': 1, 'b': 2})['count']
+    wsa.invalidateCache('memo')
+    assert n != getReq('memo/count', {'a': 1, 'b': 2})['count']
+
+    # Dispatch hooks
+    slow = ws.SlowCallHook(0.2, log=False)
+    prof = ws.ProfileHook(1)
+    wsa.addHook(slow)
+    wsa.addHook(prof)
+    assert getReq('cmd/add', {'a': 1, 'b': 2})['result'] == 3
+    assert getReq('seq/slow', {})['status'] == 'ok'
+    wsa.removeHook(slow)
+    wsa.removeHook(prof)
+    assert 1 == len(slow.calls) and 'seq/slow' == slow.calls[0]['cmd']
+    with tempfile.TemporaryDirectory() as d:
+        assert prof.dump(os.path.join(d, 'prof.pstats'))
+        names = {k[2] for k in pstats.Stats(os.path.join(d, 'prof.pstats')).stats}
+        assert 'cmdAdd' in names and 'cmdSlow' in names
+
+    # Lightweight handler arguments
+    assert getReq('lite/add', {'a': 3, 'b': 4})['result'] == 7
+    assert getReq('lite/catchall', {'a': 3})['q']['a'] == "3"
+
+    # Handler run policies
+    inline = getReq('who/inline', {})
+    assert getReq('who/thread', {})['tid'] != inline['tid']
+    assert getReq('who/process', {})['pid'] != inline['pid']
 
     # Test http functions
     assert getReq('cmd/heartbeat', {})['status'] == 'ok'
@@ -83,19 +243,464 @@ async def test_1():
             await wcon.send(json.dumps({'cmd': 'catchall', 'q':{'a':3, 'b':4}}))
             assert (await wsRes(wcon))['r']['p'] == 'catchall'
 
+            await wcon.send(json.dumps({'cmd': '/cmd/add', 'q':{'a':1, 'b':2}}))
+            assert (await wsRes(wcon))['r']['result'] == 3
+
             await wcon.send(json.dumps({'evt': 'someEvent'}))
             assert 'uid' in (await wsRes(wcon))['r']
 
-            wsa.triggerEvent('someEvent', {'value': 42})
+            wsa.triggerEvent('someEvent', {'value': 42}).result(5)
             assert (await wsRes(wcon))['r']['value'] == 42
 
+            # Rate limited events skip to the latest version
+            wsa.setEventLimit('someEvent', interval=0.2)
+            for i in range(5):
+                wsa.triggerEvent('someEvent', {'value': i}).result(5)
+            assert (await wsRes(wcon))['r']['value'] == 0
+            assert (await wsRes(wcon))['r']['value'] == 4
+            wsa.setEventLimit('someEvent')
+
+        # Replies come back as commands finish, unless the group is ordered
+        async with websockets.connect(f'ws://{host}:{port}') as wcon:
+
+            wsa.register('slow', 'slow', 'q', '', 'r', {'slow': cmdSlow})
+            await wcon.send(json.dumps({'slow': 'slow', 'tid': 'a'}))
+            await wcon.send(json.dumps({'cmd': 'heartbeat', 'tid': 'b'}))
+            assert (await wsRes(wcon))['tid'] == 'b'
+            assert (await wsRes(wcon))['tid'] == 'a'
+            wsa.unregister('slow')
+
+            await wcon.send(json.dumps({'seq': 'seq/slow', 'tid': 'a'}))
+            await wcon.send(json.dumps({'seq': 'seq/fast', 'tid': 'b'}))
+            assert (await wsRes(wcon))['tid'] == 'a'
+            assert (await wsRes(wcon))['tid'] == 'b'
+
+            await wcon.send(json.dumps({'lite': 'lite/add', 'q': {'a': 1, 'b': 2}, 'tid': 'a'}))
+            assert (await wsRes(wcon))['r']['result'] == 3
+
+            # Streams, a frame per value then the end marker
+            await wcon.send(json.dumps({'cmd': 'arows', 'q': {'n': 3}, 'tid': 's'}))
+            for i in range(3):
+                j = await wsRes(wcon)
+                assert j['tid'] == 's' and j['r']['i'] == i
+            j = await wsRes(wcon)
+            assert j['tid'] == 's' and j['end']
+
+            # Identical commands share one call
+            for v in 'ab':
+                await wcon.send(json.dumps({'memo': 'memo/count', 'q': {'x': 1}, 'tid': v}))
+            assert (await wsRes(wcon))['r'] == (await wsRes(wcon))['r']
+
+            # Without q the message is the params, the tid isn't part of the key
+            rs = []
+            for v in 'cd':
+                await wcon.send(json.dumps({'memo': 'memo/count', 'x': 2, 'tid': v}))
+                rs.append((await wsRes(wcon))['r'])
+            assert rs[0] == rs[1]
+
+            # Streams aren't cached, each caller gets its own
+            await wcon.send(json.dumps([{'memo': 'memo/rows', 'q': {'n': 2}, 'tid': v} for v in 'ab']))
+            got = {'a': [], 'b': []}
+            while not all(got[v] and 'end' in got[v][-1] for v in got):
+                j = await wsRes(wcon)
+                for v in (j if isinstance(j, list) else [j]):
+                    assert 'error' not in v
+                    got[v['tid']].append(v)
+            assert all([v['r']['i'] for v in got[k][:-1]] == [0, 1] for k in got)
+
+            await wcon.send(json.dumps({'raw': 'raw/add', 'q': {'a': 1, 'b': {'c': 2}}, 'tid': 'a'}))
+            assert (await wsRes(wcon))['r'] == {'result': 3, 'p': 'raw/add'}
+
+            # Compressed with the level and window from opts
+            await wcon.send(json.dumps({'cmd': 'big', 'tid': 'a'}))
+            assert 1999 == (await wsRes(wcon))['r']['v'][-1]
+
+            # Several commands in one frame, replies in one frame
+            await wcon.send(json.dumps([{'cmd': 'add', 'q': {'a': 1, 'b': 2}, 'tid': 'a'},
+                                        {'cmd': 'heartbeat', 'tid': 'b'}]))
+            j = {v['tid']: v for v in await wsRes(wcon)}
+            assert j['a']['r']['result'] == 3 and j['b']['r']['status'] == 'ok'
+
+        # Binary frames, if there's a codec installed
+        for k, bc in ws.codec.getBinaryCodecs().items():
+            async with websockets.connect(f'ws://{host}:{port}', subprotocols=[k]) as wcon:
+                await wcon.send(bc.dumps({'cmd': 'add', 'q': {'a': 1, 'b': 2}, 'tid': 'a'}))
+                j = bc.loads(await wcon.recv())
+                assert j['tid'] == 'a' and j['r']['result'] == 3
+
+        # Events triggered together arrive in one frame
+        async with websockets.connect(f'ws://{host}:{port}/?evtbatch=1') as wcon:
+
+            await wcon.send(json.dumps({'evt': 'evtA'}))
+            assert 'uid' in (await wsRes(wcon))['r']
+
+            await wcon.send(json.dumps({'evt': 'evtB'}))
+            assert 'uid' in (await wsRes(wcon))['r']
+
+            wsa.triggerEvents({'evtA': {'value': 1}, 'evtB': {'value': 2}}).result(5)
+            j = await wsRes(wcon)
+            assert isinstance(j, list) and 2 == len(j)
+            assert j[1]['evt'] == 'evtB' and j[1]['r']['value'] == 2
+
+        # Delta events
+        async with websockets.connect(f'ws://{host}:{port}/?evtdelta=1') as wcon:
+
+            await wcon.send(json.dumps({'evt': 'evtD'}))
+            assert 'uid' in (await wsRes(wcon))['r']
+
+            m = 100 * '0'
+            wsa.triggerEvent('evtD', {'m': m, 'w': 10}).result(5)
+            j = await wsRes(wcon)
+            assert j['r']['m'] == m
+
+            wsa.triggerEvent('evtD', {'m': '1' + m[1:], 'w': 10}).result(5)
+            d = await wsRes(wcon)
+            assert 'r' not in d and d['base'] == j['ver']
+            assert ws.delta.patch(j['r'], d['d'])['m'] == '1' + m[1:]
+
+        # Resubscribe after a reconnect with the version we already have
+        async with websockets.connect(f'ws://{host}:{port}/?evtdelta=1') as wcon:
+
+            await wcon.send(json.dumps({'evt': 'evtD', 'uid': 'rsub', 'ver': d['ver']}))
+            iid = (await wsRes(wcon))['r']['iid']
+            j = await wsRes(wcon)
+            assert j['ver'] == d['ver'] and 'r' in j
+
+        async with websockets.connect(f'ws://{host}:{port}/?evtdelta=1') as wcon:
+
+            await wcon.send(json.dumps({'evt': 'evtD', 'uid': 'rsub', 'ver': j['ver'], 'iid': iid}))
+            assert 'uid' in (await wsRes(wcon))['r']
+            await wcon.send(json.dumps({'cmd': 'heartbeat', 'tid': 'hb'}))
+            assert 'hb' == (await wsRes(wcon))['tid']
+
+        # Missed an update while away, only the change comes back
+        wsa.triggerEvent('evtD', {'m': '2' + m[1:], 'w': 10}).result(5)
+        async with websockets.connect(f'ws://{host}:{port}/?evtdelta=1') as wcon:
+
+            await wcon.send(json.dumps({'evt': 'evtD', 'uid': 'rsub', 'ver': j['ver'], 'iid': iid}))
+            assert 'uid' in (await wsRes(wcon))['r']
+            d = await wsRes(wcon)
+            assert d['base'] == j['ver']
+            assert ws.delta.patch(j['r'], d['d'])['m'] == '2' + m[1:]
+
     except Exception as e:
         Log(e)
+        raise
+
+    # Metrics, an event nobody is subscribed to isn't counted as sent
+    wsa.triggerEvent('nobody', {}).result(5)
+    j = getReq('metrics/json', {})
+    assert not j['events'].get('nobody', {}).get('sends')
+    assert j['commands']['cmd/add']['count'] and j['static']['not_modified']
+    assert j['ws']['connectionsTotal'] and j['events']['evtD']['sends']
+    r = requests.get(f'http://{host}:{port}/metrics/prometheus')
+    assert r.headers['Content-Type'].startswith('text/plain')
+    assert 'webshoes_command_seconds_count{cmd="cmd/add"}' in r.text
+
+    # Unregister handlers
+    wsa.unregister('cmd')
+    assert 'error' in getReq('cmd/heartbeat', {})
 
     # Stop the server
     wsa.stop()
 
 
+''' Stand in for a redis server, just what the event bus uses
+'''
+class FakeRedis():
+
+    def __init__(self, port):
+        self.port = port
+        self.keys = {}
+        self.subs = {}
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result(5)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.client, host, self.port)
+
+    async def client(self, reader, writer):
+        try:
+            while True:
+                n = int((await reader.readline())[1:])
+                args = []
+                for i in range(n):
+                    k = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(k + 2))[:-2])
+                cmd = args[0].decode().upper()
+                if 'INCR' == cmd:
+                    v = self.keys[args[1]] = self.keys.get(args[1], 0) + 1
+                    writer.write(b':%d\r\n' % v)
+                elif 'PUBLISH' == cmd:
+                    subs = self.subs.get(args[1], [])
+                    for w in subs:
+                        w.write(b'*3\r\n$7\r\nmessage\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n'
+                                % (len(args[1]), args[1], len(args[2]), args[2]))
+                    writer.write(b':%d\r\n' % len(subs))
+                elif 'SUBSCRIBE' == cmd:
+                    self.subs.setdefault(args[1], []).append(writer)
+                    writer.write(b'*3\r\n$9\r\nsubscribe\r\n$%d\r\n%s\r\n:1\r\n' % (len(args[1]), args[1]))
+                else:
+                    writer.write(b'+OK\r\n')
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            for v in self.subs.values():
+                if writer in v:
+                    v.remove(writer)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+
+
+''' Stand in for the app, request and websocket behind a WsConn, sends
+    block until released
+'''
+class StallApp():
+
+    def __init__(self):
+        self.sent = []
+        self.removed = []
+        self.closed = False
+        self.go = asyncio.Event()
+        self.transport = None
+
+    async def sendMsg(self, ws, msg):
+        await self.go.wait()
+        self.sent.append(msg)
+        return True
+
+    def removeUid(self, uid, conn=None):
+        self.removed.append(uid)
+
+    async def close(self):
+        self.closed = True
+
+
+''' Returns the keys queued on a WsConn
+'''
+def queued(conn):
+    return [e[1][:2] for e in conn.queue]
+
+
+async def test_4():
+
+    # Past the high-water mark with a stalled reader, what each policy leaves queued
+    frame = lambda k: k.ljust(40)
+    for policy, left in [('coalesce', ['a1', 'b1', 'c0']),
+                         ('drop', ['c0', 'a1', 'b1'])]:
+        app = StallApp()
+        conn = ws.WsConn(app, app, app, hwm=100, policy=policy)
+        for k in ['a0', 'b0', 'c0', 'a1', 'b1']:
+            assert conn.push(k[0], frame(k))
+        assert left == queued(conn) and 120 == conn.size
+        app.go.set()
+        while conn.queue:
+            await asyncio.sleep(0.01)
+        assert left == [v[:2] for v in app.sent]
+        conn.close()
+
+    # Disconnect only once the writer is stuck on the socket
+    app = StallApp()
+    conn = ws.WsConn(app, app, app, hwm=100, policy='disconnect')
+    conn.uids.add('u1')
+    for k in ['a0', 'b0', 'c0', 'a1']:
+        assert conn.push(k[0], frame(k))
+    assert ['a1', 'b0', 'c0'] == queued(conn)
+    await asyncio.sleep(0.01)
+    assert conn.busy and conn.push('d', frame('d0'))
+    assert not conn.push('e', frame('e0'))
+    await asyncio.sleep(0.01)
+    assert conn.closed and app.closed and ['u1'] == app.removed
+    assert not conn.push('a', frame('a2'))
+
+    # A send that stalls past sendtimeout drops the connection
+    app = StallApp()
+    conn = ws.WsConn(app, app, app, to=0.05)
+    conn.uids.add('u1')
+    assert conn.push('a', frame('a0'))
+    await asyncio.sleep(0.2)
+    assert conn.closed and app.closed and ['u1'] == app.removed
+
+    # Batched events from a connection that isn't reading
+    wsa = ws.WebShoesApp(host, 0, {})
+    app = StallApp()
+    conn = ws.WsConn(app, app, app, hwm=200)
+    conn.batch = True
+    await wsa.addEventHanlder('a', 'u1', conn)
+    await wsa.addEventHanlder('b', 'u2', conn)
+    for i in range(100):
+        await wsa.triggerEventsSync({'a': {'i': i}, 'b': {'i': i}})
+
+    # Batches until the high-water mark, then one coalesced frame per subscription
+    assert 10 > len(conn.queue)
+    app.go.set()
+    while conn.queue:
+        await asyncio.sleep(0.01)
+    assert all(99 == json.loads(v)['r']['i'] for v in app.sent[-2:])
+    conn.close()
+
+    # Overlapping calls while profiling, one is profiled at a time and none fail
+    wsa.register('cmd', 'cmd', 'q', '', 'r', {'slow': cmdSlow, 'add': cmdAdd})
+    prof = ws.ProfileHook(0)
+    wsa.addHook(prof)
+    prof.window(10)
+    h = wsa.handlers['cmd']
+    rs = await asyncio.gather(*[wsa.callHandler(h, 'slow', cmdSlow, 'cmd/slow', None, {}) for i in range(3)],
+                              *[wsa.callHandler(h, 'add', cmdAdd, 'cmd/add', None, {'a': 1, 'b': i}) for i in range(3)])
+    assert 3 * [{'status': 'ok'}] == rs[:3] and [1, 2, 3] == [v['result'] for v in rs[3:]]
+    assert 1 <= prof.count < 6 and not prof.busy
+    wsa.removeHook(prof)
+
+    # A function name in two groups needs the group/function form
+    wsa.register('cmd2', 'cmd', 'q', '', 'r', {'add': cmdAdd}, 'inline')
+    r, e = await wsa.handleWsCmd(None, None, conn, {'cmd': 'add', 'q': {'a': 1, 'b': 2}}, {})
+    assert 'use group/add' in r['error']
+    for c in ['cmd/add', 'cmd2/add']:
+        r, e = await wsa.handleWsCmd(None, None, conn, {'cmd': c, 'q': {'a': 1, 'b': 2}}, {})
+        assert 3 == r['r']['result']
+    r, e = await wsa.handleWsCmd(None, None, conn, {'cmd': 'slow'}, {})
+    assert 'ok' == r['r']['status']
+    wsa.unregister('cmd2')
+
+    # A hook that fails doesn't fail the handler, or leave it counted in flight
+    class BadHook(ws.DispatchHook):
+        def pre(self, call):
+            raise Exception('bad hook')
+    bad = BadHook()
+    wsa.addHook(bad)
+    assert 5 == (await wsa.callHandler(h, 'add', cmdAdd, 'cmd/add', None, {'a': 2, 'b': 3}))['result']
+    assert 0 == h['stats']['add'].inflight
+    wsa.removeHook(bad)
+
+    # Every command in a batch takes a slot, so a batch can't get around wsinflight
+    class Sink():
+        sent = []
+        async def send_str(self, s):
+            self.sent.append(s)
+    sink = Sink()
+    slots = asyncio.Semaphore(2)
+    await slots.acquire()
+    t = time.perf_counter()
+    sconn = ws.WsConn(app, app, app)
+    await wsa.handleWsMsg(None, sink, sconn, json.dumps([{'cmd': 'slow', 'tid': i} for i in range(4)]), {}, slots)
+    sconn.close()
+    assert 0.55 < time.perf_counter() - t and 4 == len(json.loads(sink.sent[-1]))
+    slots.release()
+    for i in range(2):
+        await asyncio.wait_for(slots.acquire(), 0.1)
+
+    # Gzipped copies count against the file cache limit too
+    with tempfile.TemporaryDirectory() as d:
+        fc = ws.FileCache(4000, 4000, 1, 512)
+        for name, n in [('a.txt', 1000), ('b.txt', 100)]:
+            with open(os.path.join(d, name), 'w') as f:
+                f.write(' '.join(str(i * 7919 % 1000) for i in range(n))[:3 * n])
+        a = await fc.get(os.path.join(d, 'a.txt'))
+        await fc.get(os.path.join(d, 'b.txt'))
+        assert 3300 == fc.bytes
+        assert await fc.encoded(a, 'gzip')
+        assert fc.bytes <= 4000 and 1 == len(fc.entries)
+
+    # A call started before clear() isn't handed to callers that come after it
+    rc = ws.ResultCache()
+    calls = []
+    async def make():
+        calls.append(len(calls))
+        await asyncio.sleep(0.05)
+        return {'n': calls[-1]}
+    old = asyncio.ensure_future(rc.get('k', make))
+    await asyncio.sleep(0.01)
+    rc.clear()
+    assert {'n': 0} == await old and {'n': 1} == await rc.get('k', make)
+    assert {'n': 1} == await rc.get('k', make) and 2 == len(calls)
+
+
+async def test_2():
+
+    # Worker processes sharing the port
+    wport = port + 1
+    wsa = ws.WebShoesApp(host, wport, {'workers': 2})
+    wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {
+            'who': cmdWho
+        }, 'inline')
+    wsa.start()
+
+    try:
+        url = f'http://{host}:{wport}/cmd/who'
+        for i in range(200):
+            try:
+                requests.get(url)
+                break
+            except Exception:
+                time.sleep(0.05)
+
+        # Connect until more than one worker has answered
+        cons = []
+        pids = set()
+        while len(pids) < 2 or len(cons) < 4:
+            assert len(cons) < 100, f'Connections all went to {pids}'
+            c = await websockets.connect(f'ws://{host}:{wport}')
+            cons.append(c)
+            await c.send(json.dumps({'cmd': 'who'}))
+            pids.add(json.loads(await c.recv())['r']['pid'])
+            await c.send(json.dumps({'evt': 'wevt'}))
+            assert 'uid' in json.loads(await c.recv())['r']
+        Log(f'Worker pids: {pids}, {len(cons)} connections')
+        assert os.getpid() not in pids
+
+        # Every worker sees the event, with the same version
+        wsa.triggerEvent('wevt', {'value': 1}).result(5)
+        wsa.triggerEvent('wevt', {'value': 2}).result(5)
+        for c in cons:
+            j = json.loads(await asyncio.wait_for(c.recv(), 5))
+            assert 1 == j['ver'] and 1 == j['r']['value']
+            j = json.loads(await asyncio.wait_for(c.recv(), 5))
+            assert 2 == j['ver'] and 2 == j['r']['value']
+            await c.close()
+
+    finally:
+        wsa.stop()
+
+
+async def test_3():
+
+    # Two servers sharing events through redis
+    rport = port + 2
+    redis = FakeRedis(rport)
+    nodes = []
+    for i in range(2):
+        wsa = ws.WebShoesApp(host, port + 3 + i, {'eventbus': f'redis://{host}:{rport}/0?channel=test'})
+        wsa.register('cmd', 'cmd', 'q', 'evt', 'r', {'heartbeat': cmdHeartbeat})
+        wsa.start()
+        nodes.append(wsa)
+
+    try:
+        for i in range(200):
+            try:
+                requests.get(f'http://{host}:{port + 4}/cmd/heartbeat')
+                break
+            except Exception:
+                time.sleep(0.05)
+
+        async with websockets.connect(f'ws://{host}:{port + 4}') as wcon:
+            await wcon.send(json.dumps({'evt': 'revt'}))
+            assert 'uid' in json.loads(await wcon.recv())['r']
+
+            nodes[0].triggerEvent('revt', {'value': 1}).result(5)
+            j = json.loads(await wcon.recv())
+            assert 1 == j['ver'] and 1 == j['r']['value']
+
+            nodes[0].triggerEvents({'revt': {'value': 2}, 'other': {}}).result(5)
+            j = json.loads(await wcon.recv())
+            assert 2 == j['ver'] and 2 == j['r']['value']
+            assert 1 == nodes[1].evh['other'].ver
+
+    finally:
+        for v in nodes:
+            v.stop()
+        redis.stop()
+
+
 def main():
 
     Log(ws.__info__)
@@ -103,9 +708,19 @@ def main():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.run_until_complete(test_1())
+    loop.run_until_complete(test_2())
+    loop.run_until_complete(test_3())
+    loop.run_until_complete(test_4())
 
 if __name__ == '__main__':
     try:
         main()
-    except Exception as e:
-        Log(e)
+    except BaseException as e:
+        Log(f'FAILED: {type(e).__name__} {e}')
+        traceback.print_exc()
+
+        # Servers that weren't stopped would keep the process alive, and
+        # their pool processes the port
+        for v in multiprocessing.active_children():
+            v.terminate()
+        os._exit(1)
@@ -0,0 +1,465 @@
+
+''' Event buses
+
+    Triggered events can go through a bus instead of straight to the
+    local subscribers.  The bus numbers them and hands them back, as a
+    dict of event names to (version, data), to every server sharing it,
+    this one included.  Since the versions come from the bus, every
+    server agrees on the version and data of each event.
+
+        LocalBus    - In process, for a single server
+        WorkerHub   - Parent side of opts.workers, relays to the workers
+        WorkerBus   - Worker side of opts.workers
+        RedisBus    - Any number of servers sharing a redis server, or
+                      anything else that speaks the redis protocol
+
+    See getEventBus() and WebShoesApp opts.eventbus.
+'''
+
+import struct
+import pickle
+import asyncio
+import urllib.parse
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+from . import codec
+
+
+''' Returns a frame for a message
+    @param [in] msg     - Message, must pickle
+'''
+def packFrame(msg):
+    b = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    return struct.pack('!I', len(b)) + b
+
+
+''' Reads a frame, returns the message
+    @param [in] reader  - asyncio.StreamReader
+'''
+async def readFrame(reader):
+    n = struct.unpack('!I', await reader.readexactly(4))[0]
+    return pickle.loads(await reader.readexactly(n))
+
+
+''' Returns an event bus for a url
+    @param [in] url     - 'local', or 'redis://[:password@]host[:port][/db][?channel=name]'
+    @param [in] json    - Json codec for buses that go over the network, see codec.py
+'''
+def getEventBus(url, json=None):
+    if not url or 'local' == url:
+        return LocalBus()
+
+    u = urllib.parse.urlparse(url)
+    if 'redis' == u.scheme:
+        q = urllib.parse.parse_qs(u.query)
+        return RedisBus(u.hostname or '127.0.0.1', u.port or 6379, u.password,
+                        int(u.path[1:] or 0), q.get('channel', ['webshoes'])[0], json)
+
+    raise Exception(f'Unknown event bus: {url}')
+
+
+''' class EventBus
+
+    Base class for event buses
+
+'''
+class EventBus():
+
+    def __init__(self):
+        self.onEvents = None
+
+        # Latest version of each event, for buses that number them
+        self.vers = {}
+
+    ''' Starts the bus, call on the server loop
+        @param [in] onEvents    - Coroutine function called with a dict of
+                                  event names to (version, data)
+    '''
+    async def start(self, onEvents):
+        self.onEvents = onEvents
+
+    ''' Sends events to every server on the bus, including this one
+        @param [in] events  - dict of event names to data
+    '''
+    async def publish(self, events):
+        raise NotImplementedError()
+
+    ''' Stops the bus
+    '''
+    async def close(self):
+        pass
+
+    ''' Returns events with the next version of each
+        @param [in] events  - dict of event names to data
+    '''
+    def number(self, events):
+        evs = {}
+        for k, v in events.items():
+            ver = self.vers[k] = self.vers.get(k, 0) + 1
+            evs[k] = (ver, v)
+        return evs
+
+
+''' class LocalBus
+
+    Events stay in this process
+
+'''
+class LocalBus(EventBus):
+
+    async def publish(self, events):
+        await self.onEvents(self.number(events))
+
+
+''' class WorkerHub
+
+    Parent side of opts.workers, numbers events and sends them to the
+    workers.  With an upstream bus, i.e. a RedisBus, events go through
+    that instead and whatever comes back is relayed to the workers.
+
+'''
+class WorkerHub(EventBus):
+
+    ''' Constructor
+        @param [in] socks       - Parent ends of the socket pairs, one per worker
+        @param [in] upstream    - Bus shared with other servers, or None
+    '''
+    def __init__(self, socks, upstream=None):
+        super().__init__()
+        self.socks = socks
+        self.upstream = upstream
+        self.writers = []
+        self.tasks = []
+
+    ''' Starts reading from the workers, call on the server loop
+        @param [in] onEvents    - Not used, the workers are the subscribers
+    '''
+    async def start(self, onEvents=None):
+        for s in self.socks:
+            reader, writer = await asyncio.open_unix_connection(sock=s)
+            self.writers.append(writer)
+            self.tasks.append(asyncio.ensure_future(self.read(reader)))
+        if self.upstream:
+            await self.upstream.start(self.send)
+
+    ''' Publishes the events each worker sends
+        @param [in] reader  - Connection to the worker
+    '''
+    async def read(self, reader):
+        try:
+            while True:
+                evs = await readFrame(reader)
+                try:
+                    await self.publish(evs)
+                except Exception as e:
+                    Log(e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def publish(self, events):
+        if self.upstream:
+            await self.upstream.publish(events)
+        else:
+            await self.send(self.number(events))
+
+    ''' Sends numbered events to every worker
+        @param [in] evs     - dict of event names to (version, data)
+
+        The frame is queued to every worker before the first await, so
+        all workers get events in the same order.
+    '''
+    async def send(self, evs):
+        f = packFrame(evs)
+        for w in self.writers:
+            if not w.is_closing():
+                w.write(f)
+        for w in self.writers:
+            try:
+                await w.drain()
+            except ConnectionError as e:
+                Log(e)
+
+    ''' Closes the connections, the workers exit when they see this
+    '''
+    async def close(self):
+        if self.upstream:
+            await self.upstream.close()
+        for t in self.tasks:
+            t.cancel()
+        for w in self.writers:
+            w.close()
+        for s in self.socks:
+            s.close()
+        self.tasks = []
+        self.writers = []
+
+
+''' class WorkerBus
+
+    Worker side of opts.workers, connected to the WorkerHub by a socket
+    pair made before the fork.  Frames are a 4 byte length followed by
+    a pickle, the socket pair is only ever shared with our own workers.
+
+'''
+class WorkerBus(EventBus):
+
+    ''' Constructor
+        @param [in] sock        - Worker end of the socket pair
+        @param [in] onClose     - Called when the hub goes away
+    '''
+    def __init__(self, sock, onClose=None):
+        super().__init__()
+        self.sock = sock
+        self.onClose = onClose
+        self.writer = None
+        self.task = None
+
+    async def start(self, onEvents):
+        self.onEvents = onEvents
+        reader, self.writer = await asyncio.open_unix_connection(sock=self.sock)
+        self.task = asyncio.ensure_future(self.read(reader))
+
+    ''' Passes on events from the hub
+        @param [in] reader  - Connection to the hub
+    '''
+    async def read(self, reader):
+        try:
+            while True:
+                evs = await readFrame(reader)
+                try:
+                    await self.onEvents(evs)
+                except Exception as e:
+                    Log(e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        if self.onClose:
+            self.onClose()
+
+    async def publish(self, events):
+        self.writer.write(packFrame(events))
+        await self.writer.drain()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+        self.sock.close()
+        self.task = None
+        self.writer = None
+
+
+''' class RedisConn
+
+    Just enough of a redis protocol (RESP) client for RedisBus
+
+'''
+class RedisConn():
+
+    ''' Constructor
+        @param [in] reader  - asyncio.StreamReader
+        @param [in] writer  - asyncio.StreamWriter
+    '''
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    ''' Connects, then authenticates and selects the database if needed
+        @param [in] host        - Server address
+        @param [in] port        - Server port
+        @param [in] password    - Password, or None
+        @param [in] db          - Database number
+    '''
+    @classmethod
+    async def connect(cls, host, port, password=None, db=0):
+        c = cls(*await asyncio.open_connection(host, port))
+        try:
+            if password:
+                await c.call('AUTH', password)
+            if db:
+                await c.call('SELECT', db)
+        except Exception:
+            c.close()
+            raise
+        return c
+
+    ''' Queues commands without waiting for the replies
+        @param [in] cmds    - Commands, each a tuple of arguments
+    '''
+    def send(self, *cmds):
+        b = []
+        for args in cmds:
+            b.append(b'*%d\r\n' % len(args))
+            for v in args:
+                v = v if isinstance(v, bytes) else str(v).encode()
+                b.append(b'$%d\r\n%s\r\n' % (len(v), v))
+        self.writer.write(b''.join(b))
+
+    ''' Reads a reply, error replies are raised
+    '''
+    async def read(self):
+        line = await self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Redis connection closed')
+        t, v = line[:1], line[1:-2]
+        if b'+' == t:
+            return v.decode()
+        if b'-' == t:
+            raise Exception(v.decode())
+        if b':' == t:
+            return int(v)
+        if b'$' == t:
+            n = int(v)
+            return None if 0 > n else (await self.reader.readexactly(n + 2))[:-2]
+        if b'*' == t:
+            n = int(v)
+            return None if 0 > n else [await self.read() for i in range(n)]
+        raise ConnectionError(f'Bad redis reply: {line}')
+
+    ''' Sends a command and returns the reply
+        @param [in] args    - Command and arguments
+    '''
+    async def call(self, *args):
+        self.send(args)
+        return await self.read()
+
+    def close(self):
+        self.writer.close()
+
+
+''' class RedisBus
+
+    Servers sharing a redis server, or anything that speaks its
+    protocol.  Versions come from INCR on '<channel>:ver:<event>' and
+    events are sent as json with PUBLISH on the channel.  Every server
+    keeps one subscription and fans events out to its own subscribers,
+    so there is one message per event per server.
+
+    Events published together, or while the previous batch is still on
+    its way, go out as one message.  Versions older than the one a
+    server already has are ignored, so servers end up agreeing even if
+    two publish the same event at once.
+
+'''
+class RedisBus(EventBus):
+
+    ''' Constructor
+        @param [in] host        - Redis address
+        @param [in] port        - Redis port
+        @param [in] password    - Password, or None
+        @param [in] db          - Database for the version counters
+        @param [in] channel     - Channel name, servers on the same channel share events
+        @param [in] json        - Json codec, see codec.py
+        @param [in] retry       - Seconds between reconnect attempts
+    '''
+    def __init__(self, host='127.0.0.1', port=6379, password=None, db=0, channel='webshoes',
+                 json=None, retry=1):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.channel = channel
+        self.json = json or codec.getJsonCodec()
+        self.retry = retry
+        self.pub = None
+        self.sub = None
+        self.task = None
+        self.batch = None
+        self.lock = None
+
+    ''' Connects, call on the server loop
+        @param [in] onEvents    - See EventBus.start()
+    '''
+    async def start(self, onEvents):
+        self.onEvents = onEvents
+        self.lock = asyncio.Lock()
+        await self.subscribe()
+        self.task = asyncio.ensure_future(self.read())
+
+    ''' Opens the connection subscribed to the channel
+    '''
+    async def subscribe(self):
+        sub = await RedisConn.connect(self.host, self.port, self.password, self.db)
+        try:
+            await sub.call('SUBSCRIBE', self.channel)
+        except Exception:
+            sub.close()
+            raise
+        self.sub = sub
+
+    ''' Passes on events from the channel, reconnecting if it drops
+    '''
+    async def read(self):
+        while True:
+            try:
+                m = await self.sub.read()
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                Log(e)
+                self.sub.close()
+                self.sub = None
+                while not self.sub:
+                    await asyncio.sleep(self.retry)
+                    try:
+                        await self.subscribe()
+                    except Exception as e:
+                        Log(e)
+                continue
+
+            if not isinstance(m, list) or 3 != len(m) or b'message' != m[0]:
+                continue
+
+            try:
+                evs = self.json.loads(m[2].decode())
+                await self.onEvents({k: tuple(v) for k, v in evs.items()})
+            except Exception as e:
+                Log(e)
+
+    async def publish(self, events):
+        if not self.batch:
+            self.batch = ({}, asyncio.get_running_loop().create_future())
+            asyncio.ensure_future(self.flush())
+        evs, f = self.batch
+        evs.update(events)
+        await asyncio.shield(f)
+
+    ''' Sends the waiting batch, one at a time
+    '''
+    async def flush(self):
+        async with self.lock:
+            evs, f = self.batch
+            self.batch = None
+            try:
+                if not self.pub:
+                    self.pub = await RedisConn.connect(self.host, self.port, self.password, self.db)
+
+                names = list(evs.keys())
+                self.pub.send(*[('INCR', f'{self.channel}:ver:{k}') for k in names])
+                vers = [await self.pub.read() for k in names]
+                await self.pub.call('PUBLISH', self.channel,
+                                    self.json.dumps({k: (v, evs[k]) for k, v in zip(names, vers)}))
+                f.set_result(True)
+
+            # Start over with a new connection next time
+            except Exception as e:
+                if self.pub:
+                    self.pub.close()
+                    self.pub = None
+                f.set_exception(e)
+                f.exception()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.sub:
+            self.sub.close()
+            self.sub = None
+        if self.pub:
+            self.pub.close()
+            self.pub = None
@@ -0,0 +1,166 @@
+
+''' Message codecs
+
+    Json codecs turn messages into text frames, the fastest installed
+    library is used by default
+
+        orjson > ujson > json
+
+    Binary codecs are used by websocket clients that ask for them with
+    a subprotocol, i.e. 'webshoes.msgpack' or 'webshoes.cbor', and need
+    the msgpack / cbor2 packages.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Websocket subprotocols are named with this prefix and the codec name
+SUBPROTOCOL = 'webshoes.'
+
+
+''' class JsonCodec
+
+    Standard library json
+
+'''
+class JsonCodec():
+
+    name = 'json'
+    binary = False
+
+    ''' Encode an object to a string
+        @param [in] o   - Object to encode
+    '''
+    def dumps(self, o):
+        return json.dumps(o)
+
+    ''' Decode a string or bytes
+        @param [in] s   - Data to decode
+    '''
+    def loads(self, s):
+        return json.loads(s)
+
+
+''' class OrjsonCodec
+
+    orjson, anything it can't encode, like very large integers,
+    falls back to the standard library
+
+'''
+class OrjsonCodec(JsonCodec):
+
+    name = 'orjson'
+
+    def dumps(self, o):
+        try:
+            return orjson.dumps(o, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            return json.dumps(o)
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+
+''' class UjsonCodec
+
+    ujson, with the same fallback as OrjsonCodec
+
+'''
+class UjsonCodec(JsonCodec):
+
+    name = 'ujson'
+
+    def dumps(self, o):
+        try:
+            return ujson.dumps(o, ensure_ascii=False, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return json.dumps(o)
+
+    def loads(self, s):
+        return ujson.loads(s)
+
+
+''' class MsgpackCodec
+
+    MessagePack binary frames
+
+'''
+class MsgpackCodec():
+
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, o):
+        return msgpack.packb(o, use_bin_type=True)
+
+    def loads(self, b):
+        return msgpack.unpackb(b, raw=False, strict_map_key=False)
+
+
+''' class CborCodec
+
+    CBOR binary frames
+
+'''
+class CborCodec():
+
+    name = 'cbor'
+    binary = True
+
+    def dumps(self, o):
+        return cbor2.dumps(o)
+
+    def loads(self, b):
+        return cbor2.loads(b)
+
+
+# Installed codecs, by name, in order of preference
+JSON_CODECS = {k: v for k, v, m in [('orjson', OrjsonCodec, orjson),
+                                    ('ujson', UjsonCodec, ujson),
+                                    ('json', JsonCodec, json)] if m}
+BINARY_CODECS = {k: v for k, v, m in [('msgpack', MsgpackCodec, msgpack),
+                                      ('cbor', CborCodec, cbor2)] if m}
+
+
+''' Returns a json codec
+    @param [in] name    - Codec name, None for the fastest installed
+'''
+def getJsonCodec(name=None):
+    if not name:
+        name = next(iter(JSON_CODECS))
+    if name not in JSON_CODECS:
+        raise Exception(f'Json codec not available: {name}')
+    return JSON_CODECS[name]()
+
+
+''' Returns binary codecs by subprotocol name
+    @param [in] names   - Codec names to allow, None for all installed
+'''
+def getBinaryCodecs(names=None):
+    if names is None:
+        names = list(BINARY_CODECS.keys())
+    r = {}
+    for k in names:
+        if k not in BINARY_CODECS:
+            raise Exception(f'Binary codec not available: {k}')
+        r[SUBPROTOCOL + k] = BINARY_CODECS[k]()
+    return r
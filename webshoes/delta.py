@@ -0,0 +1,126 @@
+
+''' JSON patch style diffs for event data
+
+    Operations follow RFC 6902 (add, remove, replace), with one addition
+    for long strings that only change in the middle
+
+        {"op": "splice", "path": "/m", "pos": 12, "del": 1, "value": "4"}
+
+    which replaces 'del' characters at 'pos' with 'value'.
+'''
+
+# Strings shorter than this are always replaced whole
+SPLICE_MIN = 64
+
+
+''' Escape a key for use in a patch path
+    @param [in] k   - Key to escape
+'''
+def escKey(k):
+    return str(k).replace('~', '~0').replace('/', '~1')
+
+
+''' Unescape a patch path into a list of keys
+    @param [in] path    - Patch path
+'''
+def splitPath(path):
+    return [k.replace('~1', '/').replace('~0', '~') for k in path.split('/')[1:]]
+
+
+''' Returns the patch operations that turn a into b
+    @param [in] a       - Original document
+    @param [in] b       - New document
+    @param [in] path    - Path of a and b within the document
+    @param [in] ops     - List to append operations to
+
+    Both documents should be plain json types, i.e. as decoded by json.loads()
+'''
+def diff(a, b, path='', ops=None):
+
+    if ops is None:
+        ops = []
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        for k in a:
+            if k not in b:
+                ops.append({'op': 'remove', 'path': f'{path}/{escKey(k)}'})
+        for k, v in b.items():
+            p = f'{path}/{escKey(k)}'
+            if k not in a:
+                ops.append({'op': 'add', 'path': p, 'value': v})
+            else:
+                diff(a[k], v, p, ops)
+
+    elif isinstance(a, list) and isinstance(b, list):
+        n = min(len(a), len(b))
+        for i in range(n):
+            diff(a[i], b[i], f'{path}/{i}', ops)
+        for i in range(len(a) - 1, n - 1, -1):
+            ops.append({'op': 'remove', 'path': f'{path}/{i}'})
+        for v in b[n:]:
+            ops.append({'op': 'add', 'path': f'{path}/-', 'value': v})
+
+    # Positions must mean the same thing to javascript, so ascii only
+    elif isinstance(a, str) and isinstance(b, str) \
+            and SPLICE_MIN <= len(a) and SPLICE_MIN <= len(b) \
+            and a.isascii() and b.isascii():
+        if a != b:
+            n = min(len(a), len(b))
+            p = 0
+            while p < n and a[p] == b[p]:
+                p += 1
+            s = 0
+            while s < n - p and a[-1 - s] == b[-1 - s]:
+                s += 1
+            ops.append({'op': 'splice', 'path': path, 'pos': p,
+                        'del': len(a) - p - s, 'value': b[p:len(b) - s]})
+
+    elif type(a) is not type(b) or a != b:
+        ops.append({'op': 'replace', 'path': path, 'value': b})
+
+    return ops
+
+
+''' Apply patch operations to a document
+    @param [in] doc - Document to patch, modified in place
+    @param [in] ops - Patch operations from diff()
+
+    Returns the patched document, which is a new object if the root
+    was replaced.
+'''
+def patch(doc, ops):
+
+    for o in ops:
+        keys = splitPath(o['path'])
+
+        # Whole document
+        if not keys:
+            if 'splice' == o['op']:
+                doc = doc[:o['pos']] + o['value'] + doc[o['pos'] + o['del']:]
+            else:
+                doc = o['value']
+            continue
+
+        # Find the parent
+        p = doc
+        for k in keys[:-1]:
+            p = p[int(k)] if isinstance(p, list) else p[k]
+        k = keys[-1]
+
+        if isinstance(p, list):
+            if 'add' == o['op']:
+                if '-' == k:
+                    p.append(o['value'])
+                else:
+                    p.insert(int(k), o['value'])
+                continue
+            k = int(k)
+
+        if 'remove' == o['op']:
+            del p[k]
+        elif 'splice' == o['op']:
+            p[k] = p[k][:o['pos']] + o['value'] + p[k][o['pos'] + o['del']:]
+        else:
+            p[k] = o['value']
+
+    return doc
@@ -0,0 +1,108 @@
+
+
+''' class EventSub
+
+    A single subscription to an event
+
+'''
+class EventSub():
+
+    __slots__ = ('uid', 'ujs', 'conn', 'ver')
+
+    ''' Constructor
+        @param [in] uid     - Unique id for event handler
+        @param [in] ujs     - The uid, json encoded
+        @param [in] conn    - WsConn over which to send events
+    '''
+    def __init__(self, uid, ujs, conn):
+        self.uid = uid
+        self.ujs = ujs
+        self.conn = conn
+        self.ver = 0
+
+
+''' class Event
+
+    An event, its latest data and its subscribers
+
+'''
+class Event():
+
+    __slots__ = ('evt', 'ver', 'last', 'subs', 'rjs', 'rver', 'hist', 'deltas', 'dver')
+
+    ''' Constructor
+        @param [in] evt     - Event name
+        @param [in] ver     - Current version
+        @param [in] last    - Latest data
+    '''
+    def __init__(self, evt, ver=0, last=None):
+        self.evt = evt
+        self.ver = ver
+        self.last = last
+
+        # Subscribers by uid
+        self.subs = {}
+
+        # Encoded data and the version it was encoded from
+        self.rjs = None
+        self.rver = -1
+
+        # Recently encoded versions, ver -> encoded data, oldest first
+        self.hist = {}
+
+        # Encoded deltas to rver by base version, None if not worth sending
+        self.deltas = {}
+        self.dver = -1
+
+
+''' class EventLimit
+
+    Delivery limits for an event.  Triggers inside the limits go out
+    right away, the rest are held back and subscribers pick up the
+    latest version once the event is allowed through again.
+
+'''
+class EventLimit():
+
+    __slots__ = ('rate', 'burst', 'interval', 'trailing', 'tokens', 'stamp', 'sent', 'timer')
+
+    ''' Constructor
+        @param [in] rate        - Maximum deliveries per second, 0 for no limit
+        @param [in] burst       - Number of deliveries that may go out back to
+                                    back before rate applies
+        @param [in] interval    - Minimum seconds between deliveries
+        @param [in] trailing    - If True, a held back version is delivered as
+                                    soon as the limits allow, otherwise it waits
+                                    for the next trigger
+    '''
+    def __init__(self, rate=0, burst=1, interval=0, trailing=True):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.interval = interval
+        self.trailing = trailing
+        self.tokens = self.burst
+        self.stamp = 0
+        self.sent = None
+        self.timer = None
+
+    ''' Returns the number of seconds until a delivery is allowed
+        @param [in] now - Current monotonic time
+    '''
+    def wait(self, now):
+        d = 0
+        if self.interval and self.sent is not None:
+            d = self.sent + self.interval - now
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if 1 > self.tokens:
+                d = max(d, (1 - self.tokens) / self.rate)
+        return d
+
+    ''' Records a delivery
+        @param [in] now - Current monotonic time
+    '''
+    def take(self, now):
+        self.sent = now
+        if self.rate:
+            self.tokens -= 1
@@ -0,0 +1,234 @@
+
+import os
+import gzip
+import stat
+import time
+import asyncio
+import mimetypes
+import collections
+import email.utils
+
+# File extensions of precompressed siblings, by content encoding
+ENCODING_EXTS = {'br': '.br', 'gzip': '.gz'}
+
+# Mime types worth compressing, besides text/*
+COMPRESSIBLE = {'application/javascript', 'application/json', 'application/xml',
+                'application/wasm', 'image/svg+xml'}
+
+# Reading or compressing at least this many bytes is done off the event loop
+OFFLOAD = 256*1024
+
+
+''' Calls fn(), in the default executor if there's enough work to hold up the event loop
+    @param [in] size    - Bytes the call works on
+    @param [in] fn      - Function to call
+'''
+async def offload(size, fn):
+    if OFFLOAD > size:
+        return fn()
+    return await asyncio.get_running_loop().run_in_executor(None, fn)
+
+
+''' Returns the contents of a file
+    @param [in] path    - Full path to the file
+    @param [in] n       - Most bytes to read
+'''
+def readFile(path, n):
+    with open(path, 'rb') as f:
+        return f.read(n)
+
+
+''' Returns the content encodings a request accepts
+    @param [in] req     - Request object
+'''
+def acceptEncodings(req):
+    r = set()
+    for v in req.headers.get('Accept-Encoding', '').split(','):
+        v = v.split(';')
+        if 1 < len(v) and v[1].strip() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        r.add(v[0].strip().lower())
+    return r
+
+
+''' class FileEntry
+
+    A file, its validators and, if it is small enough, its contents
+
+'''
+class FileEntry():
+
+    __slots__ = ('path', 'mtime', 'size', 'mime', 'etag', 'lastmod', 'data', 'checked', 'enc', 'extra')
+
+    ''' Constructor
+        @param [in] path    - Full path to the file
+        @param [in] st      - os.stat() result for the file
+    '''
+    def __init__(self, path, st):
+        self.path = path
+        self.mtime = st.st_mtime_ns
+        self.size = st.st_size
+        self.mime = mimetypes.guess_type(path)[0] or 'text/plain'
+        self.etag = f'"{self.mtime:x}-{self.size:x}"'
+        self.lastmod = email.utils.formatdate(self.mtime / 1e9, usegmt=True)
+        self.data = None
+        self.checked = 0
+
+        # Encoded versions by content encoding, (data, etag) or None
+        self.enc = {}
+
+        # Bytes of data compressed here, as opposed to read from siblings
+        self.extra = 0
+
+    ''' Returns True if the file is a type that compresses well
+    '''
+    def compressible(self):
+        return self.mime.startswith('text/') or self.mime in COMPRESSIBLE
+
+    ''' Returns True if the client's copy, going by the request
+        validators, is still current
+        @param [in] req     - Request object
+        @param [in] etag    - ETag of the version being sent, None for the file
+    '''
+    def notModified(self, req, etag=None):
+        inm = req.headers.get('If-None-Match')
+        if inm is not None:
+            tags = [v.strip() for v in inm.split(',')]
+            return '*' in tags or (etag or self.etag) in [v[2:] if v.startswith('W/') else v for v in tags]
+        ims = req.if_modified_since
+        return ims is not None and self.mtime // 1000000000 <= ims.timestamp()
+
+
+''' class FileCache
+
+    Size bounded LRU cache of static files, keyed by path.  Entries are
+    checked against the file modification time, at most once every
+    'check' seconds.
+
+'''
+class FileCache():
+
+    ''' Constructor
+        @param [in] maxbytes    - Maximum bytes of file data to keep
+        @param [in] maxfile     - Largest file to keep in memory
+        @param [in] check       - Seconds between modification time checks
+        @param [in] minzip      - Smallest file to compress on the fly, 0 to never
+    '''
+    def __init__(self, maxbytes=32*1024*1024, maxfile=1024*1024, check=1, minzip=512):
+        self.maxbytes = maxbytes
+        self.maxfile = min(maxfile, maxbytes)
+        self.check = check
+        self.minzip = minzip
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+
+    ''' Returns the entry for a file, or None if it isn't a file
+        @param [in] path    - Full path to the file
+
+        Files larger than maxfile are returned without data and not kept.
+        Call on the event loop.
+    '''
+    async def get(self, path):
+
+        now = time.monotonic()
+        e = self.entries.get(path)
+        if e:
+            if now - e.checked < self.check:
+                self.entries.move_to_end(path)
+                return e
+            self.remove(path)
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        # Still the same file
+        if e and e.mtime == st.st_mtime_ns and e.size == st.st_size:
+            e.checked = now
+            self.add(e)
+            return e
+
+        e = FileEntry(path, st)
+        e.checked = now
+        if self.maxfile >= e.size:
+            try:
+                e.data = await offload(e.size, lambda: readFile(path, self.maxfile + 1))
+            except OSError:
+                return None
+
+            # Changed while we were reading, try again next time
+            if len(e.data) != e.size:
+                e.data = None
+                return e
+
+            self.add(e)
+
+        return e
+
+    ''' Adds an entry, dropping the least recently used ones to make room
+        @param [in] e   - Entry to add
+    '''
+    def add(self, e):
+        self.remove(e.path)
+        self.entries[e.path] = e
+        self.bytes += len(e.data) + e.extra
+        self.trim()
+
+    ''' Drops the least recently used entries until under maxbytes
+    '''
+    def trim(self):
+        while self.bytes > self.maxbytes:
+            self.remove(next(iter(self.entries)))
+
+    ''' Removes an entry
+        @param [in] path    - Full path to the file
+    '''
+    def remove(self, path):
+        e = self.entries.pop(path, None)
+        if e:
+            self.bytes -= len(e.data) + e.extra
+
+    ''' Returns (data, etag) for a cached file in a content encoding, or None
+        @param [in] e       - Cached entry, i.e. from get(), with data
+        @param [in] enc     - Content encoding, 'br' or 'gzip'
+
+        A precompressed sibling, i.e. file.js.gz, is used if there is one
+        no older than the file.  Otherwise gzip is made here, once, if the
+        file is worth compressing.  Siblings should be rebuilt along with
+        the file, the result is kept for as long as the file is unchanged.
+    '''
+    async def encoded(self, e, enc):
+
+        if enc in e.enc:
+            return e.enc[enc]
+
+        r = None
+        s = await self.get(e.path + ENCODING_EXTS[enc])
+        if s and s.data is not None and s.mtime >= e.mtime:
+            r = (s.data, s.etag)
+
+        elif 'gzip' == enc and self.minzip and self.minzip <= e.size and e.compressible():
+            z = await offload(e.size, lambda: gzip.compress(e.data, 6, mtime=0))
+
+            # Another request got there first
+            if enc in e.enc:
+                return e.enc[enc]
+
+            if len(z) < e.size:
+                r = (z, e.etag[:-1] + '-gz"')
+                e.extra += len(z)
+                if self.entries.get(e.path) is e:
+                    self.bytes += len(z)
+                    self.trim()
+
+        e.enc[enc] = r
+        return r
+
+    ''' Removes all entries
+    '''
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
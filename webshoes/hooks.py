@@ -0,0 +1,317 @@
+
+''' Dispatch hooks
+
+    Hooks see every handler call, http or websocket, before and after
+    the handler runs.  They're for finding slow handlers under real
+    traffic, without redeploying.
+
+        import webshoes as ws
+
+        slow = ws.SlowCallHook(0.25)
+        prof = ws.ProfileHook(0.01)
+        wsa.addHook(slow)
+        wsa.addHook(prof)
+
+        # Profile every call for the next 30 seconds, then write the results
+        prof.window(30, '/tmp/webshoes.pstats')
+
+        $ python3 -m pstats /tmp/webshoes.pstats
+
+    Hooks run on the server loop, so they should be quick, and they
+    don't need locks.  Calls answered from the result cache go through
+    them too, their elapsed time is just the lookup.
+'''
+
+import time
+import random
+import pstats
+import cProfile
+import tracemalloc
+import collections
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+
+''' class HandlerCall
+
+    A handler call, as seen by the hooks
+
+'''
+class HandlerCall():
+
+    __slots__ = ('sub', 'fn', 'path', 'q', 'req', 'ws', 'start', 'elapsed',
+                 'error', 'profile', 'state')
+
+    ''' Constructor
+        @param [in] sub     - Handler group
+        @param [in] fn      - Function name within the group
+        @param [in] path    - Command or http path
+        @param [in] q       - Parameters, as decoded
+        @param [in] req     - Request object
+        @param [in] ws      - Websocket, None for http requests
+    '''
+    def __init__(self, sub, fn, path, q, req, ws):
+        self.sub = sub
+        self.fn = fn
+        self.path = path
+        self.q = q
+        self.req = req
+        self.ws = ws
+        self.start = time.perf_counter()
+
+        # Seconds the call took and what it raised, set before post()
+        self.elapsed = 0
+        self.error = None
+
+        # cProfile.Profile to run the handler under, see ProfileHook
+        self.profile = None
+
+        # For hooks to keep things between pre() and post(), by hook
+        self.state = {}
+
+    ''' Returns 'sub/function'
+    '''
+    @property
+    def name(self):
+        return f'{self.sub}/{self.fn}'
+
+
+''' class DispatchHook
+
+    Base class for hooks, see WebShoesApp.addHook()
+
+'''
+class DispatchHook():
+
+    ''' Called before the handler
+        @param [in] call    - HandlerCall
+    '''
+    def pre(self, call):
+        pass
+
+    ''' Called after the handler, even if it failed
+        @param [in] call    - HandlerCall, with elapsed and error set
+    '''
+    def post(self, call):
+        pass
+
+
+''' class SlowCallHook
+
+    Logs calls that take longer than a threshold, and keeps the latest
+
+'''
+class SlowCallHook(DispatchHook):
+
+    ''' Constructor
+        @param [in] threshold   - Seconds a call may take before it's slow
+        @param [in] keep        - Number of slow calls to keep in self.calls
+        @param [in] log         - True to Log() slow calls
+    '''
+    def __init__(self, threshold=0.1, keep=100, log=True):
+        self.threshold = threshold
+        self.log = log
+        self.calls = collections.deque(maxlen=keep)
+
+    def post(self, call):
+        if call.elapsed < self.threshold:
+            return
+        v = {'cmd': call.name, 'path': call.path, 'elapsed': round(call.elapsed, 6),
+             'time': time.time(), 'error': str(call.error) if call.error else None}
+        self.calls.append(v)
+        if self.log:
+            Log(f'Slow call: {call.path} took {call.elapsed:.3f}s')
+
+
+''' class ProfileHook
+
+    Runs a fraction of the calls under cProfile and adds them up.
+    Handlers are profiled in whatever thread they run in, and async
+    handlers only while they're running, not while they wait.
+    Handlers run in another process aren't profiled.
+
+    Only one call is profiled at a time, calls that start while one is
+    being profiled are skipped.  From Python 3.12 only one profiler can
+    be enabled at once, and if another one is, calls run unprofiled.
+
+'''
+class ProfileHook(DispatchHook):
+
+    ''' Constructor
+        @param [in] fraction    - Fraction of calls to profile, 0 for only in a window()
+    '''
+    def __init__(self, fraction=0.01):
+        self.fraction = fraction
+        self.stats = None
+        self.count = 0
+        self.until = 0
+        self.path = None
+        self.busy = False
+
+    ''' Profile calls for a while, can be called from any thread
+        @param [in] secs    - Seconds to profile for
+        @param [in] path    - If given, results are written here once the
+                              first call after the window ends
+    '''
+    def window(self, secs, path=None):
+        self.path = path
+        self.until = time.monotonic() + secs
+
+    def pre(self, call):
+        if self.busy or call.profile:
+            return
+        if self.until or (self.fraction and random.random() < self.fraction):
+            call.profile = call.state[self] = cProfile.Profile()
+            self.busy = True
+
+    def post(self, call):
+        if call.state.pop(self, None):
+            self.busy = False
+            try:
+                if self.stats:
+                    self.stats.add(call.profile)
+                else:
+                    self.stats = pstats.Stats(call.profile)
+                self.count += 1
+
+            # Nothing was recorded, i.e. from another process
+            except TypeError:
+                pass
+
+        if self.until and time.monotonic() >= self.until:
+            self.until = 0
+            if self.path:
+                self.dump(self.path)
+                self.path = None
+
+    ''' Writes the results so far as a pstats file, returns False if there are none
+        @param [in] path    - File to write
+    '''
+    def dump(self, path):
+        if not self.stats:
+            return False
+        self.stats.dump_stats(path)
+        Log(f'Wrote {self.count} profiled calls to {path}')
+        return True
+
+    ''' Forgets the results so far
+    '''
+    def clear(self):
+        self.stats = None
+        self.count = 0
+
+
+''' class MallocHook
+
+    Compares tracemalloc snapshots from before and after a fraction of
+    the calls.  Tracing is only on while a sampled call is running, but
+    it covers the whole process, so other work that happens meanwhile
+    shows up too.  Snapshots are slow, keep the fraction small.
+
+'''
+class MallocHook(DispatchHook):
+
+    ''' Constructor
+        @param [in] fraction    - Fraction of calls to sample
+        @param [in] top         - Number of lines to keep per call
+        @param [in] keep        - Number of calls to keep in self.calls
+        @param [in] frames      - Stack frames to keep per allocation
+    '''
+    def __init__(self, fraction=0.001, top=10, keep=100, frames=1):
+        self.fraction = fraction
+        self.top = top
+        self.frames = frames
+        self.calls = collections.deque(maxlen=keep)
+        self.active = 0
+        self.started = False
+
+    def pre(self, call):
+        if random.random() >= self.fraction:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started = True
+        self.active += 1
+        call.state[self] = tracemalloc.take_snapshot()
+
+    def post(self, call):
+        snap = call.state.pop(self, None)
+        if snap is None:
+            return
+        diff = tracemalloc.take_snapshot().compare_to(snap, 'lineno')[:self.top]
+        self.calls.append({'cmd': call.name, 'path': call.path, 'time': time.time(),
+                           'top': [str(v) for v in diff]})
+        self.active -= 1
+
+        # Leave tracing alone if someone else turned it on
+        if not self.active and self.started:
+            tracemalloc.stop()
+            self.started = False
+
+
+''' Turns a profiler on, returns False if another one is already on
+    @param [in] prof    - cProfile.Profile
+'''
+def enableProfile(prof):
+    try:
+        prof.enable()
+        return True
+    except ValueError:
+        return False
+
+
+''' Calls a function with a profiler on, or without if it can't be turned on
+    @param [in] prof    - cProfile.Profile
+    @param [in] f       - Function to call
+    @param [in] args    - Arguments
+'''
+def profileCall(prof, f, *args):
+    if not enableProfile(prof):
+        return f(*args)
+    try:
+        return f(*args)
+    finally:
+        prof.disable()
+
+
+''' Awaits a value yielded by a coroutine, see profileCoro()
+'''
+class YieldTo():
+
+    __slots__ = ('v',)
+
+    def __init__(self, v):
+        self.v = v
+
+    def __await__(self):
+        return (yield self.v)
+
+
+''' Runs a coroutine with a profiler enabled only while it runs
+    @param [in] prof    - cProfile.Profile
+    @param [in] coro    - Coroutine
+
+    The coroutine is stepped from here so time spent waiting, and other
+    tasks running meanwhile, aren't counted.
+'''
+async def profileCoro(prof, coro):
+    v, err = None, None
+    while True:
+        on = enableProfile(prof)
+        try:
+            y = coro.throw(err) if err else coro.send(v)
+        except StopIteration as e:
+            return e.value
+        finally:
+            if on:
+                prof.disable()
+
+        v, err = None, None
+        try:
+            v = await YieldTo(y)
+        except BaseException as e:
+            err = e
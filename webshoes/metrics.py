@@ -0,0 +1,297 @@
+
+''' Server metrics
+
+    Counters are only ever touched on the server loop, so there are no
+    locks, and a command costs a couple of clock reads and a few integer
+    adds.  Set opts.metrics to False to turn them off.
+
+    Register the handlers to read them
+
+        wsa.register('metrics', '', '', '', '', {
+                'json': webshoes.metricsJson,
+                'prometheus': webshoes.metricsPrometheus
+            })
+
+    then GET /metrics/json or /metrics/prometheus.
+'''
+
+import time
+from aiohttp import web
+
+
+''' class Histogram
+
+    Latencies in microseconds, in log linear buckets like HdrHistogram.
+    Values under 8 get a bucket each, after that each power of two is
+    split into four, so a bucket is never more than 25% wide.
+
+'''
+class Histogram():
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    # Enough for just over 12 days
+    BUCKETS = 160
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    ''' Adds a value
+        @param [in] v   - Microseconds, an int
+    '''
+    def add(self, v):
+        n = v.bit_length()
+        i = v if 3 >= n else ((n - 3) << 2) + (v >> (n - 3))
+        self.counts[i if i < self.BUCKETS else self.BUCKETS - 1] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    ''' Returns the upper bound of a bucket, exclusive
+        @param [in] i   - Bucket index
+    '''
+    @staticmethod
+    def upper(i):
+        if 8 > i:
+            return i + 1
+        return (5 + (i & 3)) << ((i >> 2) - 1)
+
+    ''' Returns the value below which a fraction of the values fall
+        @param [in] q   - Fraction, i.e. 0.99
+    '''
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        n = q * self.count
+        c = 0
+        for i, v in enumerate(self.counts):
+            c += v
+            if c >= n:
+                return min(self.upper(i) - 1, self.max)
+        return self.max
+
+    ''' Returns a summary, in milliseconds
+    '''
+    def asDict(self):
+        ms = lambda v: round(v / 1000, 3)
+        return {'count': self.count,
+                'mean': ms(self.sum / self.count) if self.count else 0,
+                'p50': ms(self.quantile(0.5)),
+                'p90': ms(self.quantile(0.9)),
+                'p99': ms(self.quantile(0.99)),
+                'p999': ms(self.quantile(0.999)),
+                'max': ms(self.max)}
+
+    ''' Returns (upper bound in microseconds, cumulative count) at powers of four
+    '''
+    def cumulative(self):
+        r = []
+        c = 0
+        i = 0
+        for k in range(14):
+            le = 4 ** k
+            while i < self.BUCKETS and self.upper(i) <= le:
+                c += self.counts[i]
+                i += 1
+            r.append((le, c))
+        return r
+
+
+''' class CommandStats
+
+    Counters for one handler function
+
+'''
+class CommandStats():
+
+    __slots__ = ('errors', 'inflight', 'hist')
+
+    def __init__(self):
+        self.errors = 0
+        self.inflight = 0
+        self.hist = Histogram()
+
+
+''' class EventStats
+
+    Counters for one event
+
+'''
+class EventStats():
+
+    __slots__ = ('sends', 'frames', 'bytes')
+
+    def __init__(self):
+        self.sends = 0
+        self.frames = 0
+        self.bytes = 0
+
+
+''' class Metrics
+
+    Everything counted for a WebShoesApp, see wsa.metrics
+
+'''
+class Metrics():
+
+    def __init__(self):
+        self.started = time.time()
+
+        # By 'sub/function'
+        self.commands = {}
+
+        # By event name
+        self.events = {}
+
+        # Time to queue an event to all its subscribers
+        self.fanout = Histogram()
+
+        self.wsConnections = 0
+        self.wsConnectionsTotal = 0
+        self.wsMessages = 0
+        self.httpRequests = 0
+        self.httpErrors = 0
+
+        # Bytes sent, http replies and websocket replies, and event frames queued
+        self.httpBytes = 0
+        self.wsBytes = 0
+        self.eventBytes = 0
+
+        # serveFolder() replies
+        self.static = {'ok': 0, 'not_modified': 0, 'not_found': 0, 'file': 0, 'bytes': 0}
+
+    ''' Returns the counters for a handler function
+        @param [in] name    - 'sub/function'
+    '''
+    def command(self, name):
+        s = self.commands.get(name)
+        if not s:
+            s = self.commands[name] = CommandStats()
+        return s
+
+    ''' Records an event going out
+        @param [in] ev      - Event name
+        @param [in] frames  - Number of messages queued
+        @param [in] size    - Bytes queued
+    '''
+    def eventSent(self, ev, frames, size):
+        s = self.events.get(ev)
+        if not s:
+            s = self.events[ev] = EventStats()
+        s.sends += 1
+        s.frames += frames
+        s.bytes += size
+        self.eventBytes += size
+
+    ''' Returns the metrics as a dict
+        @param [in] wsa     - WebShoesApp, for the subscriber counts
+    '''
+    def asDict(self, wsa=None):
+        evs = {k: {'sends': v.sends, 'frames': v.frames, 'bytes': v.bytes, 'subscribers': 0}
+                    for k, v in self.events.items()}
+        if wsa:
+            for k, e in wsa.evh.items():
+                evs.setdefault(k, {'sends': 0, 'frames': 0, 'bytes': 0})['subscribers'] = len(e.subs)
+
+        return {
+            'uptime': round(time.time() - self.started, 3),
+            'ws': {'connections': self.wsConnections,
+                   'connectionsTotal': self.wsConnectionsTotal,
+                   'messages': self.wsMessages},
+            'http': {'requests': self.httpRequests, 'errors': self.httpErrors},
+            'bytes': {'http': self.httpBytes, 'ws': self.wsBytes, 'event': self.eventBytes},
+            'commands': {k: dict(v.hist.asDict(), errors=v.errors, inflight=v.inflight)
+                            for k, v in self.commands.items()},
+            'events': evs,
+            'fanout': self.fanout.asDict(),
+            'static': dict(self.static)
+        }
+
+    ''' Returns the metrics in the Prometheus text format
+        @param [in] wsa     - WebShoesApp, for the subscriber counts
+    '''
+    def prometheus(self, wsa=None):
+
+        r = []
+        def metric(name, kind, text, values):
+            r.append(f'# HELP webshoes_{name} {text}')
+            r.append(f'# TYPE webshoes_{name} {kind}')
+            for labels, v in values:
+                r.append(f'webshoes_{name}{labels} {v}')
+
+        def histogram(name, text, hists):
+            r.append(f'# HELP webshoes_{name} {text}')
+            r.append(f'# TYPE webshoes_{name} histogram')
+            for labels, h in hists:
+                sep = ',' if labels else ''
+                for le, c in h.cumulative():
+                    r.append(f'webshoes_{name}_bucket{{{labels}{sep}le="{le / 1e6:g}"}} {c}')
+                r.append(f'webshoes_{name}_bucket{{{labels}{sep}le="+Inf"}} {h.count}')
+                r.append(f'webshoes_{name}_sum{{{labels}}} {h.sum / 1e6}')
+                r.append(f'webshoes_{name}_count{{{labels}}} {h.count}')
+
+        cmds = [(f'cmd="{esc(k)}"', v) for k, v in self.commands.items()]
+        histogram('command_seconds', 'Handler latency', [(l, v.hist) for l, v in cmds])
+        metric('command_errors_total', 'counter', 'Handler errors',
+                [('{' + l + '}', v.errors) for l, v in cmds])
+        metric('command_inflight', 'gauge', 'Handlers running',
+                [('{' + l + '}', v.inflight) for l, v in cmds])
+
+        metric('ws_connections', 'gauge', 'Open websockets', [('', self.wsConnections)])
+        metric('ws_connections_total', 'counter', 'Websockets opened', [('', self.wsConnectionsTotal)])
+        metric('ws_messages_total', 'counter', 'Websocket messages received', [('', self.wsMessages)])
+        metric('http_requests_total', 'counter', 'Http requests', [('', self.httpRequests)])
+        metric('http_errors_total', 'counter', 'Http requests that failed', [('', self.httpErrors)])
+        metric('sent_bytes_total', 'counter', 'Bytes sent, by replies over http and websockets, and events', [
+                ('{type="http"}', self.httpBytes),
+                ('{type="ws"}', self.wsBytes),
+                ('{type="event"}', self.eventBytes)])
+
+        evs = [(f'{{evt="{esc(k)}"}}', v) for k, v in self.events.items()]
+        metric('event_sends_total', 'counter', 'Times an event went out', [(l, v.sends) for l, v in evs])
+        metric('event_frames_total', 'counter', 'Event messages queued', [(l, v.frames) for l, v in evs])
+        metric('event_bytes_total', 'counter', 'Event bytes queued', [(l, v.bytes) for l, v in evs])
+        if wsa:
+            metric('event_subscribers', 'gauge', 'Subscribers',
+                    [(f'{{evt="{esc(k)}"}}', len(e.subs)) for k, e in wsa.evh.items()])
+        histogram('fanout_seconds', 'Time to queue an event to its subscribers', [('', self.fanout)])
+
+        metric('static_requests_total', 'counter', 'Static file replies',
+                [(f'{{result="{k}"}}', v) for k, v in self.static.items() if 'bytes' != k])
+        metric('static_bytes_total', 'counter', 'Static file bytes sent', [('', self.static['bytes'])])
+
+        return '\n'.join(r) + '\n'
+
+
+''' Escapes a Prometheus label value
+    @param [in] v   - Value
+'''
+def esc(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+''' Handler that returns the metrics as json
+    @param [in] ctx     - Calling context
+    @param [in] q       - Not used
+
+    Async so it always runs on the server loop, along with the counters.
+'''
+async def metricsJson(ctx, q):
+    m = ctx.wsa.metrics
+    return m.asDict(ctx.wsa) if m else {'error': 'Metrics are off, see opts.metrics'}
+
+
+''' Handler that returns the metrics in the Prometheus text format
+    @param [in] ctx     - Calling context
+    @param [in] q       - Not used
+'''
+async def metricsPrometheus(ctx, q):
+    m = ctx.wsa.metrics
+    if not m:
+        return web.Response(text='Metrics are off, see opts.metrics', status=404)
+    return web.Response(body=m.prometheus(ctx.wsa).encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -0,0 +1,117 @@
+
+''' Lightweight handler arguments
+
+    For handlers registered with wrap='light', these stand in for the
+    property bags normally passed as ctx and q.  They give the same
+    q.a style access, but wrap the decoded message in place instead of
+    copying it, and nested dicts are only wrapped when they are read.
+'''
+
+
+''' class Params
+
+    Attribute access to a dict, missing keys read as None
+
+'''
+class Params():
+
+    __slots__ = ('_d',)
+
+    ''' Constructor
+        @param [in] d   - dict to wrap, it is not copied
+    '''
+    def __init__(self, d=None):
+        object.__setattr__(self, '_d', {} if d is None else d)
+
+    ''' Wrap dicts on the way out so nested values work the same way
+    '''
+    @staticmethod
+    def _wrap(v):
+        return Params(v) if type(v) is dict else v
+
+    def __getattr__(self, k):
+        v = self._d.get(k)
+        return Params(v) if type(v) is dict else v
+
+    def __setattr__(self, k, v):
+        self._d[k] = v
+
+    def __delattr__(self, k):
+        self._d.pop(k, None)
+
+    def __getitem__(self, k):
+        return self._wrap(self._d[k])
+
+    def __setitem__(self, k, v):
+        self._d[k] = v
+
+    def __delitem__(self, k):
+        del self._d[k]
+
+    def __contains__(self, k):
+        return k in self._d
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __bool__(self):
+        return bool(self._d)
+
+    def __eq__(self, o):
+        return self._d == (o._d if isinstance(o, Params) else o)
+
+    def __repr__(self):
+        return f'Params({self._d!r})'
+
+    def get(self, k, default=None):
+        return self._wrap(self._d.get(k, default))
+
+    def exists(self, k):
+        return k in self._d
+
+    def keys(self):
+        return self._d.keys()
+
+    def values(self):
+        return self._d.values()
+
+    def items(self):
+        return self._d.items()
+
+    ''' Returns the wrapped dict
+    '''
+    def as_dict(self):
+        return self._d
+
+
+''' class Context
+
+    Handler context, the same fields as the property bag version
+
+'''
+class Context():
+
+    __slots__ = ('p', 'req', 'opts', 'wsa', 'ws')
+
+    ''' Constructor
+        @param [in] p       - Command or http path
+        @param [in] req     - Request object
+        @param [in] opts    - Server options
+        @param [in] wsa     - WebShoesApp
+        @param [in] ws      - Websocket, None for http requests
+    '''
+    def __init__(self, p, req, opts, wsa, ws=None):
+        self.p = p
+        self.req = req
+        self.opts = opts
+        self.wsa = wsa
+        self.ws = ws
+
+    def __getitem__(self, k):
+        return getattr(self, k)
+
+    def get(self, k, default=None):
+        return getattr(self, k, default)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+''' Precompress the files in a folder served by serveFolder()
+
+        $ python3 -m webshoes.precompress ./site
+
+    Writes file.gz next to each compressible file, and file.br too if
+    the brotli package is installed.  Siblings that are already up to
+    date are left alone, and ones that wouldn't be smaller aren't written.
+'''
+
+import os
+import sys
+import gzip
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import sparen
+    Log = sparen.log
+except:
+    Log = print
+
+from . filecache import ENCODING_EXTS, COMPRESSIBLE
+
+
+''' Returns True if the file is a type that compresses well
+    @param [in] path    - File name
+
+    Files that are already compressed, i.e. the .gz / .br siblings
+    written here, are not.
+'''
+def isCompressible(path):
+    mime, enc = mimetypes.guess_type(path)
+    if enc:
+        return False
+    mime = mime or ''
+    return mime.startswith('text/') or mime in COMPRESSIBLE
+
+
+''' Precompress the files in a folder and its sub folders
+    @param [in] root    - Folder to precompress
+    @param [in] minsize - Smallest file to compress
+    @param [in] force   - Rewrite siblings even if they are up to date
+    @param [in] verbose - Log the files written
+
+    Returns a list of the files written
+'''
+def precompress(root, minsize=512, force=False, verbose=False):
+
+    encs = {'gzip': lambda d: gzip.compress(d, 9, mtime=0)}
+    if brotli:
+        encs['br'] = lambda d: brotli.compress(d, quality=11)
+
+    written = []
+    for path, dirs, files in os.walk(root):
+        for f in files:
+            fp = os.path.join(path, f)
+            if not isCompressible(fp) or minsize > os.path.getsize(fp):
+                continue
+
+            data = None
+            for enc, fn in encs.items():
+                zp = fp + ENCODING_EXTS[enc]
+                if not force and os.path.isfile(zp) and os.path.getmtime(zp) >= os.path.getmtime(fp):
+                    continue
+
+                if data is None:
+                    with open(fp, 'rb') as fh:
+                        data = fh.read()
+
+                z = fn(data)
+                if len(z) >= len(data):
+                    continue
+
+                with open(zp, 'wb') as fh:
+                    fh.write(z)
+                written.append(zp)
+
+                if verbose:
+                    Log(f'{zp} : {len(data)} -> {len(z)}')
+
+    return written
+
+
+def main():
+    if 2 > len(sys.argv):
+        Log(f'Usage: python3 -m webshoes.precompress <folder> [<folder> ...]')
+        return 1
+    for v in sys.argv[1:]:
+        precompress(v, verbose=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
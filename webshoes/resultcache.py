@@ -0,0 +1,139 @@
+
+import json
+import time
+import asyncio
+import threading
+import collections
+
+
+''' Returns a cache key for a command and its parameters
+    @param [in] p       - Command or http path
+    @param [in] q       - Parameters, as decoded
+    @param [in] skip    - Set of parameter names to leave out
+
+    The same parameters give the same key whatever order they came in.
+'''
+def cacheKey(p, q, skip=frozenset()):
+    if skip and isinstance(q, dict) and not skip.isdisjoint(q.keys()):
+        q = {k: v for k, v in q.items() if k not in skip}
+    return p + '\n' + json.dumps(q, sort_keys=True, separators=(',', ':'), default=str)
+
+
+''' class ResultCache
+
+    Results of a handler, keyed by command and parameters.  Entries
+    expire after 'ttl' seconds and the least recently used are dropped
+    past 'maxsize'.  Concurrent misses for the same key share a single
+    call to the handler.
+
+    Only dict results are kept, anything else is passed through.
+    Lookups happen on the server loop, clear() may be called from
+    any thread.
+
+'''
+class ResultCache():
+
+    ''' Constructor
+        @param [in] ttl     - Seconds an entry is good for, 0 for until cleared
+        @param [in] maxsize - Maximum number of entries
+        @param [in] events  - Names of events that clear the cache when triggered
+    '''
+    def __init__(self, ttl=0, maxsize=1024, events=()):
+        self.ttl = ttl
+        self.maxsize = max(1, maxsize)
+        self.events = (events,) if isinstance(events, str) else tuple(events)
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # Bumped by clear(), so calls already running don't store stale
+        # results or hand them to callers that arrive after the clear
+        self.gen = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    ''' Returns the cached result for a key, calling fn() to make it if needed
+        @param [in] key     - Cache key, see cacheKey()
+        @param [in] fn      - Coroutine function that returns the result
+
+        Only dict results are kept or handed to concurrent callers.  If
+        fn() returns anything else, i.e. a generator, the callers that
+        were waiting on it call fn() themselves.
+    '''
+    async def get(self, key, fn):
+
+        while True:
+            # clear() may swap the dict from another thread
+            entries = self.entries
+            e = entries.get(key)
+            if e:
+                if not self.ttl or time.monotonic() < e[0]:
+                    self.hits += 1
+                    entries.move_to_end(key)
+                    return e[1]
+                entries.pop(key, None)
+
+            # Someone is already working on it, since the last clear()
+            f = self.pending.get((key, self.gen))
+            if not f:
+                break
+            try:
+                r = await asyncio.shield(f)
+            except asyncio.CancelledError:
+                # The caller that was making it went away, try again
+                if not f.cancelled():
+                    raise
+                continue
+
+            # Not something that can be shared
+            if r is None:
+                self.misses += 1
+                return await fn()
+            self.hits += 1
+            return r
+
+        self.misses += 1
+        gen = self.gen
+        f = self.pending[(key, gen)] = asyncio.get_running_loop().create_future()
+        try:
+            r = await fn()
+        except asyncio.CancelledError:
+            f.cancel()
+            raise
+        except BaseException as e:
+            f.set_exception(e)
+            f.exception()
+            raise
+        finally:
+            if self.pending.get((key, gen)) is f:
+                del self.pending[(key, gen)]
+
+        if type(r) is not dict:
+            f.set_result(None)
+            return r
+
+        self.put(key, r, gen)
+        f.set_result(r)
+        return r
+
+    ''' Adds an entry, dropping the least recently used ones to make room
+        @param [in] key     - Cache key
+        @param [in] r       - Result
+        @param [in] gen     - Value of self.gen when the call started
+    '''
+    def put(self, key, r, gen):
+        with self.lock:
+            if gen != self.gen:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, r)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    ''' Removes all entries
+    '''
+    def clear(self):
+        with self.lock:
+            self.gen += 1
+            self.entries = collections.OrderedDict()
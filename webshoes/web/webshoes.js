@@ -6,6 +6,17 @@
                             uid         : Random id, autogenerated if not proided
                             cb          : Callback for warnings and errors
                             reconnect   : Reconnect delay in milliseconds
+                            evtbatch    : Set to true to receive events triggered
+                                          together as a single frame
+                            evtdelta    : Set to true to receive event updates as
+                                          patches against the previous version.
+                                          Event callbacks must not modify the
+                                          object they are passed.
+                            codec       : 'msgpack' or 'cbor' to have replies sent
+                                          as binary frames
+                            msgbatch    : Milliseconds to collect msg() calls into
+                                          one frame, 0 (default) batches calls made
+                                          together, false to send each right away
                         [out]
                             isOpen      : Set to true if connection is open, else false
                             msg         : Call to send message
@@ -14,6 +25,9 @@
                             xx          : Websocket
                             cbmap       : Callback map
                             evmap       : Events callback map
+                            evstate     : Latest version of each event
+                            iid         : Server instance the versions came from
+                            msgq        : Messages waiting to be sent as a batch
 */
 function WebShoes(opts)
 {
@@ -26,24 +40,62 @@ function WebShoes(opts)
     if (!opts.evmap)
         opts.evmap = {};
 
+    if (!opts.evstate)
+        opts.evstate = {};
+
     if (!opts.reconnect)
         opts.reconnect = 3000;
 
+    if (opts.msgbatch === undefined)
+        opts.msgbatch = 0;
+
+    // Fails the callbacks of queued messages that were never sent
+    opts._drop = (q) =>
+    {
+        for (let m of q)
+        {
+            let v = opts.cbmap[m.tid];
+            if (!v)
+                continue;
+            delete opts.cbmap[m.tid];
+            if (v.cb && (!v.id || opts._q(v.id)))
+                v.cb({'error': 'Not connected'}, v.msg);
+            if (v.end)
+                v.end('Not connected', v.msg);
+        }
+    };
+
+    // Anything still queued went with the old connection
+    if (opts.msgq)
+        opts._drop(opts.msgq);
+    opts.msgq = [];
+
     try
     {
-        let xx = new WebSocket(opts.url);
+        let url = opts.url;
+        if (opts.evtbatch)
+            url += (url.includes('?') ? '&' : '?') + 'evtbatch=1';
+        if (opts.evtdelta)
+            url += (url.includes('?') ? '&' : '?') + 'evtdelta=1';
+
+        // Binary frames if a codec was asked for, the server falls back to json
+        let xx = opts.codec ? new WebSocket(url, ['webshoes.' + opts.codec]) : new WebSocket(url);
+        xx.binaryType = 'arraybuffer';
 
         // Callback when ws connection is opened
         xx.onopen = ()=>
         {
             opts.isOpen = true;
 
-            // Rehook events
+            // Rehook events, letting the server know what we already have
             for (let k in opts.evmap)
                 for (let v of opts.evmap[k])
                 {   if (opts.cb)
                         opts.cb('rehook', v)
-                    opts.xx.send(JSON.stringify(v.msg));
+                    let msg = v.msg;
+                    if (opts.iid && opts.evstate[k])
+                        msg = Object.assign({}, msg, {ver: opts.evstate[k].ver, iid: opts.iid});
+                    opts.xx.send(JSON.stringify(msg));
                 }
 
             if (opts.cb)
@@ -71,50 +123,100 @@ function WebShoes(opts)
         {
             try
             {
-                let j = JSON.parse(msg.data);
-                if (j.error && opts.cb)
-                    opts.cb('error', j.error);
-                if (j.warning && opts.cb)
-                    opts.cb('warning', j.warning);
-
-                // See if there is a callback for this transaction id
-                if (j.tid && j.tid in opts.cbmap)
-                {
-                    let tid = j.tid;
-                    let v = opts.cbmap[tid];
+                // Batched frames hold an array of messages
+                let p = (msg.data instanceof ArrayBuffer)
+                        ? ('cbor' == opts.codec ? opts._cbor : opts._unpack)(msg.data)
+                        : JSON.parse(msg.data);
+                for (let j of (Array.isArray(p) ? p : [p]))
+                    opts._onmsg(j);
+            }
+            catch(e)
+            {   console.log(e);
+                if (opts.cb)
+                    opts.cb('error', e.message ? e.message : e);
+            }
+        };
+
+        // True if tid is from one of our event registrations
+        opts._isReg = (tid)=>
+        {
+            for (let k in opts.evmap)
+                for (let v of opts.evmap[k])
+                    if (v.msg.tid == tid)
+                        return true;
+            return false;
+        };
 
-                    // If callback and it's still valid
-                    if (j.r && v.cb)
-                        if (!v.id || opts._q(v.id))
-                            v.cb(j.r, v.msg);
+        // Handles a single message from the server
+        opts._onmsg = (j)=>
+        {
+            if (j.error && opts.cb)
+                opts.cb('error', j.error);
+            if (j.warning && opts.cb)
+                opts.cb('warning', j.warning);
+
+            // Event registrations say which server instance we're talking to,
+            // other replies may carry an iid of their own
+            if (j.r && j.r.iid && j.tid && opts._isReg(j.tid))
+                opts.iid = j.r.iid;
+
+            // See if there is a callback for this transaction id
+            if (j.tid && j.tid in opts.cbmap)
+            {
+                let tid = j.tid;
+                let v = opts.cbmap[tid];
+
+                // If callback and it's still valid
+                if (j.r && v.cb)
+                    if (!v.id || opts._q(v.id))
+                        v.cb(j.r, v.msg);
 
+                // Streams stay open until the end marker
+                if (!v.end)
                     delete opts.cbmap[tid];
+                else if (j.end || j.error)
+                {
+                    delete opts.cbmap[tid];
+                    v.end(j.error, v.msg);
                 }
+            }
 
-                // If it is an event, see if there is a matching event callback
-                else if (j.evt && j.evt in opts.evmap)
+            // If it is an event, see if there is a matching event callback
+            else if (j.evt && j.evt in opts.evmap)
+            {
+                // Apply deltas to the version we have
+                if (opts.evtdelta)
                 {
-                    // Filter invalid callbacks
-                    opts.evmap[j.evt] = opts.evmap[j.evt].filter(v=>v.cb && (!v.id || opts._q(v.id)));
-
-                    // For each callback entry
-                    for (let k in opts.evmap[j.evt])
+                    if (j.d)
                     {
-                        let v = opts.evmap[j.evt][k];
-
-                        if (!j.r)
-                            j.r = {};
-
-                        // Call callback
-                        v.cb(j.r, v.msg);
+                        // Missed a version, register again to get the whole thing
+                        let s = opts.evstate[j.evt];
+                        if (!s || s.ver != j.base)
+                        {
+                            delete opts.evstate[j.evt];
+                            if (opts.evmap[j.evt].length)
+                                opts.xx.send(JSON.stringify(opts.evmap[j.evt][0].msg));
+                            return;
+                        }
+                        j.r = opts._patch(s.r, j.d);
                     }
                 }
+                opts.evstate[j.evt] = {ver: j.ver, r: j.r};
 
-            }
-            catch(e)
-            {   console.log(e);
-                if (opts.cb)
-                    opts.cb('error', e.message ? e.message : e);
+                // Filter invalid callbacks
+                opts.evmap[j.evt] = opts.evmap[j.evt].filter(v=>v.cb && (!v.id || opts._q(v.id)));
+
+                // For each callback entry
+                for (let k in opts.evmap[j.evt])
+                {
+                    let v = opts.evmap[j.evt][k];
+
+                    if (!j.r)
+                        j.r = {};
+
+                    // Call callback
+                    v.cb(j.r, v.msg);
+                }
             }
         };
 
@@ -122,8 +224,11 @@ function WebShoes(opts)
             @param [in] id      - This should be a valid html element.  If the
                                   html element is not valid or does not exist,
                                   the callback will not be made.
+            @param [in] end     - For commands that stream their reply, cb is
+                                  called for each value and end(error) once
+                                  the stream is over
         */
-        xx.msg = (id, cmd, params, cb) =>
+        xx.msg = (id, cmd, params, cb, end) =>
         {
             if (!opts.isOpen && cb)
                 return cb({'error': 'Not connected'});
@@ -134,10 +239,24 @@ function WebShoes(opts)
             let msg = { uid: opts.uid, cmd: cmd, q: params, tid: tid, t: t };
 
             // Add callback
-            opts.cbmap[tid] = {id: id, cb: cb, msg: msg};
+            opts.cbmap[tid] = {id: id, cb: cb, msg: msg, end: end};
 
             // Send the message
-            opts.xx.send(JSON.stringify(msg));
+            if (opts.msgbatch === false)
+                return opts.xx.send(JSON.stringify(msg));
+
+            // Or queue it up with any others sent around the same time
+            opts.msgq.push(msg);
+            if (1 == opts.msgq.length)
+                setTimeout(()=>
+                {
+                    let q = opts.msgq;
+                    opts.msgq = [];
+                    if (!opts.isOpen)
+                        opts._drop(q);
+                    else if (q.length)
+                        opts.xx.send(JSON.stringify(1 == q.length ? q[0] : q));
+                }, opts.msgbatch);
         };
 
         xx.onEvent = (id, evt, params, cb) =>
@@ -171,6 +290,169 @@ function WebShoes(opts)
         // Call to get DOM item using selector
         opts._q = document.querySelector.bind(document);
 
+        // Applies patch operations from the server to a document, returns the result
+        opts._patch = (doc, ops) =>
+        {
+            let splice = (v, o) => v.slice(0, o.pos) + o.value + v.slice(o.pos + o.del);
+            for (let o of ops)
+            {
+                let keys = o.path.split('/').slice(1).map(k=>k.replace(/~1/g, '/').replace(/~0/g, '~'));
+
+                // Whole document
+                if (!keys.length)
+                {   doc = ('splice' == o.op) ? splice(doc, o) : o.value;
+                    continue;
+                }
+
+                // Find the parent
+                let p = doc;
+                for (let k of keys.slice(0, -1))
+                    p = p[k];
+                let k = keys[keys.length - 1];
+
+                if ('remove' == o.op)
+                {   if (Array.isArray(p))
+                        p.splice(k, 1);
+                    else
+                        delete p[k];
+                }
+                else if ('splice' == o.op)
+                    p[k] = splice(p[k], o);
+                else if ('add' == o.op && Array.isArray(p))
+                {   if ('-' == k)
+                        p.push(o.value);
+                    else
+                        p.splice(k, 0, o.value);
+                }
+                else
+                    p[k] = o.value;
+            }
+            return doc;
+        };
+
+        // Decodes a MessagePack frame
+        opts._unpack = (buf) =>
+        {
+            let v = new DataView(buf), p = 0, td = new TextDecoder();
+            let str = (n)=>{ let s = td.decode(new Uint8Array(buf, p, n)); p += n; return s; };
+            let bin = (n)=>{ let b = new Uint8Array(buf.slice(p, p + n)); p += n; return b; };
+            let arr = (n)=>{ let a = []; while (n--) a.push(rd()); return a; };
+            let map = (n)=>{ let o = {}; while (n--) { let k = rd(); o[k] = rd(); } return o; };
+            let num = (f, n)=>{ let r = v[f](p); p += n; return r; };
+            let rd = ()=>
+            {
+                let t = v.getUint8(p++);
+                if (t < 0x80) return t;
+                if (t < 0x90) return map(t & 0x0f);
+                if (t < 0xa0) return arr(t & 0x0f);
+                if (t < 0xc0) return str(t & 0x1f);
+                if (t >= 0xe0) return t - 0x100;
+                switch (t)
+                {
+                    case 0xc0: return null;
+                    case 0xc2: return false;
+                    case 0xc3: return true;
+                    case 0xc4: return bin(num('getUint8', 1));
+                    case 0xc5: return bin(num('getUint16', 2));
+                    case 0xc6: return bin(num('getUint32', 4));
+                    case 0xca: return num('getFloat32', 4);
+                    case 0xcb: return num('getFloat64', 8);
+                    case 0xcc: return num('getUint8', 1);
+                    case 0xcd: return num('getUint16', 2);
+                    case 0xce: return num('getUint32', 4);
+                    case 0xcf: return Number(num('getBigUint64', 8));
+                    case 0xd0: return num('getInt8', 1);
+                    case 0xd1: return num('getInt16', 2);
+                    case 0xd2: return num('getInt32', 4);
+                    case 0xd3: return Number(num('getBigInt64', 8));
+                    case 0xd9: return str(num('getUint8', 1));
+                    case 0xda: return str(num('getUint16', 2));
+                    case 0xdb: return str(num('getUint32', 4));
+                    case 0xdc: return arr(num('getUint16', 2));
+                    case 0xdd: return arr(num('getUint32', 4));
+                    case 0xde: return map(num('getUint16', 2));
+                    case 0xdf: return map(num('getUint32', 4));
+                }
+                throw new Error(`Unsupported msgpack type ${t}`);
+            };
+            return rd();
+        };
+
+        // Decodes a CBOR frame
+        opts._cbor = (buf) =>
+        {
+            let v = new DataView(buf), p = 0, td = new TextDecoder(), brk = {};
+            let num = (f, n)=>{ let r = v[f](p); p += n; return r; };
+            let len = (ai)=>
+            {
+                if (ai < 24) return ai;
+                switch (ai)
+                {
+                    case 24: return num('getUint8', 1);
+                    case 25: return num('getUint16', 2);
+                    case 26: return num('getUint32', 4);
+                    case 27: return Number(num('getBigUint64', 8));
+                    case 31: return -1;
+                }
+                throw new Error(`Unsupported cbor length ${ai}`);
+            };
+            let half = (h)=>
+            {
+                let e = (h >> 10) & 0x1f, m = h & 0x3ff, s = (h & 0x8000) ? -1 : 1;
+                if (31 == e) return m ? NaN : s * Infinity;
+                return s * (e ? Math.pow(2, e - 15) * (1 + m / 1024) : Math.pow(2, -14) * (m / 1024));
+            };
+            let rd = ()=>
+            {
+                let b = v.getUint8(p++), mt = b >> 5, ai = b & 0x1f;
+                if (7 == mt)
+                    switch (ai)
+                    {
+                        case 20: return false;
+                        case 21: return true;
+                        case 22: return null;
+                        case 23: return undefined;
+                        case 25: return half(num('getUint16', 2));
+                        case 26: return num('getFloat32', 4);
+                        case 27: return num('getFloat64', 8);
+                        case 31: return brk;
+                        default: throw new Error(`Unsupported cbor value ${ai}`);
+                    }
+
+                let n = len(ai), r, x;
+                switch (mt)
+                {
+                    case 0: return n;
+                    case 1: return -1 - n;
+                    case 2:
+                    case 3:
+                        // Indefinite length strings come in chunks
+                        if (0 > n)
+                        {   r = [];
+                            while (brk !== (x = rd()))
+                                r.push(x);
+                            return 3 == mt ? r.join('') : new Uint8Array(r.reduce((a, c)=>a.concat(Array.from(c)), []));
+                        }
+                        r = new Uint8Array(buf, p, n); p += n;
+                        return 3 == mt ? td.decode(r) : r.slice();
+                    case 4:
+                        r = [];
+                        while (n-- && brk !== (x = rd()))
+                            r.push(x);
+                        return r;
+                    case 5:
+                        r = {};
+                        while (n-- && brk !== (x = rd()))
+                            r[x] = rd();
+                        return r;
+                    case 6:
+                        // Tags aren't interpreted, just the value
+                        return rd();
+                }
+            };
+            return rd();
+        };
+
         // Adds a unique div to the specified DOM element and retuns the id selector
         opts.addPageId = (id) =>
         {   let div = opts._q(id);
@@ -1,32 +1,120 @@
 
 import os
+import zlib
+import gzip
 import time
 import json
 import inspect
+import functools
 import random
+import signal
+import socket
 import threading
 import aiohttp
 from aiohttp import web, WSCloseCode
 import asyncio
-import mimetypes
+import multiprocessing
+import concurrent.futures
 
 import threadmsg as tm
 import propertybag as pb
 
+from . wsconn import WsConn
+from . events import Event, EventSub, EventLimit
+from . import delta
+from . import codec
+from . params import Params, Context
+from . filecache import FileCache, acceptEncodings, offload
+from . resultcache import ResultCache, cacheKey
+from . bus import WorkerHub, WorkerBus, getEventBus
+from . metrics import Metrics, metricsJson, metricsPrometheus
+from . hooks import HandlerCall, DispatchHook, SlowCallHook, ProfileHook, MallocHook, profileCoro, profileCall
+
 try:
     import sparen
     Log = sparen.log
 except Exception as e:
     Log = print
 
+''' Returns a copy of v with property bags turned into plain dicts
+    @param [in] v   - Value to convert
+'''
+def plainData(v):
+    if isinstance(v, (pb.Bag, Params)):
+        v = v.as_dict()
+    if isinstance(v, dict):
+        return {k: plainData(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [plainData(x) for x in v]
+    return v
+
+
+''' Runs a handler in a worker process
+    @param [in] f       - Handler function, must be importable by the worker
+    @param [in] ctx     - Context, plain dict
+    @param [in] q       - Parameters, plain dict
+    @param [in] wrap    - How to pass ctx and q, see WebShoesApp.register()
+'''
+def runProcessHandler(f, ctx, q, wrap='bag'):
+    if 'bag' == wrap:
+        return plainData(f(pb.Bag(ctx), pb.Bag(q)))
+    return plainData(f(Params(ctx), q if 'raw' == wrap else Params(q)))
+
+
 class WebShoesApp():
 
+    # Ways a handler can be run
+    RUN_POLICIES = ('inline', 'thread', 'process')
+
+    # Ways handler arguments can be passed
+    WRAP_MODES = ('bag', 'light', 'raw')
+
+    # Websocket message fields that aren't parameters
+    MSG_KEYS = frozenset(('tid', 't', 'uid'))
+
 
     ''' Constructor
         @param [in] addr    - Address to listen on
         @param [in] port    - Port to listen on
         @param [in] opts    - Options, passed to callbacks in ctx.opts
-                                verbose = True for verbose console messages
+                                verbose     = True for verbose console messages
+                                evtnouid    = True to leave the subscriber uid out of event
+                                              messages, so every subscriber shares one frame
+                                sendhwm     = Per connection send buffer high-water mark in bytes
+                                sendpolicy  = What to do with a connection over the high-water mark,
+                                              'coalesce', 'drop' or 'disconnect', see WsConn
+                                sendtimeout = Seconds a send may stall before the connection is dropped
+                                evthistory  = Number of recent versions kept per event, so a client
+                                              resubscribing after a reconnect only gets what it missed
+                                runpolicy   = Default policy for plain (non async) handlers, see register()
+                                threadpool  = Number of threads for 'thread' handlers
+                                processpool = Number of processes for 'process' handlers
+                                wsinflight  = Maximum commands in progress per websocket connection
+                                jsoncodec   = 'orjson', 'ujson' or 'json', defaults to the fastest installed
+                                wscodecs    = Binary codecs websocket clients may ask for, defaults to
+                                              all installed, i.e. ['msgpack', 'cbor'], see codec.py
+                                filecache   = Bytes of static files to keep in memory, 0 to disable
+                                filecachemax= Largest static file to keep in memory
+                                filecheck   = Seconds between checking cached files for changes
+                                fileminzip  = Smallest cached static file to gzip on the fly, 0 to never
+                                httpzipmin  = Smallest json reply to compress for clients that accept
+                                              gzip or deflate, 0 to never
+                                httpziplevel= Compression level for json replies, 1 - 9
+                                wscompress  = False to turn off websocket permessage-deflate
+                                wsziplevel  = Compression level for websocket frames, 1 - 9
+                                wszipbits   = Largest compression window for websocket frames, 9 - 15
+                                wszipmin    = Websocket frames smaller than this are sent uncompressed
+                                workers     = Number of worker processes sharing the port, see start()
+                                metrics     = False to turn off the counters in self.metrics, see metrics.py
+                                eventbus    = Bus shared with other servers, so triggered events
+                                              reach all their subscribers too, i.e.
+                                              'redis://host:6379/0?channel=name', see bus.py
+
+        The options used on every message, verbose, evtnouid, evthistory,
+        runpolicy, wszipmin, httpzipmin and httpziplevel, are read here
+        once, along with the ones that set up the server, i.e. jsoncodec,
+        filecache and eventbus.  Changing them in self.opts afterwards has
+        no effect.
     '''
     def __init__(self, addr, port, opts={}):
 
@@ -34,28 +122,118 @@ class WebShoesApp():
         self.port = port
         self.opts = pb.Bag(opts)
 
+        # Read once, a missing key is expensive to look up in a property bag
+        self.verbose = self.opts.get('verbose', False)
+        self.wsZipMin = self.opts.get('wszipmin', 128)
+        self.evtNoUid = self.opts.get('evtnouid', False)
+        self.evtHistory = max(2, self.opts.get('evthistory', 8))
+        self.runPolicy = self.opts.get('runpolicy', 'thread')
+        self.httpZipMin = self.opts.get('httpzipmin', 1024)
+        self.httpZipLevel = self.opts.get('httpziplevel', 6)
+
         self.thread = None
         self.ws = None
+        self.server = None
+        self.runner = None
+        self.site = None
         self.handlers = {}
-        self.evh = pb.Bag()
+        self.routes = {}
+        self.evtRoutes = {}
+        self.evh = {}
+        self.uidEvents = {}
+        self.evLimits = {}
+        self.cacheEvents = {}
+        self.pools = {}
+
+        # Dispatch hooks, see addHook()
+        self.hooks = []
+
+        # Counters, see metrics.py
+        self.metrics = Metrics() if self.opts.get('metrics', True) else None
+
+        # Worker processes, see start()
+        self.bus = None
+        self.worker = None
+        self.workers = []
+        self.workerSocks = None
+        self.hubSock = None
+
+        # Message encoding
+        self.json = codec.getJsonCodec(self.opts.get('jsoncodec', None))
+        self.wsCodecs = codec.getBinaryCodecs(self.opts.get('wscodecs', None))
+
+        # Event bus shared with other servers, set before start() to use your own
+        url = self.opts.get('eventbus', None)
+        self.eventBus = getEventBus(url, self.json) if url else None
+
+        # Static files served by serveFolder()
+        self.fileCache = FileCache(self.opts.get('filecache', 32*1024*1024),
+                                   self.opts.get('filecachemax', 1024*1024),
+                                   self.opts.get('filecheck', 1),
+                                   self.opts.get('fileminzip', 512))
+
+        # Identifies this server instance, event versions only mean something to it
+        self.iid = ''.join(random.choice('0123456789abcdef') for i in range(16))
 
         # Setup thread and function broker
         self.thread = tm.ThreadMsg(self.msgThread, start=False)
         self.thread.setDefaultFunctionKey('_funName')
         self.callMap = {
-            'triggerEventSync': self.triggerEventSync
+            'triggerEventSync': self.triggerEventSync,
+            'triggerEventsSync': self.triggerEventsSync
         }
 
 
     ''' Register request handler
         @param [in] sub     - Sub path for http requests, can be * for any
-        @param [in] cmd     - Name of parameter in websocket requests containing command
+        @param [in] cmd     - Name of parameter in websocket requests containing command,
+                                i.e. 'sub/add', or just 'add' if no other group using
+                                the same parameter name has an 'add'
         @param [in] q       - Name of parameter in websocket requests containing paraameters
                                 If this is '', then the top level object contains parameters
         @param [in] evt     - Name of parameter containing event name
         @param [in] rep     - Name of parameter in reply that should contain reply object
                                 If this is '', then the top level object will contain reply values
         @param [fm] fm      - The function map
+        @param [in] run     - How plain (non async) handlers are run, either one policy
+                              for the group or a dict of function name to policy, with
+                              '*' for the rest.  If not given, opts.runpolicy is used,
+                              which defaults to 'thread'.
+                                inline  = Called on the event loop, use for quick functions
+                                          or ones that must touch the loop
+                                thread  = Called in a thread pool so the loop keeps running
+                                process = Called in a process pool, for cpu bound work.
+                                          The function must be importable by the worker and
+                                          ctx only contains p and opts, as plain dicts.
+
+                              Async handlers always run on the event loop.
+        @param [in] ordered - If True, websocket commands for this group are handled one
+                              at a time per connection, in the order they arrive.
+                              Otherwise they run concurrently and replies may come
+                              back out of order.
+        @param [in] wrap    - How ctx and q are passed to the handlers
+                                bag     = Property bags (default)
+                                light   = Context and Params from params.py, q.a style access
+                                          like a property bag, but much cheaper for small
+                                          commands.  Missing keys read as None.
+                                raw     = Context, and q as the decoded dict
+        @param [in] cache   - Cache handler results, for functions that always give the same
+                              answer for the same parameters.  Either one setting for the
+                              group or a dict of function name to setting, with '*' for the
+                              rest.  A setting is True, a number of seconds to keep results,
+                              or a dict of
+                                ttl     = Seconds to keep results, 0 to keep them until cleared
+                                max     = Maximum number of results to keep, default 1024
+                                events  = Event names, triggering any of them clears the cache
+
+                              Results are keyed by the command and its parameters, and only
+                              dict replies are cached.  Concurrent calls with the same
+                              parameters share one handler call.  Generator handlers
+                              are never cached.  See also invalidateCache().
+
+        Handlers that are generators or async generators stream what they yield,
+        as newline delimited json over http, or one websocket frame per value
+        followed by an end marker.  See streamHttp() and streamWs().
 
         @begincode
 
@@ -103,34 +281,450 @@ class WebShoesApp():
         @endcode
 
     '''
-    def register(self, sub, cmd, q, evt, rep, fm):
-        self.handlers[sub] = {'sub':sub, 'cmd':cmd, 'q':q, 'evt':evt, 'rep':rep, 'fm':fm}
+    def register(self, sub, cmd, q, evt, rep, fm, run=None, ordered=False, wrap='bag', cache=None):
+        for v in (run.values() if isinstance(run, dict) else [run]):
+            if v and v not in self.RUN_POLICIES:
+                raise Exception(f'Invalid run policy: {v}')
+        if wrap not in self.WRAP_MODES:
+            raise Exception(f'Invalid wrap mode: {wrap}')
+        self.handlers[sub] = {'sub':sub, 'cmd':cmd, 'q':q, 'evt':evt, 'rep':rep, 'fm':fm,
+                              'run':run, 'ordered':ordered, 'wrap':wrap,
+                              'caches':self.makeCaches(fm, cache), 'stats':{}}
+        self.buildRoutes()
+
+
+    ''' Returns the result caches for a function map, by function name
+        @param [in] fm      - The function map
+        @param [in] cache   - Cache setting, see register()
+    '''
+    @staticmethod
+    def makeCaches(fm, cache):
+
+        if not cache:
+            return {}
+
+        # One setting for the whole group
+        if not isinstance(cache, dict) or {'ttl', 'max', 'events'} & cache.keys():
+            cache = {'*': cache}
+
+        caches = {}
+        for k, f in fm.items():
+            c = cache.get(k) or cache.get('*')
+            if not c or not callable(f):
+                continue
+
+            # Streams can't be shared or replayed
+            if inspect.isgeneratorfunction(f) or inspect.isasyncgenfunction(f):
+                if k in cache:
+                    raise Exception(f'Generator handlers can not be cached: {k}')
+                continue
+
+            if True is c:
+                c = {}
+            elif not isinstance(c, dict):
+                c = {'ttl': c}
+            caches[k] = ResultCache(c.get('ttl', 0), c.get('max', 1024), c.get('events', ()))
+        return caches
 
 
     ''' Unregister the specified request handler
         @param [in] sub     - Sub name to unregister
     '''
     def unregister(self, sub):
-        if p in self.handlers:
+        if sub in self.handlers:
             del self.handlers[sub]
+            self.buildRoutes()
+
+
+    ''' Rebuilds the dispatch index from the registered handlers
+
+        self.routes maps the websocket command parameter name to
+            sub     - Handler groups by sub name
+            fn      - Handler groups by function name, for commands
+                      that are not prefixed with the sub name
+
+        self.evtRoutes maps the websocket event parameter name to
+        the handler group that owns it.
+
+        Where names collide, the first registered group wins.
+
+        self.cacheEvents maps event names to the result caches they clear.
+    '''
+    def buildRoutes(self):
+        routes = {}
+        evtRoutes = {}
+        cacheEvents = {}
+        for sub, h in self.handlers.items():
+            for c in h['caches'].values():
+                for ev in c.events:
+                    cacheEvents.setdefault(ev, []).append(c)
+            if h['cmd']:
+                r = routes.setdefault(h['cmd'], {'sub': {}, 'fn': {}})
+                r['sub'].setdefault(sub, h)
+
+                # A name in more than one group needs the group/function form
+                for k in h['fm'].keys():
+                    r['fn'][k] = h if r['fn'].get(k, h) is h else None
+            if h['evt']:
+                evtRoutes.setdefault(h['evt'], h)
+
+        # Swap in whole so lookups never see a partial index
+        self.routes = routes
+        self.evtRoutes = evtRoutes
+        self.cacheEvents = cacheEvents
+
+
+    ''' Find the handler group and function name for a path
+        @param [in] p       - List of path components
+        @param [in] groups  - Map of sub names to handler groups
+        @param [in] fns     - Map of function names to handler groups,
+                                used for single component paths, or None.
+                                Names in more than one group map to None.
+
+        Returns a tuple of (handler group, function name)
+    '''
+    @staticmethod
+    def findRoute(p, groups, fns=None):
+
+        # Function name without sub path
+        if fns is not None and 1 == len(p):
+            fn = p[0] if p[0] in fns else '*'
+            if fn not in fns:
+                raise Exception(f'No handler for {p[0]}')
+            if not fns[fn]:
+                raise Exception(f'More than one group has a handler for {p[0]}, use group/{p[0]}')
+            return fns[fn], fn
+
+        if 0 >= len(p):
+            p = ['*']
+
+        if 1 == len(p):
+            p = [p[0], '*']
+
+        # Find handler group
+        h = groups.get(p[0]) or groups.get('*')
+        if not h:
+            raise Exception(f'No handler group for {"/".join(p)}')
+
+        # Find handler
+        if p[1] in h['fm']:
+            return h, p[1]
+        if '*' in h['fm']:
+            return h, '*'
+        raise Exception(f'No handler for {"/".join(p)}')
+
+
+    ''' Returns the executor for a run policy, creating it on first use
+        @param [in] run     - 'thread' or 'process'
+    '''
+    def getPool(self, run):
+        pool = self.pools.get(run)
+        if not pool:
+            if 'process' == run:
+                pool = concurrent.futures.ProcessPoolExecutor(self.opts.get('processpool', None))
+            else:
+                pool = concurrent.futures.ThreadPoolExecutor(self.opts.get('threadpool', None),
+                                                             thread_name_prefix='webshoes')
+            self.pools[run] = pool
+        return pool
+
+
+    ''' Call a user handler according to its run policy
+        @param [in] h       - Handler group
+        @param [in] fn      - Function name within the group
+        @param [in] f       - Handler function
+        @param [in] p       - Command or http path
+        @param [in] req     - Request object
+        @param [in] q       - Parameters for the handler, as decoded
+        @param [in] ws      - Websocket, None for http requests
+
+        If the function has a result cache, see register(), the handler is
+        only called on a miss.
+
+        Generator and async generator handlers stream their results, they
+        come back as an async generator, see streamHttp() and streamWs().
+        Plain generators are stepped in a thread unless the run policy is
+        'inline', they can't be run in another process.
+
+        Counts, errors and latency go in self.metrics, by 'sub/function',
+        and the call is passed through the hooks, see addHook().
+    '''
+    async def callHandler(self, h, fn, f, p, req, q, ws=None):
+
+        m = self.metrics
+        if m:
+            s = h['stats'].get(fn)
+            if not s:
+                s = h['stats'][fn] = m.command(f"{h['sub']}/{fn}")
+            s.inflight += 1
+            t = time.perf_counter_ns()
+
+        hooks = self.hooks
+        call = None
+
+        try:
+            # A failing hook is logged, it doesn't fail the handler
+            if hooks:
+                call = HandlerCall(h['sub'], fn, p, q, req, ws)
+                for v in hooks:
+                    try:
+                        v.pre(call)
+                    except Exception as e:
+                        Log(e)
+
+            c = h['caches'].get(fn)
+            if not c:
+                return await self.runHandler(h, fn, f, p, req, q, ws, call)
+            return await self.cachedHandler(c, h, fn, f, p, req, q, ws, call)
+
+        except Exception as e:
+            if m:
+                s.errors += 1
+            if call:
+                call.error = e
+            raise
+
+        finally:
+            if m:
+                s.inflight -= 1
+                s.hist.add((time.perf_counter_ns() - t) // 1000)
+            if call:
+                call.elapsed = time.perf_counter() - call.start
+                for v in reversed(hooks):
+                    try:
+                        v.post(call)
+                    except Exception as e:
+                        Log(e)
+
+
+    ''' Call a user handler through its result cache, see callHandler()
+        @param [in] c       - ResultCache for the function
+    '''
+    async def cachedHandler(self, c, h, fn, f, p, req, q, ws=None, call=None):
+
+        async def make():
+            r = await self.runHandler(h, fn, f, p, req, q, ws, call)
+            return plainData(r) if isinstance(r, (pb.Bag, Params)) else r
+
+        # If the whole message is the params, leave out the parts that change every time
+        skip = self.MSG_KEYS if ws is not None and isinstance(q, dict) and q.get(h['cmd']) == p else ()
+
+        # Copied, since the reply gets a tid added to it
+        r = await c.get(cacheKey(p, q, skip), make)
+        return dict(r) if type(r) is dict else r
+
+
+    ''' Adds a hook that sees every handler call, see hooks.py
+        @param [in] hook    - DispatchHook, i.e. SlowCallHook or ProfileHook
+
+        Hooks are called in the order they were added before the handler,
+        and in reverse order after it.
+    '''
+    def addHook(self, hook):
+        self.hooks = self.hooks + [hook]
+
+
+    ''' Removes a hook added with addHook()
+        @param [in] hook    - DispatchHook
+    '''
+    def removeHook(self, hook):
+        self.hooks = [v for v in self.hooks if v is not hook]
+
+
+    ''' Call a user handler according to its run policy, see callHandler()
+        @param [in] call    - HandlerCall if there are hooks, it may ask
+                              for the handler to be profiled
+    '''
+    async def runHandler(self, h, fn, f, p, req, q, ws=None, call=None):
+
+        run = h['run']
+        if isinstance(run, dict):
+            run = run.get(fn) or run.get('*')
+        if not run:
+            run = self.runPolicy
+
+        wrap = h['wrap']
+        coro = inspect.iscoroutinefunction(f) or inspect.isasyncgenfunction(f)
+
+        # A generator can't come back from another process
+        if 'process' == run and not coro and inspect.isgeneratorfunction(f):
+            run = 'thread'
+
+        if 'process' == run and not coro:
+            c = {'p': p, 'opts': plainData(self.opts)}
+            r = await asyncio.get_running_loop().run_in_executor(
+                        self.getPool(run), runProcessHandler, f, c, plainData(q), wrap)
+            return r
+
+        # Context for user functions
+        if 'bag' == wrap:
+            ctx = {'p': p, 'req': req, 'opts': self.opts, 'wsa': self}
+            if ws is not None:
+                ctx['ws'] = ws
+            ctx = pb.Bag(ctx)
+            q = pb.Bag(q)
+        else:
+            ctx = Context(p, req, self.opts, self, ws)
+            if 'light' == wrap:
+                q = Params(q)
+
+        # Profile in whatever thread it runs in
+        prof = call.profile if call else None
+        if prof:
+            if inspect.iscoroutinefunction(f):
+                return await profileCoro(prof, f(ctx, q))
+            if not coro:
+                f = functools.partial(profileCall, prof, f)
+
+        # Async handlers and inline functions are called right here
+        if 'inline' == run or coro:
+            r = f(ctx, q)
+
+        else:
+            r = await asyncio.get_running_loop().run_in_executor(self.getPool(run), f, ctx, q)
+
+        if type(r) is not dict:
+            if inspect.isawaitable(r):
+                r = await r
+            elif inspect.isgenerator(r):
+                r = self.stepGenerator(r, None if 'inline' == run else self.getPool('thread'))
+        return r
+
+
+    ''' Iterates a plain generator from the event loop
+        @param [in] g       - Generator
+        @param [in] pool    - Executor to step it in, None to step it on the loop
+        @param [in] wait    - Seconds to keep collecting values in the executor
+                              before handing them over
+
+        Values are handed over from the executor a batch at a time, so a
+        fast generator doesn't pay for a thread hop per value.
+    '''
+    @staticmethod
+    async def stepGenerator(g, pool=None, wait=0.01):
+
+        try:
+            if not pool:
+                for v in g:
+                    yield v
+                return
+
+            def step():
+                vs = []
+                t = time.monotonic()
+                for v in g:
+                    vs.append(v)
+                    if 256 <= len(vs) or wait <= time.monotonic() - t:
+                        return vs, False
+                return vs, True
+
+            loop = asyncio.get_running_loop()
+            end = False
+            while not end:
+                vs, end = await loop.run_in_executor(pool, step)
+                for v in vs:
+                    yield v
+
+        finally:
+            # Still running in the executor if we were cancelled
+            try:
+                g.close()
+            except ValueError:
+                pass
+
+
+    ''' Applies the websocket compression options to a connection
+        @param [in] ws      - Websocket, after the handshake
+
+        aiohttp doesn't take a level or window size, so the compressor
+        is swapped for one that uses opts.wsziplevel and opts.wszipbits.
+        A smaller window than the one negotiated is always fine for the
+        client to inflate.  Without a compatible aiohttp, its defaults
+        are used.
+    '''
+    def setupWsCompression(self, ws):
+        w = getattr(ws, '_writer', None)
+        if not w or not getattr(w, 'compress', 0):
+            return
+
+        # The negotiated window, for sendMsg() to restore
+        w.wsaCompress = w.compress
+
+        # sendMsg() switches compression per frame, so sends take turns
+        w.wsaLock = asyncio.Lock()
+
+        level = self.opts.get('wsziplevel', None)
+        bits = self.opts.get('wszipbits', None)
+        if level or bits:
+            try:
+                from aiohttp.compression_utils import ZLibCompressor
+                w._compressobj = ZLibCompressor(level=level or 1,
+                                                wbits=-min(bits or w.compress, w.compress),
+                                                max_sync_chunk_size=16384)
+            except Exception as e:
+                Log(e)
+
+
+    ''' Compress an http reply body if the client accepts it
+        @param [in] req     - Request object
+        @param [in] body    - Reply body
+
+        Returns the body and its content encoding, None if not compressed
+    '''
+    async def compressBody(self, req, body):
+
+        accept = acceptEncodings(req)
+        enc = 'gzip' if 'gzip' in accept else 'deflate' if 'deflate' in accept else None
+        if not enc:
+            return body, None
+
+        if 'gzip' == enc:
+            fn = lambda: gzip.compress(body, self.httpZipLevel, mtime=0)
+        else:
+            fn = lambda: zlib.compress(body, self.httpZipLevel)
+
+        # Keep big ones off the event loop
+        return await offload(len(body), fn), enc
 
 
     ''' Send message to socket
         @param [in] ws      - Websocket overwhich to send the message
         @param [in] msg     - Message to send
+        @param [in] bc      - Binary codec the client asked for, or None
+
+        Strings are sent as they are, i.e. pre-encoded json events.
     '''
-    async def sendMsg(self, ws, msg):
+    async def sendMsg(self, ws, msg, bc=None):
 
-        if self.opts.verbose:
+        if self.verbose:
             Log(f"Sending --> {msg}")
 
         try:
             if isinstance(msg, pb.Bag):
-                await ws.send_str(msg.toJson())
-            elif isinstance(msg, dict) or isinstance(msg, list):
-                await ws.send_str(json.dumps(msg))
+                msg = msg.as_dict()
+            if isinstance(msg, dict) or isinstance(msg, list):
+                if bc:
+                    msg = bc.dumps(msg)
+                else:
+                    msg = self.json.dumps(msg)
+
+                # Replies, events come pre-encoded and are counted when queued
+                if self.metrics:
+                    self.metrics.wsBytes += len(msg)
+
+            # Small frames aren't worth compressing, see setupWsCompression().
+            # The writer is shared by every task sending on the connection,
+            # so nothing else may send until it's switched back.
+            w = getattr(ws, '_writer', None)
+            if w and getattr(w, 'wsaCompress', 0):
+                async with w.wsaLock:
+                    w.compress = 0 if len(msg) < self.wsZipMin else w.wsaCompress
+                    try:
+                        await (ws.send_bytes(msg) if isinstance(msg, bytes) else ws.send_str(msg))
+                    finally:
+                        w.compress = w.wsaCompress
             else:
-                await ws.send_str(msg)
+                await (ws.send_bytes(msg) if isinstance(msg, bytes) else ws.send_str(msg))
         except Exception as e:
             Log(e)
             return False
@@ -139,60 +733,322 @@ class WebShoesApp():
 
 
     '''
-        @param [in] ev  - Event to register
-        @param [in] uid - Unique id for event handler
-        @param [in] ws  - Websocket over which to send events
+        @param [in] ev      - Event to register
+        @param [in] uid     - Unique id for event handler
+        @param [in] conn    - WsConn over which to send events
+        @param [in] ver     - Version the subscriber already has, 0 for none
+
+        A subscriber that already has the current version isn't sent it
+        again, one that has a version still in the event history can be
+        sent a delta if the connection supports it.
     '''
-    async def addEventHanlder(self, ev, uid, ws):
+    async def addEventHanlder(self, ev, uid, conn, ver=0):
 
-        if self.opts.verbose:
+        if self.verbose:
             Log(f'Registering: {ev} -> {uid}')
 
         # Add the event if it doesn't exist yet
-        if ev not in self.evh:
-            self.evh[ev] = {'evt': ev, 'cb':{}, 'ver': 0}
+        e = self.evh.get(ev)
+        if not e:
+            e = self.evh[ev] = Event(ev)
+
+        # Only trust versions we can still account for
+        if ver != e.ver and ver not in e.hist:
+            ver = 0
 
         # Adding new handler
-        if uid not in self.evh[ev]['cb']:
-            self.evh[ev]['cb'][uid] = {'uid': uid, 'ws': ws, 'ver': 0, 'last': {}}
+        sub = e.subs.get(uid)
+        if not sub:
+            sub = e.subs[uid] = EventSub(uid, json.dumps(uid), conn)
+            self.uidEvents.setdefault(uid, set()).add(ev)
 
-        # Just mark existing handler as out of date
+        # Existing handler may be on a new connection
         else:
-            self.evh[ev]['cb'][uid]['ver'] = 0
+            sub.conn = conn
+
+        sub.ver = ver
+
+
+    ''' Encode the part of an event message shared by all subscribers
+        @param [in] e   - Event record
+        @param [in] t   - Message timestamp
+
+        The payload is serialized once per version and cached in the event
+        record, along with the last few versions in e.hist.  The returned
+        string is missing the closing brace so the subscriber uid can be
+        spliced onto the end.
+    '''
+    def encodeEvent(self, e, t):
+
+        ver = e.ver
+        if e.rver != ver:
+            r = e.last if e.last is not None else {}
+            if isinstance(r, pb.Bag):
+                r = r.as_dict()
+            e.rjs = self.json.dumps(r)
+            e.rver = ver
+
+            # Keep at least the previous version for deltas
+            e.hist[ver] = e.rjs
+            while len(e.hist) > self.evtHistory:
+                del e.hist[next(iter(e.hist))]
+
+        return f'{{"evt": {json.dumps(e.evt)}, "ver": {ver}, "t": {t}, "r": {e.rjs}'
+
+
+    ''' Encode a delta message from an earlier version
+        @param [in] e       - Event record
+        @param [in] t       - Message timestamp
+        @param [in] base    - Version the delta is from, must be in e.hist
+
+        Call after encodeEvent().  The patch is made once per version and
+        base.  Returns the message missing its closing brace like
+        encodeEvent(), or None if the patch wouldn't be smaller than the
+        full data.
+    '''
+    def encodeDelta(self, e, t, base):
+
+        if e.dver != e.rver:
+            e.deltas = {}
+            e.dver = e.rver
+
+        if base not in e.deltas:
+            djs = self.json.dumps(delta.diff(self.json.loads(e.hist[base]), self.json.loads(e.rjs)))
+            e.deltas[base] = djs if len(djs) < len(e.rjs) else None
+
+        djs = e.deltas[base]
+        if djs is None:
+            return None
+
+        return f'{{"evt": {json.dumps(e.evt)}, "ver": {e.rver}, "base": {base}, "t": {t}, "d": {djs}'
+
+
+    ''' Build the messages for subscribers that are behind on an event
+        @param [in] e       - Event record
+        @param [in] t       - Message timestamp
+        @param [in] subs    - Subscribers to consider, None for all
+
+        Yields (subscriber, message, full) and marks each subscriber as
+        current.  If message is a delta, full is a function returning the
+        complete message, otherwise it is None.  Subscribers on connections
+        that opted in to deltas get one if they have the version it is
+        based on.
+    '''
+    def eventMsgs(self, e, t, subs=None):
+
+        ver = e.ver
+        pre = None
+        dpres = {}
+        nouid = self.evtNoUid
+        for v in (e.subs.values() if subs is None else subs):
+            if v.ver != ver:
+                base = v.ver
+                v.ver = ver
+
+                # Encode once, on the first subscriber that needs it
+                if pre is None:
+                    pre = self.encodeEvent(e, t)
+                    if nouid:
+                        msg = pre + '}'
+
+                if v.conn.delta and base in e.hist:
+                    if base not in dpres:
+                        dpre = self.encodeDelta(e, t, base)
+                        dpres[base] = (dpre, dpre + '}' if nouid and dpre is not None else None)
+                    dpre, dmsg = dpres[base]
+                    if dpre is not None:
+                        if nouid:
+                            yield v, dmsg, lambda: msg
+                        else:
+                            end = f', "uid": {v.ujs}}}'
+                            yield v, dpre + end, lambda end=end: pre + end
+                        continue
+
+                yield v, msg if nouid else f'{pre}, "uid": {v.ujs}}}', None
 
 
     ''' Send event to websocket connections
         @param [in] ev  - Event to send
+        @param [in] uid - Only send to this subscriber, None for all
+
+        Messages are queued on each connection and written by the
+        connection, so a slow subscriber does not hold up the others.
     '''
-    async def sendEvent(self, ev):
+    async def sendEvent(self, ev, uid=None):
 
-        if self.opts.verbose:
+        if self.verbose:
             Log(f'Send Event: {ev}')
 
-        if ev not in self.evh:
+        e = self.evh.get(ev)
+        if not e:
             return False
 
+        subs = None
+        if uid is not None:
+            subs = [e.subs[uid]] if uid in e.subs else []
+
+        m = self.metrics
+        t = time.perf_counter_ns()
+        n = size = 0
+
+        ruids = []
+        for v, msg, full in self.eventMsgs(e, time.time(), subs):
+            n += 1
+            size += len(msg)
+            if not v.conn.push((ev, v.uid), msg, full):
+                ruids.append(v)
+
+        if m and n:
+            m.eventSent(ev, n, size)
+            m.fanout.add((time.perf_counter_ns() - t) // 1000)
+
+        # Remove failed uids
+        for v in ruids:
+            self.removeUid(v.uid, v.conn)
+
+
+    ''' Send several events to websocket connections
+        @param [in] evs - Events to send
+
+        All the updates for a connection are queued together.  If the
+        connection opted in to batched events, they go out as a single
+        frame containing an array of event messages, unless the
+        connection is past opts.sendhwm.
+    '''
+    async def sendEvents(self, evs):
+
+        if self.verbose:
+            Log(f'Send Events: {evs}')
+
+        m = self.metrics
+        ns = time.perf_counter_ns()
+
+        # Group messages by connection
         t = time.time()
-        ver = self.evh[ev]['ver']
-        r = self.evh[ev]['last']
-        if isinstance(r, pb.Bag):
-            r = self.evh[ev]['last'].as_dict()
+        out = {}
+        for ev in evs:
+            e = self.evh.get(ev)
+            if e:
+                n = size = 0
+                for v, msg, full in self.eventMsgs(e, t):
+                    out.setdefault(v.conn, []).append((v, ev, msg, full))
+                    n += 1
+                    size += len(msg)
+                if m and n:
+                    m.eventSent(ev, n, size)
+
+        # A batch can't be coalesced, so once a connection is behind its
+        # events are queued one by one, and replace the ones still waiting
         ruids = []
-        for k,v in self.evh[ev]['cb'].items():
-            if v['ver'] != ver:
-                v['ver'] = ver
-                if not await self.sendMsg(v['ws'], {
-                                        'evt':ev,
-                                        'uid': k,
-                                        'ver':ver,
-                                        't':t,
-                                        'r':r
-                                    }):
-                    ruids.append(k)
+        for conn, msgs in out.items():
+            if conn.batch and 1 < len(msgs) and not conn.congested():
+                if not conn.push(object(), '[' + ', '.join(m[2] for m in msgs) + ']'):
+                    ruids += [m[0] for m in msgs]
+            else:
+                for v, ev, msg, full in msgs:
+                    if not conn.push((ev, v.uid), msg, full):
+                        ruids.append(v)
+
+        if m and out:
+            m.fanout.add((time.perf_counter_ns() - ns) // 1000)
 
         # Remove failed uids
         for v in ruids:
-            self.removeUid(v)
+            self.removeUid(v.uid, v.conn)
+
+
+    ''' Set delivery limits for an event
+        @param [in] event       - Event to limit
+        @param [in] rate        - Maximum deliveries per second, 0 for no limit
+        @param [in] burst       - Number of deliveries that may go out back to
+                                    back before rate applies
+        @param [in] interval    - Minimum seconds between deliveries
+        @param [in] trailing    - If True, a held back version is delivered as
+                                    soon as the limits allow, otherwise it waits
+                                    for the next trigger
+
+        Triggers are never lost, the version counter makes sure subscribers
+        get the latest data when the event goes out.  Call with no limits
+        to remove them.
+
+        @begincode
+
+            # At most 10 updates a second, the last one always gets through
+            wsa.setEventLimit('matrixUpdate', rate=10)
+
+        @endcode
+    '''
+    def setEventLimit(self, event, rate=0, burst=1, interval=0, trailing=True):
+        if not rate and not interval:
+            self.evLimits.pop(event, None)
+        else:
+            self.evLimits[event] = EventLimit(rate, burst, interval, trailing)
+
+
+    ''' Apply delivery limits to triggered events
+        @param [in] evs - Events that were triggered
+
+        Returns the events that may be sent now.  Trailing deliveries are
+        scheduled for the rest.
+    '''
+    def limitEvents(self, evs):
+
+        if not self.evLimits:
+            return evs
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        out = []
+        for ev in evs:
+            lim = self.evLimits.get(ev)
+            if lim:
+                d = lim.wait(now)
+                if 0 < d:
+                    if lim.trailing and not lim.timer:
+                        lim.timer = loop.call_later(d, self.flushEvent, ev, lim)
+                    continue
+                lim.take(now)
+            out.append(ev)
+        return out
+
+
+    ''' Delivers an event that was held back by its limits
+        @param [in] ev  - Event to send
+        @param [in] lim - The EventLimit that scheduled the delivery
+    '''
+    def flushEvent(self, ev, lim):
+        lim.timer = None
+        if self.evLimits.get(ev) is lim:
+            evs = self.limitEvents([ev])
+        else:
+            evs = [ev]
+        if evs:
+            asyncio.ensure_future(self.sendEvent(ev))
+
+
+    ''' Clears cached handler results, see register()
+        @param [in] sub     - Handler group, None for all groups
+        @param [in] fn      - Function name, None for all functions in the group
+
+        Safe to call from any thread, i.e. from a handler after changing
+        the data behind a cached function.
+    '''
+    def invalidateCache(self, sub=None, fn=None):
+        for k, h in list(self.handlers.items()):
+            if sub is None or sub == k:
+                for n, c in h['caches'].items():
+                    if fn is None or fn == n:
+                        c.clear()
+
+
+    ''' Clears the result caches tied to events, see register()
+        @param [in] events  - Names of the events triggered
+    '''
+    def invalidateEvents(self, events):
+        if self.cacheEvents:
+            for ev in events:
+                for c in self.cacheEvents.get(ev, ()):
+                    c.clear()
 
 
     ''' Trigger the specified event
@@ -201,221 +1057,623 @@ class WebShoesApp():
     '''
     async def triggerEventSync(self, event, data):
 
-        if self.opts.verbose:
+        if self.verbose:
             Log(f'Trigger event: {event}')
 
+        # The hub numbers it and sends it to every worker
+        if self.bus:
+            await self.bus.publish({event: plainData(data)})
+            return
+
+        self.invalidateEvents([event])
+
         # If it doesn't exist
-        if event not in self.evh:
-            self.evh[event] = {'evt': event, 'cb':{}, 'ver': 1, 'last': data}
+        e = self.evh.get(event)
+        if not e:
+            self.evh[event] = Event(event, 1, data)
 
         # Update existing event
         else:
-            self.evh[event]['last'] = data
-            self.evh[event]['ver'] += 1
-            await self.sendEvent(event)
+            e.last = data
+            e.ver += 1
+            if self.limitEvents([event]):
+                await self.sendEvent(event)
+
+
+    ''' Trigger several events at once
+        @param [in] events - dict of event names to data
+
+        Every version is bumped before anything is sent, so subscribers
+        never see part of the batch.
+    '''
+    async def triggerEventsSync(self, events):
+
+        if self.verbose:
+            Log(f'Trigger events: {list(events.keys())}')
+
+        if self.bus:
+            await self.bus.publish({k: plainData(v) for k, v in events.items()})
+            return
+
+        self.invalidateEvents(events.keys())
+
+        evs = []
+        for event, data in events.items():
+            e = self.evh.get(event)
+            if not e:
+                self.evh[event] = Event(event, 1, data)
+            else:
+                e.last = data
+                e.ver += 1
+                evs.append(event)
+
+        evs = self.limitEvents(evs)
+        if evs:
+            await self.sendEvents(evs)
+
+
+    ''' Applies events from the event bus, see bus.py
+        @param [in] events - dict of event names to (version, data)
+
+        Versions older than the one we have are late, and ignored.
+    '''
+    async def receiveEvents(self, events):
+
+        if self.verbose:
+            Log(f'Receive events: {list(events.keys())}')
+
+        self.invalidateEvents(events.keys())
+
+        evs = []
+        for event, (ver, data) in events.items():
+            e = self.evh.get(event)
+            if not e:
+                self.evh[event] = Event(event, ver, data)
+            elif ver > e.ver:
+                e.last = data
+                e.ver = ver
+                evs.append(event)
+
+        evs = self.limitEvents(evs)
+        if 1 == len(evs):
+            await self.sendEvent(evs[0])
+        elif evs:
+            await self.sendEvents(evs)
+
+
+    ''' Thread safe function to call a function in callMap on the server loop
+        @param [in] fn      - Name of the function in callMap
+        @param [in] kwargs  - Arguments for the function
+
+        The call is scheduled directly on the server loop, which wakes
+        right away.  Returns a concurrent.futures.Future for the result.
+        Don't block on the result from inside a handler, as that is the
+        server loop.
+    '''
+    def callLoop(self, fn, **kwargs):
+
+        # Straight onto the server loop if it's there
+        loop = self.thread.loop
+        if loop and not loop.is_closed():
+            coro = self.callMap[fn](**kwargs)
+            try:
+                return asyncio.run_coroutine_threadsafe(coro, loop)
+            except RuntimeError:
+                coro.close()
+
+        # Server isn't running yet, leave it on the message queue
+        fut = concurrent.futures.Future()
+        def onDone(ctx, p, r, e):
+            if e:
+                fut.set_exception(e)
+            else:
+                fut.set_result(r)
+        self.thread.call(onDone, fn, **kwargs)
+        return fut
 
 
     ''' Thread safe function to trigger the specified event
         @param [in] event  - Event to trigger
         @param [in] data   - Data associated with the event
+
+        Returns a concurrent.futures.Future that completes once the
+        event has been queued to its subscribers.  Result caches tied
+        to the event are cleared before this returns.
     '''
     def triggerEvent(self, event, data):
-        return self.thread.call('triggerEventSync', event=event, data=data)
+        self.invalidateEvents([event])
+        return self.callLoop('triggerEventSync', event=event, data=data)
+
+
+    ''' Thread safe function to trigger several events at once
+        @param [in] events - dict of event names to data
+
+        Crosses to the server thread once for the whole batch.  Returns a
+        concurrent.futures.Future that completes once the events have
+        been queued to their subscribers.
+    '''
+    def triggerEvents(self, events):
+        self.invalidateEvents(events.keys())
+        return self.callLoop('triggerEventsSync', events=dict(events))
 
 
     ''' Remove specified uid from the event handler list
-        @param [in] uid - Unique id of event handler
+        @param [in] uid     - Unique id of event handler
+        @param [in] conn    - If not None, only subscriptions still bound
+                                to this connection are removed
     '''
-    def removeUid(self, uid):
-        for k,v in self.evh.items():
-            if uid in v['cb']:
-                if self.opts.verbose:
-                    Log(f'Removing event target: {uid}')
-                del v['cb'][uid]
+    def removeUid(self, uid, conn=None):
+        evs = self.uidEvents.get(uid)
+        if not evs:
+            return
+
+        verbose = self.verbose
+        for ev in list(evs):
+            e = self.evh.get(ev)
+            sub = e.subs.get(uid) if e else None
+            if sub and (conn is None or sub.conn is conn):
+                if verbose:
+                    Log(f'Removing event target: {uid} -> {ev}')
+                del e.subs[uid]
+                evs.discard(ev)
+            elif not sub:
+                evs.discard(ev)
+
+        if not evs:
+            del self.uidEvents[uid]
+
 
     ''' Send files from directory
         @param [in] ctx     - Calling context variables
-        @param [in] q       - Query variables
+        @param [in] q       - Query variables, not used
+        @param [in] fo      - Folder settings, looked up from the request path if None
+        @param [in] fname   - File name within the folder, from the request path if None
+
+        The folder settings are the dict registered in place of a function
+                                root    = Folder to serve
+                                defpage = Page to redirect to for folder requests
+                                cache   = Cache-Control header value, i.e. 'max-age=3600'
+
+        Small files are kept in memory, see FileCache and opts.filecache.
+        Responses carry an ETag and Last-Modified, so browsers can
+        revalidate and get a 304 instead of the whole file.
+
+        Clients that accept it get a precompressed sibling, i.e. file.js.br
+        or file.js.gz, see precompress.py.  Without one, cached text files
+        are gzipped once and the result kept.
     '''
     @staticmethod
-    async def serveFolder(ctx, q):
+    async def serveFolder(ctx, q, fo=None, fname=None):
+
+        # handleHttp() passes the route it found, q depends on the wrap mode
+        if fo is None or fname is None:
+            p = ctx.req.path.split('/')
+            while len(p) and not p[0]:
+                p = p[1:]
+            fname = '/'.join(p[1:])
+            h, fn = ctx.wsa.findRoute(p, ctx.wsa.handlers)
+            fo = h['fm'][fn]
 
         # Root folder must exist
-        if not q._.root or not os.path.isdir(q._.root):
+        root = fo.get('root')
+        if not root or not os.path.isdir(root):
             return web.Response(text='Not Found', status=404)
 
-        # Parse the path
-        p = ctx.req.path.split('/')
-        while len(p) and not p[0]:
-            p = p[1:]
-        fname = '/'.join(p[1:])
+        # Find a file with this name, but not outside the root
+        root = os.path.normpath(root)
+        p = os.path.normpath(os.path.join(root, fname))
+        if p != root and not p.startswith(os.path.join(root, '')):
+            return web.Response(text='Not Found', status=404)
+
+        m = ctx.wsa.metrics.static if ctx.wsa.metrics else {}
 
-        # Find a file with this name
-        p = os.path.join(q._.root, fname)
-        if not os.path.isfile(p):
-            if q._.defpage:
-                p = os.path.join(p, q._.defpage)
+        e = await ctx.wsa.fileCache.get(p)
+        if not e:
+            defpage = fo.get('defpage')
+            if defpage:
+                p = os.path.join(p, defpage)
                 if os.path.isfile(p):
-                    return web.HTTPSeeOther(os.path.join(ctx.req.path, q._.defpage))
+                    return web.HTTPSeeOther(os.path.join(ctx.req.path, defpage))
+            if m:
+                m['not_found'] += 1
             return web.Response(text='Not Found', status=404)
 
-        # Try to put the correct mime type
-        mime = mimetypes.guess_type(p)[0]
-        if not mime:
-            mime = 'text/plain'
-
         # If verbose is set
-        if ctx.opts.verbose:
-            Log(f'[{mime}] {p}')
+        if ctx.wsa.verbose:
+            Log(f'[{e.mime}] {p}')
+
+        headers = {'Content-Type': e.mime}
+        if fo.get('cache'):
+            headers['Cache-Control'] = fo['cache']
+
+        # Too big to keep in memory, FileResponse handles the validators
+        if e.data is None:
+            if m:
+                m['file'] += 1
+            return web.FileResponse(p, headers=headers)
+
+        # Compressed version if the client takes one
+        body, etag = e.data, e.etag
+        headers['Vary'] = 'Accept-Encoding'
+        accept = acceptEncodings(ctx.req)
+        for enc in ('br', 'gzip'):
+            if enc in accept:
+                r = await ctx.wsa.fileCache.encoded(e, enc)
+                if r:
+                    body, etag = r
+                    headers['Content-Encoding'] = enc
+                    break
+
+        headers['ETag'] = etag
+        headers['Last-Modified'] = e.lastmod
+        if e.notModified(ctx.req, etag):
+            del headers['Content-Type']
+            headers.pop('Content-Encoding', None)
+            if m:
+                m['not_modified'] += 1
+            return web.Response(status=304, headers=headers)
+
+        if m:
+            m['ok'] += 1
+            m['bytes'] += len(body)
+        return web.Response(body=body, headers=headers)
+
+
+    ''' Sends the values from a streaming handler, one frame each
+        @param [in] ws      - Websocket
+        @param [in] conn    - WsConn for the websocket
+        @param [in] h       - Handler group
+        @param [in] tid     - Transaction id of the command
+        @param [in] g       - Async generator from callHandler()
+
+        Each frame carries the tid of the command, the caller sends the
+        end marker.  Every send waits for the socket to drain past the
+        writer limit, so a slow client slows the generator down instead
+        of building up a backlog.  Returns False if the connection went.
+    '''
+    async def streamWs(self, ws, conn, h, tid, g):
+        rep = h['rep']
+        try:
+            async for v in g:
+                if isinstance(v, (pb.Bag, Params)):
+                    v = plainData(v)
+                if rep:
+                    v = {rep: v}
+                if tid:
+                    v['tid'] = tid
+                if not await self.sendMsg(ws, v, conn.codec):
+                    return False
+        finally:
+            await g.aclose()
+        return True
+
+
+    ''' Handle a single websocket command
+        @param [in] req     - The original websocket request object
+        @param [in] ws      - The websocket handler object
+        @param [in] conn    - WsConn for the websocket
+        @param [in] j       - Decoded command
+        @param [in] order   - Last command of each ordered group, by sub name
+
+        Returns a tuple of (reply, event), where event is the (event, uid)
+        to send once the reply has gone out, or None.
+
+        Streaming handlers send their values from here, see streamWs(),
+        and the reply is the end marker, {'end': true, 'tid': ...}.
+
+        Everything up to the order check must stay free of awaits, that
+        is what keeps ordered groups in arrival order.
+    '''
+    async def handleWsCmd(self, req, ws, conn, j, order):
+
+        # Transaction id
+        tid = ''
+        done = None
+        h = None
+
+        try:
+            # Message
+            if not isinstance(j, dict):
+                raise Exception('Bad message')
+
+            if self.verbose:
+                Log(f'Message: {j}')
+
+            # Save away the latest transaction id
+            tid = j.get('tid') or ''
+
+            r = None
+            res = None
+            sendEvent = None
+
+            # Event handler registration?
+            for k, eh in self.evtRoutes.items():
+                if k in j:
+                    h = eh
+                    uid = j.get('uid')
+                    if not uid:
+                        letters = '1324567890ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                        uid = ''.join(random.choice(letters) for i in range(32))
+                    evt = j[k]
+                    conn.uids.add(uid)
+
+                    # Version the client already has, if it's from this server
+                    ver = j.get('ver', 0) if j.get('iid') == self.iid else 0
+                    if not isinstance(ver, int):
+                        ver = 0
+
+                    await self.addEventHanlder(evt, uid, conn, ver)
+                    r = {'uid': uid, 'status': 'Event added', 'iid': self.iid}
+                    sendEvent = (evt, uid)
+                    break
+
+            # Check for command
+            else:
+                for k, rt in self.routes.items():
+                    if k not in j:
+                        continue
+
+                    # Command
+                    cmd = j[k]
+
+                    # Split the command
+                    p = cmd.split('/')
+                    while len(p) and not p[0]:
+                        p = p[1:]
+
+                    # Bad handler?
+                    if 0 >= len(p):
+                        raise Exception(f'Bad handler: {cmd}')
+
+                    # Find function
+                    h, fn = self.findRoute(p, rt['sub'], rt['fn'])
+                    f = h['fm'][fn]
+                    if not callable(f):
+                        raise Exception(f'No callable handler for {cmd}')
+
+                    # Wait for the previous command in an ordered group
+                    if h['ordered']:
+                        prev = order.get(h['sub'])
+                        done = order[h['sub']] = asyncio.get_running_loop().create_future()
+                        if prev:
+                            await asyncio.shield(prev)
+
+                    # Params
+                    q = {}
+                    if h['q'] in j:
+                        q = j[h['q']]
+                    else:
+                        q = j
+
+                    try:
+                        # Call user handler
+                        r = await self.callHandler(h, fn, f, cmd, req, q, ws)
+
+                        # Stream, then mark the end
+                        if inspect.isasyncgen(r):
+                            g, r = r, None
+                            if await self.streamWs(ws, conn, h, tid, g):
+                                res = {'end': True}
+                    except Exception as e:
+                        Log(e)
+                        raise Exception('Server Error')
+
+                    break
+
+            # Send response if needed
+            if r:
+                if isinstance(r, (pb.Bag, Params)):
+                    r = r.as_dict()
+
+                if 'rep' in h and h['rep']:
+                    res = {h['rep']:r}
+                else:
+                    res = r
+            if res:
+                if tid:
+                    res['tid'] = tid
+                if 't' not in res:
+                    res['t'] = time.time()
+
+            return res, sendEvent
+
+        except Exception as e:
+            Log(e)
+            res = {'error': str(e)}
+            if tid:
+                res['tid'] = tid
+            return res, None
+
+        # Let the next command in the group go
+        finally:
+            if done:
+                if not done.done():
+                    done.set_result(True)
+                if order.get(h['sub']) is done:
+                    del order[h['sub']]
+
+
+    ''' Handle a websocket message
+        @param [in] req     - The original websocket request object
+        @param [in] ws      - The websocket handler object
+        @param [in] conn    - WsConn for the websocket
+        @param [in] data    - Message text
+        @param [in] order   - Last command of each ordered group, by sub name
+        @param [in] slots   - Semaphore limiting the commands in progress, the
+                              message already holds one of them
+
+        Runs as its own task so a slow command doesn't hold up the ones
+        behind it.  The message may also be an array of commands, these
+        are handled concurrently, each taking a slot of its own, and the
+        replies sent back together in one array.
+    '''
+    async def handleWsMsg(self, req, ws, conn, data, order, slots=None):
+
+        try:
+            if isinstance(data, bytes):
+                if not conn.codec:
+                    raise Exception('Binary frames need a codec, see codec.py')
+                j = conn.codec.loads(data)
+            else:
+                j = self.json.loads(data)
+        except Exception as e:
+            Log(e)
+            await self.sendMsg(ws, {'error': str(e)}, conn.codec)
+            return
+
+        # Batch of commands
+        if isinstance(j, list):
+            cmds = []
+            try:
+                for i, v in enumerate(j):
+                    c = asyncio.ensure_future(self.handleWsCmd(req, ws, conn, v, order))
+                    cmds.append(c)
+
+                    # The first one runs in the message's slot
+                    if slots and i:
+                        c.add_done_callback(lambda c: slots.release())
+                    if slots and i + 1 < len(j):
+                        await slots.acquire()
+                rs = await asyncio.gather(*cmds)
+            except asyncio.CancelledError:
+                for c in cmds:
+                    c.cancel()
+                raise
+            res = [r for r, e in rs if r]
+            if res:
+                await self.sendMsg(ws, res, conn.codec)
+            for r, e in rs:
+                if e:
+                    await self.sendEvent(*e)
+            return
 
-        return web.FileResponse(p, headers={"Content-Type":mime})
+        res, e = await self.handleWsCmd(req, ws, conn, j, order)
+        if res:
+            await self.sendMsg(ws, res, conn.codec)
+        if e:
+            await self.sendEvent(*e)
 
 
-    ''' Called to handle a websocket message
+    ''' Called to handle a websocket connection
         @param [in] req     - The original websocket request object
         @param [in] ws      - The websocket handler object
+
+        Messages are processed concurrently, up to opts.wsinflight at a
+        time, and replies go out as they finish.  Clients match them up
+        by tid.  Each command in a batch counts against the limit.
     '''
     async def handleWs(self, req, ws):
 
-        if self.opts.verbose:
+        if self.verbose:
             Log('websocket connected')
 
-        # List of events created by this websocket
-        evts = []
+        # Outbound queue, also tracks events created by this websocket
+        conn = WsConn(self, req, ws,
+                      hwm=self.opts.get('sendhwm', 1024*1024),
+                      policy=self.opts.get('sendpolicy', 'coalesce'),
+                      to=self.opts.get('sendtimeout', 30))
 
-        # For each message from the web socket
-        async for msg in ws:
+        # Client opted in to batched event frames, i.e. ws://host/path?evtbatch=1
+        conn.batch = req.query.get('evtbatch', '') not in ('', '0', 'false')
 
-            # Transaction id
-            tid = ''
+        # Client opted in to delta events, i.e. ws://host/path?evtdelta=1
+        conn.delta = req.query.get('evtdelta', '') not in ('', '0', 'false')
 
-            # If it's a text message
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                if msg.data:
-                    try:
-                        # Message
-                        j = pb.Bag(json.loads(msg.data), '')
-
-                        if self.opts.verbose:
-                            Log(f'Message: {j}')
-
-                        # Save away the latest transaction id
-                        if j.tid:
-                            tid = j.tid
-
-                        # Find handler
-                        for c,h in self.handlers.items():
-
-                            r = None
-                            sendEvent = None
-
-                            # Event handler registration?
-                            if h['evt'] and h['evt'] in j:
-                                uid = j.uid
-                                if not uid:
-                                    letters = '1324567890ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-                                    uid = ''.join(random.choice(letters) for i in range(32))
-                                evt = j[h['evt']]
-                                evts.append(uid)
-                                await self.addEventHanlder(evt, uid, ws)
-                                r = {'uid': uid, 'status': 'Event added'}
-                                sendEvent = evt
-
-                            # Check for command
-                            elif h['cmd'] and j.exists(h['cmd']):
-
-                                # Command
-                                cmd = j[h['cmd']]
-
-                                # Params
-                                q = {}
-                                if h['q'] in j:
-                                    q = j[h['q']]
-                                else:
-                                    q = j
-
-                                # Split the command
-                                p = cmd.split('/')
-                                while len(p) and not p[0]:
-                                    p = p[1:]
-
-                                # Bad handler?
-                                if 0 >= len(p):
-                                    Log(f'Bad handler: {cmd}')
-                                    continue
-
-                                # Is this our handler?
-                                if p[0] != h['sub']:
-                                    continue
-
-                                # Skip sub path if needed
-                                if 1 < len(p) and h['sub'] and p[0] == h['sub']:
-                                    p = p[1:]
-
-                                # Ensure a handler
-                                if p[0] not in h['fm']:
-                                    if '*' not in h['fm']:
-                                        raise Exception(f'No handler for {cmd}')
-                                    p[0] = '*'
-
-                                # Find function
-                                f = h['fm'][p[0]]
-                                if not callable(f):
-                                    raise Exception(f'No callable handler for {cmd}')
-
-                                # Context for user functions
-                                ctx = pb.Bag({'p': cmd, 'req': req, 'opts': self.opts, 'wsa': self, 'ws': ws})
-
-                                try:
-                                    # Call user handler
-                                    r = f(ctx, pb.Bag(q))
-                                    if inspect.isawaitable(r):
-                                        r = await r
-                                except Exception as e:
-                                    Log(e)
-                                    raise Exception('Server Error')
-
-                            else:
-                                continue
-
-                            # Send response if needed
-                            if r:
-                                if isinstance(r, pb.Bag):
-                                    r = r.as_dict()
-
-                                if 'rep' in h and h['rep']:
-                                    res = {h['rep']:r}
-                                else:
-                                    res = r
-                                if j.tid:
-                                    res['tid'] = tid
-                                if 't' not in res:
-                                    res['t'] = time.time()
-                                await self.sendMsg(ws, res)
-
-                            # Send event if needed
-                            if sendEvent:
-                                await self.sendEvent(sendEvent)
-
-                            break
+        # Binary codec negotiated with a subprotocol, i.e. 'webshoes.msgpack'
+        conn.codec = self.wsCodecs.get(ws.ws_protocol)
 
+        # permessage-deflate settings
+        self.setupWsCompression(ws)
+
+        m = self.metrics
+        if m:
+            m.wsConnections += 1
+            m.wsConnectionsTotal += 1
+
+        # Commands in progress
+        tasks = set()
+        order = {}
+        slots = asyncio.Semaphore(max(1, self.opts.get('wsinflight', 16)))
+
+        def onDone(task):
+            tasks.discard(task)
+            slots.release()
+
+        try:
+            # For each message from the web socket
+            async for msg in ws:
+
+                # If it's a text message
+                if msg.type == aiohttp.WSMsgType.TEXT or msg.type == aiohttp.WSMsgType.BINARY:
+                    if msg.data:
+                        if m:
+                            m.wsMessages += 1
+
+                        # Stop reading while the connection is at its limit
+                        await slots.acquire()
+                        task = asyncio.ensure_future(self.handleWsMsg(req, ws, conn, msg.data, order, slots))
+                        tasks.add(task)
+                        task.add_done_callback(onDone)
+
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    Log(f'websocket error: {ws.exception()}')
+
+        finally:
+            if self.verbose:
+                Log('websocket disconnected')
+
+            if m:
+                m.wsConnections -= 1
+
+            # Nobody left to reply to
+            for v in list(tasks):
+                v.cancel()
+
+            # Remove events
+            conn.close()
+            for e in conn.uids:
+                self.removeUid(e, conn)
 
-                    except Exception as e:
-                        Log(e)
-                        res = {'error': str(e)}
-                        if tid:
-                            res['tid'] = tid
-                        await self.sendMsg(ws, res)
 
-            elif msg.type == aiohttp.WSMsgType.ERROR:
-                Log(f'websocket error: {ws.exception()}')
+    ''' Sends the values from a streaming handler as newline delimited json
+        @param [in] req     - Request object
+        @param [in] g       - Async generator from callHandler()
+
+        The reply is sent with chunked encoding as the values come in, so
+        the whole result is never held in memory.  Each write waits for
+        the socket to drain.  The status has already gone out by the time
+        a handler fails, so an error ends the stream with an error line.
+    '''
+    async def streamHttp(self, req, g):
 
-        if self.opts.verbose:
-            Log('websocket disconnected')
+        resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        resp.enable_chunked_encoding()
+        await resp.prepare(req)
 
-        # Remove events
-        for e in evts:
-            self.removeUid(e)
+        m = self.metrics
+        dumps = self.json.dumps
+        try:
+            async for v in g:
+                if isinstance(v, (pb.Bag, Params)):
+                    v = plainData(v)
+                b = (dumps(v) + '\n').encode()
+                if m:
+                    m.httpBytes += len(b)
+                await resp.write(b)
+
+        # Client went away
+        except ConnectionError:
+            return resp
+
+        except Exception as e:
+            Log(e)
+            await resp.write((dumps({'error': 'Server error'}) + '\n').encode())
+
+        finally:
+            await g.aclose()
+
+        await resp.write_eof()
+        return resp
 
 
     ''' HTTP request handler
@@ -423,39 +1681,21 @@ class WebShoesApp():
     '''
     async def handleHttp(self, req):
 
-        if self.opts.verbose:
+        if self.verbose:
             Log(f'HTTP Request {req.path}')
 
         p = req.path.split('/')
         while len(p) and not p[0]:
             p = p[1:]
 
-        if 0 >= len(p):
-            p = ['*']
-
-        if 1 == len(p):
-            p = [p[0], '*']
-
-        # Find handler group
-        if p[0] not in self.handlers:
-            if '*' not in self.handlers:
-                raise Exception(f'No handler group for {req.path}')
-            p[0] = '*'
-
         # Find handler
-        h = self.handlers[p[0]]
-        if p[1] not in h['fm']:
-            if '*' not in h['fm']:
-                raise Exception(f'No handler for {req.path}')
-            p[1] = '*'
-
-        # Find function
-        params = {}
-        f = h['fm'][p[1]]
+        h, fn = self.findRoute(p, self.handlers)
+
+        # Find function, a dict is a folder, see serveFolder()
+        f = h['fm'][fn]
         if not callable(f):
             if isinstance(f, dict):
-                params = f
-                f = self.serveFolder
+                f = functools.partial(self.serveFolder, fo=f, fname='/'.join(p[1:]))
             else:
                 raise Exception(f'No callable handler for {req.path}')
 
@@ -470,52 +1710,85 @@ class WebShoesApp():
             for k in set(m.keys()):
                 q[k] = m[k]
 
-        # Pass on object properties if any
-        if params:
-            q['_'] = pb.Bag(params)
-
-        # Context for user functions
-        ctx = pb.Bag({'p': req.path, 'req': req, 'opts': self.opts, 'wsa': self})
-
         # Call user handler
         try:
-            r = f(ctx, pb.Bag(q))
-            if inspect.isawaitable(r):
-                r = await r
+            r = await self.callHandler(h, fn, f, req.path, req, q)
         except Exception as e:
             Log(e)
             raise Exception('Server error')
 
         # application/json
-        if isinstance(r, dict) or isinstance(r, pb.Bag):
-            res = web.Response(text=json.dumps(r))
-            res.headers['Content-Type'] = 'application/json'
-            return res
+        if isinstance(r, (dict, pb.Bag, Params)):
+            if not isinstance(r, dict):
+                r = r.as_dict()
+            body = self.json.dumps(r).encode()
+            headers = {'Content-Type': 'application/json'}
+
+            # Compress large replies
+            if self.httpZipMin and self.httpZipMin <= len(body):
+                body, enc = await self.compressBody(req, body)
+                headers['Vary'] = 'Accept-Encoding'
+                if enc:
+                    headers['Content-Encoding'] = enc
+
+            if self.metrics:
+                self.metrics.httpBytes += len(body)
+
+            return web.Response(body=body, headers=headers)
+
+        # Streaming handler
+        if inspect.isasyncgen(r):
+            return await self.streamHttp(req, r)
 
         return r
 
 
+    ''' Returns True if the request is asking for a websocket upgrade
+        @param [in] req - Request object
+
+        Only the headers are inspected, so plain http requests never pay
+        for a websocket handshake attempt.
+    '''
+    @staticmethod
+    def isWsRequest(req):
+        h = req.headers
+        if 'websocket' != h.get('Upgrade', '').strip().lower():
+            return False
+        return 'upgrade' in [v.strip() for v in h.get('Connection', '').lower().split(',')]
+
+
     ''' Connection handler
         @param [in] req - Request object
     '''
     async def reqHandler(self, req):
 
-        # Try websocket
-        try:
-            ws = web.WebSocketResponse()
-            await ws.prepare(req)
+        # Websocket
+        if self.isWsRequest(req):
+            ws = web.WebSocketResponse(protocols=list(self.wsCodecs.keys()),
+                                       compress=bool(self.opts.get('wscompress', True)))
             try:
-                await self.handleWs(req, ws)
-                return ws
+                await ws.prepare(req)
             except Exception as e:
                 Log(e)
+                ws = None
+
+            if ws:
+                try:
+                    await self.handleWs(req, ws)
+                except Exception as e:
+                    Log(e)
+                return ws
 
         # Http
+        m = self.metrics
+        if m:
+            m.httpRequests += 1
+        try:
+            return await self.handleHttp(req)
         except Exception as e:
-            try:
-                return await self.handleHttp(req)
-            except Exception as e:
-                return web.Response(text=json.dumps({'error': str(e)}))
+            if m:
+                m.httpErrors += 1
+            return web.Response(text=json.dumps({'error': str(e)}))
 
 
     ''' Main thread function
@@ -525,17 +1798,36 @@ class WebShoesApp():
 
         # Initialize
         if not ctx.loops:
-            # https://docs.aiohttp.org/en/stable/web_reference.html
-            self.server = web.Server(self.reqHandler)
-            self.runner = web.ServerRunner(self.server)
-            await self.runner.setup()
-            self.site = web.TCPSite(self.runner, self.addr, self.port)
-            await self.site.start()
+
+            # Parent of worker processes, only runs the event hub
+            if self.workerSocks:
+                self.bus = WorkerHub(self.workerSocks, self.eventBus)
+                await self.bus.start()
+
+            else:
+                if self.worker is not None:
+                    self.bus = WorkerBus(self.hubSock, self.workerDone.set)
+                elif self.eventBus:
+                    self.bus = self.eventBus
+                if self.bus:
+                    await self.bus.start(self.receiveEvents)
+
+                # https://docs.aiohttp.org/en/stable/web_reference.html
+                self.server = web.Server(self.reqHandler)
+                self.runner = web.ServerRunner(self.server)
+                await self.runner.setup()
+                self.site = web.TCPSite(self.runner, self.addr, self.port,
+                                        reuse_port=(self.worker is not None))
+                await self.site.start()
 
         # Shutdown
         if not ctx.run:
-            await self.site.stop()
-            await self.runner.cleanup()
+            if self.bus:
+                await self.bus.close()
+                self.bus = None
+            if self.site:
+                await self.site.stop()
+                await self.runner.cleanup()
             self.site = None
             self.runner = None
             self.server = None
@@ -547,15 +1839,92 @@ class WebShoesApp():
 
 
     ''' Starts the server thread
+
+        With opts.workers above 1, that many worker processes are forked
+        to serve the port between them with SO_REUSEPORT, and this process
+        only relays events.  Register handlers before calling this, the
+        workers get a copy of them when they're forked.  triggerEvent()
+        works from here or from a worker, subscribers on every worker get
+        the event with the same version, see bus.py.  Worker mode needs
+        fork() and SO_REUSEPORT, i.e. Linux, and a fixed port.
     '''
     def start(self):
         self.stop()
+        n = self.opts.get('workers', 0)
+        if n and 1 < n:
+            self.startWorkers(n)
         self.thread.start()
 
 
-    ''' Stops the server thread
+    ''' Forks the worker processes
+        @param [in] n       - Number of workers
+    '''
+    def startWorkers(self, n):
+
+        # Handlers can't be pickled, so the workers must be forked
+        mp = multiprocessing.get_context('fork')
+
+        pairs = [socket.socketpair() for i in range(n)]
+        for i, (a, b) in enumerate(pairs):
+            w = mp.Process(target=self.runWorker, args=(i, b, pairs), name=f'webshoes-{i}')
+            w.start()
+            self.workers.append(w)
+
+        for a, b in pairs:
+            b.close()
+        self.workerSocks = [a for a, b in pairs]
+
+
+    ''' Worker process main
+        @param [in] i       - Worker index
+        @param [in] sock    - Worker end of the socket pair to the hub
+        @param [in] pairs   - All socket pairs, the others are closed here
+
+        Runs until the parent closes the hub.
+    '''
+    def runWorker(self, i, sock, pairs):
+
+        # The parent shuts us down
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # Only our end stays open, or we'd never see the hub close
+        for a, b in pairs:
+            a.close()
+            if b is not sock:
+                b.close()
+
+        self.worker = i
+        self.workers = []
+        self.hubSock = sock
+        self.workerDone = threading.Event()
+
+        if self.verbose:
+            Log(f'Worker {i} started, pid {os.getpid()}')
+
+        self.thread.start()
+        self.workerDone.wait()
+        self.stop()
+
+
+    ''' Stops the server thread, and the workers if there are any
     '''
     def stop(self):
         if self.thread:
             self.thread.join(True)
 
+        # Closing the hub tells the workers to exit
+        for v in self.workerSocks or []:
+            v.close()
+        for w in self.workers:
+            w.join(10)
+            if w.is_alive():
+                w.terminate()
+                w.join()
+        self.workers = []
+        self.workerSocks = None
+
+        # Process workers have to be waited for or they're left behind
+        for k, v in self.pools.items():
+            v.shutdown(wait=('process' == k), cancel_futures=True)
+        self.pools = {}
+
@@ -0,0 +1,197 @@
+import asyncio
+import collections
+
+try:
+    import sparen
+    Log = sparen.log
+except Exception as e:
+    Log = print
+
+
+class WsConn():
+
+    ''' Slow consumer policies, applied once the amount of data waiting
+        to go out on a connection passes the high-water mark
+
+            coalesce    - A queued frame for the same key is replaced with
+                          the newer one, so at most one version per event
+                          subscription is waiting
+            drop        - A queued frame for the same key is thrown away
+                          and the newer one queued at the back, so frames
+                          go out in the order of their latest version
+            disconnect  - The connection is closed if the writer is blocked
+                          on the socket, otherwise frames are coalesced as
+                          the backlog is only a burst the writer hasn't
+                          had a chance to drain yet
+    '''
+    POLICIES = ('coalesce', 'drop', 'disconnect')
+
+
+    ''' Constructor
+        @param [in] app     - WebShoesApp owning the connection
+        @param [in] req     - The original websocket request object
+        @param [in] ws      - The websocket handler object
+        @param [in] hwm     - Send buffer high-water mark in bytes
+        @param [in] policy  - Slow consumer policy, see POLICIES
+        @param [in] to      - Seconds a single send may take before the
+                                connection is considered stalled
+    '''
+    def __init__(self, app, req, ws, hwm=1024*1024, policy='coalesce', to=30):
+
+        if policy not in self.POLICIES:
+            raise Exception(f'Invalid slow consumer policy: {policy}')
+
+        self.app = app
+        self.ws = ws
+        self.transport = req.transport
+        self.hwm = hwm
+        self.policy = policy
+        self.to = to
+
+        # Event uids registered over this connection
+        self.uids = set()
+
+        # Client wants events triggered together in one array frame
+        self.batch = False
+
+        # Client accepts event deltas
+        self.delta = False
+
+        # Binary codec for replies, events are always pre-encoded json
+        self.codec = None
+
+        # Outbound queue, entries are [key, msg]
+        self.queue = collections.deque()
+        self.latest = {}
+        self.size = 0
+
+        self.busy = False
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.task = asyncio.ensure_future(self.writer())
+
+
+    ''' Returns the number of bytes waiting to be sent
+    '''
+    def pending(self):
+        n = self.size
+        if self.transport:
+            n += self.transport.get_write_buffer_size()
+        return n
+
+
+    ''' Returns True if the amount waiting to be sent is over the high-water mark
+    '''
+    def congested(self):
+        return bool(self.hwm) and self.pending() >= self.hwm
+
+
+    ''' Queue a message for sending
+        @param [in] key     - Key identifying what the message is a version of,
+                                used when coalescing
+        @param [in] msg     - Encoded message
+        @param [in] full    - If msg only makes sense after the messages
+                                before it, i.e. a delta, a function returning
+                                a message that stands on its own.  Used if
+                                earlier messages are coalesced or dropped.
+
+        Returns False if the connection is closed or was closed because
+        it could not keep up.
+    '''
+    def push(self, key, msg, full=None):
+
+        if self.closed:
+            return False
+
+        if self.congested():
+
+            # The socket isn't draining, the client isn't keeping up
+            if 'disconnect' == self.policy and self.busy:
+                Log(f'Disconnecting slow consumer, {self.pending()} bytes pending')
+                self.fail()
+                return False
+
+            # Frames for other keys stay, their subscribers' versions have
+            # already moved on, so nothing would send them again
+            if 'drop' == self.policy:
+                e = self.latest.pop(key, None)
+                if e:
+                    self.queue.remove(e)
+                    self.size -= len(e[1])
+                    if full:
+                        msg = full()
+
+            # Replace the stale version if it hasn't gone out yet
+            elif key in self.latest:
+                if full:
+                    msg = full()
+                e = self.latest[key]
+                self.size += len(msg) - len(e[1])
+                e[1] = msg
+                return True
+
+        e = [key, msg]
+        self.queue.append(e)
+        self.latest[key] = e
+        self.size += len(msg)
+        self.ready.set()
+        return True
+
+
+    ''' Writes queued messages to the socket
+    '''
+    async def writer(self):
+
+        while not self.closed:
+
+            await self.ready.wait()
+            self.ready.clear()
+
+            while self.queue and not self.closed:
+                e = self.queue.popleft()
+                if self.latest.get(e[0]) is e:
+                    del self.latest[e[0]]
+                self.size -= len(e[1])
+
+                self.busy = True
+                try:
+                    ok = await asyncio.wait_for(self.app.sendMsg(self.ws, e[1]), self.to)
+                except asyncio.TimeoutError:
+                    Log(f'Send timed out after {self.to} seconds')
+                    ok = False
+                self.busy = False
+
+                if not ok:
+                    self.fail()
+
+
+    ''' Drops the connection and its event registrations
+
+        Registrations are removed on the next loop pass, since this may
+        be called while an event is being fanned out.
+    '''
+    def fail(self):
+        if self.closed:
+            return
+        self.close()
+        asyncio.get_event_loop().call_soon(self.removeUids)
+        asyncio.ensure_future(self.ws.close())
+
+
+    ''' Removes the event registrations made over this connection
+    '''
+    def removeUids(self):
+        for uid in list(self.uids):
+            self.app.removeUid(uid, self)
+
+
+    ''' Stops the writer, anything still queued is discarded
+    '''
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.latest.clear()
+        self.size = 0
+        self.ready.set()
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()